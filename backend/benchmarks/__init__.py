@@ -0,0 +1,4 @@
+"""Local performance benchmarks for the ChatPDF backend.
+
+Run from the backend directory, e.g. ``python -m benchmarks.extraction``.
+"""
@@ -0,0 +1,119 @@
+"""Shared helpers for the benchmark scripts: timing statistics and JSON result files."""
+
+import importlib.metadata
+import json
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Linear-interpolated percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def latency_summary(latencies_ms: List[float]) -> Dict[str, float]:
+    return {
+        "p50": round(percentile(latencies_ms, 50), 3),
+        "p90": round(percentile(latencies_ms, 90), 3),
+        "p99": round(percentile(latencies_ms, 99), 3),
+        "mean": round(sum(latencies_ms) / len(latencies_ms), 3) if latencies_ms else 0.0,
+        "min": round(min(latencies_ms), 3) if latencies_ms else 0.0,
+        "max": round(max(latencies_ms), 3) if latencies_ms else 0.0,
+    }
+
+
+async def time_async(func: Callable[[], Awaitable[Any]], iterations: int, warmup: int = 1) -> List[float]:
+    """Run an async callable repeatedly and return per-call latencies in milliseconds"""
+    for _ in range(warmup):
+        await func()
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await func()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+async def peak_memory_async(func: Callable[[], Awaitable[Any]]) -> Dict[str, int]:
+    """Memory used by one call (measured separately from timings).
+    
+    python_heap_peak_bytes comes from tracemalloc and misses native allocations such as
+    pypdfium2's; rss_peak_growth_bytes is how far the call raised the process's peak RSS, which
+    includes them but reads 0 when an earlier call already reached a higher peak.
+    """
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    try:
+        await func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    return {"python_heap_peak_bytes": peak, "rss_peak_growth_bytes": rss_growth * 1024}  # ru_maxrss is in KB on Linux
+
+
+def progress(message: str):
+    """Progress lines go to stderr so stdout carries only the JSON results"""
+    print(message, file=sys.stderr, flush=True)
+
+
+def library_versions(distributions: List[str]) -> Dict[str, Optional[str]]:
+    versions = {}
+    for name in distributions:
+        try:
+            versions[name] = importlib.metadata.version(name)
+        except importlib.metadata.PackageNotFoundError:
+            versions[name] = None
+    return versions
+
+
+def git_revision() -> Optional[str]:
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BACKEND_DIR, capture_output=True, text=True, timeout=5
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return result.stdout.strip() or None
+
+
+def write_results(path: Optional[str], benchmark: str, results: List[Dict[str, Any]],
+                  distributions: List[str], parameters: Dict[str, Any]) -> Dict[str, Any]:
+    """Write benchmark results as JSON (to stdout when no path is given) and return the report"""
+    report = {
+        "benchmark": benchmark,
+        "created_at": datetime.utcnow().isoformat() + "Z",
+        "environment": {
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "git_revision": git_revision(),
+            "libraries": library_versions(distributions),
+        },
+        "parameters": parameters,
+        "results": results,
+    }
+    payload = json.dumps(report, indent=2)
+    if path:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        Path(path).write_text(payload + "\n")
+    else:
+        print(payload)
+    return report
@@ -0,0 +1,152 @@
+"""Synthetic document generators with controlled size.
+
+Sizes are expressed in "pages" of roughly 300 words so results for different
+formats can be compared: a page is one PDF page, six DOCX paragraphs, one
+PPTX slide, or 50 spreadsheet/CSV rows.
+"""
+
+import csv
+import io
+import random
+from typing import Callable, Dict, NamedTuple
+
+WORDS_PER_PAGE = 300
+ROWS_PER_PAGE = 50
+COLUMNS = 6
+
+VOCABULARY = (
+    "analysis document chapter section method result data model system process "
+    "research value table figure summary question answer review context network "
+    "learning language evidence sample measure report theory practice design study"
+).split()
+
+
+class CorpusDocument(NamedTuple):
+    format: str
+    pages: int
+    content: bytes
+    text: str  # Ground-truth text that was written into the document
+
+
+def _words(rng: random.Random, count: int) -> str:
+    return " ".join(rng.choice(VOCABULARY) for _ in range(count))
+
+
+def make_pdf(pages: int, seed: int = 0) -> CorpusDocument:
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfgen import canvas
+
+    rng = random.Random(seed)
+    buffer = io.BytesIO()
+    pdf = canvas.Canvas(buffer, pagesize=letter)
+    text_parts = []
+    for page in range(1, pages + 1):
+        heading = f"Chapter {page}"
+        pdf.bookmarkPage(f"page{page}")
+        pdf.addOutlineEntry(heading, f"page{page}", level=0)
+        pdf.setFont("Helvetica-Bold", 14)
+        pdf.drawString(72, 740, heading)
+        pdf.setFont("Helvetica", 10)
+        lines = [_words(rng, 12) for _ in range(WORDS_PER_PAGE // 12)]
+        for index, line in enumerate(lines):
+            pdf.drawString(72, 715 - index * 25, line)
+        text_parts.append("\n".join([heading] + lines))
+        pdf.showPage()
+    pdf.save()
+    return CorpusDocument("pdf", pages, buffer.getvalue(), "\n".join(text_parts))
+
+
+def make_docx(pages: int, seed: int = 0) -> CorpusDocument:
+    from docx import Document
+
+    rng = random.Random(seed)
+    doc = Document()
+    text_parts = []
+    for page in range(1, pages + 1):
+        heading = f"Chapter {page}"
+        doc.add_heading(heading, level=1)
+        text_parts.append(heading)
+        for _ in range(6):
+            paragraph = _words(rng, WORDS_PER_PAGE // 6)
+            doc.add_paragraph(paragraph)
+            text_parts.append(paragraph)
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return CorpusDocument("docx", pages, buffer.getvalue(), "\n".join(text_parts))
+
+
+def _rows(rng: random.Random, pages: int):
+    for row in range(pages * ROWS_PER_PAGE):
+        yield [f"row{row}"] + [_words(rng, 1) if col % 2 else str(rng.randint(0, 10000)) for col in range(COLUMNS - 1)]
+
+
+def make_xlsx(pages: int, seed: int = 0) -> CorpusDocument:
+    from openpyxl import Workbook
+
+    rng = random.Random(seed)
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.title = "Data"
+    text_parts = []
+    for row in _rows(rng, pages):
+        sheet.append(row)
+        text_parts.append(" | ".join(row))
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return CorpusDocument("xlsx", pages, buffer.getvalue(), "\n".join(text_parts))
+
+
+def make_pptx(pages: int, seed: int = 0) -> CorpusDocument:
+    from pptx import Presentation
+    from pptx.util import Inches
+
+    rng = random.Random(seed)
+    presentation = Presentation()
+    layout = presentation.slide_layouts[5]  # Title only
+    text_parts = []
+    for page in range(1, pages + 1):
+        slide = presentation.slides.add_slide(layout)
+        heading = f"Chapter {page}"
+        slide.shapes.title.text = heading
+        body = _words(rng, WORDS_PER_PAGE)
+        box = slide.shapes.add_textbox(Inches(0.5), Inches(1.5), Inches(9), Inches(5))
+        box.text_frame.text = body
+        text_parts.extend([heading, body])
+    buffer = io.BytesIO()
+    presentation.save(buffer)
+    return CorpusDocument("pptx", pages, buffer.getvalue(), "\n".join(text_parts))
+
+
+def make_csv(pages: int, seed: int = 0) -> CorpusDocument:
+    rng = random.Random(seed)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    text_parts = []
+    for row in _rows(rng, pages):
+        writer.writerow(row)
+        text_parts.append(" | ".join(row))
+    return CorpusDocument("csv", pages, buffer.getvalue().encode("utf-8"), "\n".join(text_parts))
+
+
+def make_txt(pages: int, seed: int = 0) -> CorpusDocument:
+    rng = random.Random(seed)
+    text_parts = []
+    for page in range(1, pages + 1):
+        text_parts.append(f"CHAPTER {page}")
+        text_parts.extend(_words(rng, 12) for _ in range(WORDS_PER_PAGE // 12))
+    text = "\n".join(text_parts)
+    return CorpusDocument("txt", pages, text.encode("utf-8"), text)
+
+
+GENERATORS: Dict[str, Callable[..., CorpusDocument]] = {
+    "pdf": make_pdf,
+    "docx": make_docx,
+    "xlsx": make_xlsx,
+    "pptx": make_pptx,
+    "csv": make_csv,
+    "txt": make_txt,
+}
+
+
+def generate(format: str, pages: int, seed: int = 0) -> CorpusDocument:
+    return GENERATORS[format](pages, seed)
@@ -0,0 +1,103 @@
+"""Benchmark the document extractors in server.py against a synthetic corpus.
+
+Measures latency percentiles, throughput (pages/s and MB/s), peak Python heap allocation and
+peak RSS growth (which also covers native allocations) for each extractor and document size,
+and writes the results as JSON. Progress goes to stderr.
+
+    cd backend
+    python -m benchmarks.extraction --sizes 1,10,100 --iterations 5 --output results/extraction.json
+
+Importing server loads backend/.env exactly like the running service does.
+"""
+
+import argparse
+import asyncio
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from benchmarks.common import latency_summary, peak_memory_async, progress, time_async, write_results
+from benchmarks.corpus import GENERATORS, generate
+
+import server
+
+EXTRACTORS = {
+    "pdf": server.extract_text_from_pdf,
+    "docx": server.extract_text_from_docx,
+    "xlsx": server.extract_text_from_xlsx,
+    "pptx": server.extract_text_from_pptx,
+    "csv": server.extract_text_from_csv,
+    "txt": server.extract_text_from_txt,
+}
+
+LIBRARIES = ["PyPDF2", "python-docx", "openpyxl", "python-pptx", "reportlab"]
+
+
+async def benchmark_extractor(format: str, pages: int, iterations: int, corpus_dir: Optional[Path] = None) -> Dict[str, Any]:
+    document = generate(format, pages)
+    if corpus_dir:
+        corpus_dir.mkdir(parents=True, exist_ok=True)
+        (corpus_dir / f"{format}_{pages}p.{format}").write_bytes(document.content)
+    
+    extractor = EXTRACTORS[format]
+    output = await extractor(document.content)
+    latencies = await time_async(lambda: extractor(document.content), iterations)
+    memory = await peak_memory_async(lambda: extractor(document.content))
+    
+    median_seconds = latency_summary(latencies)["p50"] / 1000
+    megabytes = len(document.content) / (1024 * 1024)
+    return {
+        "format": format,
+        "pages": pages,
+        "input_bytes": len(document.content),
+        "output_chars": len(output),
+        "iterations": iterations,
+        "latency_ms": latency_summary(latencies),
+        "throughput": {
+            "pages_per_s": round(pages / median_seconds, 2) if median_seconds else None,
+            "mb_per_s": round(megabytes / median_seconds, 3) if median_seconds else None,
+        },
+        "memory": memory,
+    }
+
+
+def memory_mb(result: Dict[str, Any], key: str) -> float:
+    return result["memory"][key] / 1024 / 1024
+
+
+async def run(formats: List[str], sizes: List[int], iterations: int, corpus_dir: Optional[Path] = None) -> List[Dict[str, Any]]:
+    results = []
+    for format in formats:
+        for pages in sizes:
+            result = await benchmark_extractor(format, pages, iterations, corpus_dir)
+            progress(
+                f"{format:>5} {pages:>5}p  p50 {result['latency_ms']['p50']:>9.2f} ms  "
+                f"{result['throughput']['pages_per_s'] or 0:>9.1f} pages/s  "
+                f"{result['throughput']['mb_per_s'] or 0:>7.2f} MB/s  "
+                f"heap peak {memory_mb(result, 'python_heap_peak_bytes'):>7.1f} MB  "
+                f"RSS +{memory_mb(result, 'rss_peak_growth_bytes'):>7.1f} MB"
+            )
+            results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--formats", default=",".join(GENERATORS), help="Comma-separated formats to benchmark")
+    parser.add_argument("--sizes", default="1,10,100", help="Comma-separated document sizes in pages")
+    parser.add_argument("--iterations", type=int, default=5, help="Timed runs per format and size")
+    parser.add_argument("--output", help="JSON results file (printed to stdout when omitted)")
+    parser.add_argument("--corpus-dir", type=Path, help="Also save the generated documents here")
+    args = parser.parse_args()
+    
+    formats = [name.strip() for name in args.formats.split(",") if name.strip()]
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    results = asyncio.run(run(formats, sizes, args.iterations, args.corpus_dir))
+    write_results(args.output, "extraction", results, LIBRARIES, {
+        "formats": formats,
+        "sizes": sizes,
+        "iterations": args.iterations,
+    })
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Compare the PDF extraction engines in server.py side by side on the same corpus.
+
+For every engine and document size this measures latency percentiles and pages/s,
+plus text quality against the text that was written into the PDF:
+
+- word_f1: bag-of-words F1 between extracted and ground-truth words
+- order_ratio: difflib similarity of the two word sequences (penalises reordering)
+- outline_recall: share of chapter bookmarks found in the extracted outline
+
+Engines are called directly, without the automatic PyPDF2 fallback, so a failing
+engine shows up as an error instead of PyPDF2's numbers.
+
+    cd backend
+    python -m benchmarks.pdf_engines --sizes 1,10,100 --iterations 5 --output results/pdf_engines.json
+"""
+
+import argparse
+import asyncio
+import difflib
+from collections import Counter
+from typing import Any, Dict, List
+
+from benchmarks.common import latency_summary, progress, time_async, write_results
+from benchmarks.corpus import make_pdf
+
+import server
+
+LIBRARIES = ["PyPDF2", "pypdfium2", "reportlab"]
+
+
+def word_f1(extracted: List[str], expected: List[str]) -> float:
+    overlap = sum((Counter(extracted) & Counter(expected)).values())
+    if not overlap:
+        return 0.0
+    precision = overlap / len(extracted)
+    recall = overlap / len(expected)
+    return 2 * precision * recall / (precision + recall)
+
+
+def order_ratio(extracted: List[str], expected: List[str]) -> float:
+    return difflib.SequenceMatcher(None, extracted, expected, autojunk=False).ratio()
+
+
+def extract(engine: str, content: bytes):
+    page_texts, bookmarks = server.PDF_ENGINES[engine].extract(content)
+    return server._assemble_pdf(page_texts, bookmarks)
+
+
+async def benchmark_engine(engine: str, pages: int, iterations: int) -> Dict[str, Any]:
+    document = make_pdf(pages)
+    result = {"engine": engine, "pages": pages, "input_bytes": len(document.content), "iterations": iterations}
+    try:
+        text, outline = extract(engine, document.content)
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+        return result
+
+    async def run_once():
+        return extract(engine, document.content)
+
+    latencies = await time_async(run_once, iterations)
+    median_seconds = latency_summary(latencies)["p50"] / 1000
+    extracted_words = text.split()
+    expected_words = document.text.split()
+    outline_titles = {entry["title"] for entry in outline}
+
+    result.update({
+        "output_chars": len(text),
+        "latency_ms": latency_summary(latencies),
+        "pages_per_s": round(pages / median_seconds, 2) if median_seconds else None,
+        "quality": {
+            "word_f1": round(word_f1(extracted_words, expected_words), 4),
+            "order_ratio": round(order_ratio(extracted_words, expected_words), 4),
+            "outline_recall": round(sum(f"Chapter {page}" in outline_titles for page in range(1, pages + 1)) / pages, 4),
+        },
+    })
+    return result
+
+
+async def run(engines: List[str], sizes: List[int], iterations: int) -> List[Dict[str, Any]]:
+    results = []
+    for pages in sizes:
+        for engine in engines:
+            result = await benchmark_engine(engine, pages, iterations)
+            if "error" in result:
+                progress(f"{engine:>10} {pages:>5}p  failed: {result['error']}")
+            else:
+                quality = result["quality"]
+                progress(
+                    f"{engine:>10} {pages:>5}p  p50 {result['latency_ms']['p50']:>9.2f} ms  "
+                    f"{result['pages_per_s'] or 0:>9.1f} pages/s  "
+                    f"F1 {quality['word_f1']:.3f}  order {quality['order_ratio']:.3f}  "
+                    f"outline {quality['outline_recall']:.2f}"
+                )
+            results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engines", default=",".join(server.PDF_ENGINES), help="Comma-separated PDF engines to compare")
+    parser.add_argument("--sizes", default="1,10,100", help="Comma-separated document sizes in pages")
+    parser.add_argument("--iterations", type=int, default=5, help="Timed runs per engine and size")
+    parser.add_argument("--output", help="JSON results file (printed to stdout when omitted)")
+    args = parser.parse_args()
+
+    engines = [name.strip() for name in args.engines.split(",") if name.strip()]
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    results = asyncio.run(run(engines, sizes, args.iterations))
+    write_results(args.output, "pdf_engines", results, LIBRARIES, {
+        "engines": engines,
+        "sizes": sizes,
+        "iterations": args.iterations,
+    })
+
+
+if __name__ == "__main__":
+    main()
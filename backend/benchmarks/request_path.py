@@ -0,0 +1,128 @@
+"""Time the read endpoints end to end inside the process, without a network hop.
+
+Seeds sessions and messages through the storage repositories, then sends requests to the
+FastAPI app over httpx's ASGI transport and reports latency percentiles per endpoint. With the
+in-memory storage backend (the default) no external services are needed, so the numbers cover
+only handler, serialization and search cost. --storage mongo runs the same requests against a
+scratch database at MONGO_URL, which is dropped at the end unless --keep is given.
+
+    cd backend
+    python -m benchmarks.request_path --sessions 100 --messages 200 --output results/request_path.json
+"""
+
+import argparse
+import asyncio
+import random
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+import httpx
+
+from benchmarks.common import latency_summary, progress, time_async, write_results
+from benchmarks.corpus import VOCABULARY
+
+import server
+
+LIBRARIES = ["fastapi", "httpx", "motor", "orjson"]
+
+
+async def seed(sessions: int, messages_per_session: int, rng: random.Random) -> List[str]:
+    base = datetime.utcnow() - timedelta(days=1)
+    session_ids = []
+    for number in range(sessions):
+        session = server.ChatSession(title=f"Benchmark session {number} {rng.choice(VOCABULARY)}",
+                                     updated_at=base + timedelta(seconds=number))
+        await server.storage.sessions.insert(session.dict())
+        messages = [
+            server.ChatMessage(
+                session_id=session.id,
+                content=" ".join(rng.choices(VOCABULARY, k=40)),
+                role="user" if index % 2 == 0 else "assistant",
+                timestamp=base + timedelta(seconds=number, milliseconds=index),
+            ).dict()
+            for index in range(messages_per_session)
+        ]
+        await server.storage.messages.insert_many(messages)
+        server.usage_rollup.record("sessions")
+        server.usage_rollup.record_messages(messages)
+        session_ids.append(session.id)
+    await server.usage_rollup.flush()
+    await server.sync_search_indexes()
+    return session_ids
+
+
+def endpoint_requests(session_id: str) -> Dict[str, Dict[str, Any]]:
+    return {
+        "GET /sessions": {"method": "GET", "url": "/api/sessions"},
+        "GET /sessions/summary": {"method": "GET", "url": "/api/sessions/summary?limit=50"},
+        "GET /sessions/{id}/messages/page": {"method": "GET", "url": f"/api/sessions/{session_id}/messages/page?limit=100"},
+        "GET /sessions/{id}/messages": {"method": "GET", "url": f"/api/sessions/{session_id}/messages"},
+        "POST /search": {"method": "POST", "url": "/api/search",
+                         "json": {"query": f"{VOCABULARY[0]} {VOCABULARY[1]}", "search_type": "all", "limit": 20}},
+        "POST /export": {"method": "POST", "url": "/api/export", "json": {"session_id": session_id, "export_format": "txt"}},
+        "GET /insights": {"method": "GET", "url": "/api/insights"},
+    }
+
+
+async def run(storage: str, sessions: int, messages_per_session: int, iterations: int,
+              keep: bool, database: str) -> List[Dict[str, Any]]:
+    server.storage = server.create_storage(storage)
+    if storage == "mongo":
+        server.db = server.client[database]
+        server.analytics_db = server.analytics_database(server.client, database)
+        await server.db.client.drop_database(database)
+        await server.ensure_indexes()
+
+    try:
+        session_ids = await seed(sessions, messages_per_session, random.Random(0))
+        results = []
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            for endpoint, request in endpoint_requests(session_ids[len(session_ids) // 2]).items():
+
+                async def send_once():
+                    response = await client.request(**request)
+                    response.raise_for_status()
+                    return response
+
+                body_bytes = len((await send_once()).content)
+                latencies = await time_async(send_once, iterations)
+                result = {
+                    "endpoint": endpoint,
+                    "storage": storage,
+                    "latency_ms": latency_summary(latencies),
+                    "body_bytes": body_bytes,
+                }
+                progress(
+                    f"{storage:>6}  {endpoint:<34} p50 {result['latency_ms']['p50']:>8.2f} ms  "
+                    f"p99 {result['latency_ms']['p99']:>8.2f} ms  {body_bytes:>9} bytes"
+                )
+                results.append(result)
+        return results
+    finally:
+        if storage == "mongo" and not keep:
+            await server.db.client.drop_database(database)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--storage", choices=["memory", "mongo"], default="memory", help="Storage backend to run against")
+    parser.add_argument("--sessions", type=int, default=100, help="Sessions to seed")
+    parser.add_argument("--messages", type=int, default=200, help="Messages per session")
+    parser.add_argument("--iterations", type=int, default=50, help="Timed requests per endpoint")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch database afterwards (--storage mongo)")
+    parser.add_argument("--database", default=f"{server.DB_NAME}_request_bench", help="Scratch database name")
+    parser.add_argument("--output", help="JSON results file (printed to stdout when omitted)")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args.storage, args.sessions, args.messages, args.iterations, args.keep, args.database))
+    write_results(args.output, "request_path", results, LIBRARIES, {
+        "storage": args.storage,
+        "sessions": args.sessions,
+        "messages_per_session": args.messages,
+        "iterations": args.iterations,
+    })
+
+
+if __name__ == "__main__":
+    main()
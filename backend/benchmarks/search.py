@@ -0,0 +1,167 @@
+"""Measure /search latency as the number of stored chat messages grows.
+
+Seeds a scratch database (<DB_NAME>_search_bench by default) with synthetic sessions and
+messages up to each size, lets the search index catch up through the same sync the server
+runs, and then times advanced_search() end to end: index lookup, hit fetch and the batched
+session-title lookup. Each size builds on the previous one, so 1k, 100k and 1M run in one
+pass. The scratch database is dropped at the end unless --keep is given.
+
+    cd backend
+    python -m benchmarks.search --sizes 1000,100000,1000000 --output results/search.json
+
+Requires a MongoDB reachable at MONGO_URL. --index-only skips Mongo and times only the
+in-process index lookup.
+"""
+
+import argparse
+import asyncio
+import itertools
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+from benchmarks.common import latency_summary, progress, time_async, write_results
+from benchmarks.corpus import VOCABULARY
+
+import server
+
+LIBRARIES = ["motor", "pymongo"]
+MESSAGES_PER_SESSION = 50
+WORDS_PER_MESSAGE = 25
+INSERT_BATCH = 10000
+
+# Word frequencies follow Zipf's law like natural text: the corpus vocabulary are the most
+# frequent words, followed by a long tail of synthetic ones
+WORDS = VOCABULARY + [f"term{rank}" for rank in range(len(VOCABULARY), 20000)]
+CUMULATIVE_WEIGHTS = list(itertools.accumulate(1 / rank for rank in range(1, len(WORDS) + 1)))
+
+QUERIES = {
+    "head_term": WORDS[0],             # In most messages
+    "mid_term": WORDS[200],            # In roughly 1 of 40 messages
+    "tail_term": WORDS[10000],         # In roughly 1 of 4000 messages
+    "two_terms": f"{WORDS[1]} {WORDS[150]}",
+    "phrase": f'"{WORDS[0]} {WORDS[1]}"',
+}
+
+
+def make_message(index: int, rng: random.Random, base: datetime) -> Dict[str, Any]:
+    words = rng.choices(WORDS, cum_weights=CUMULATIVE_WEIGHTS, k=WORDS_PER_MESSAGE)
+    return {
+        "id": f"bench-message-{index}",
+        "session_id": f"bench-session-{index // MESSAGES_PER_SESSION}",
+        "content": " ".join(words),
+        "role": "user" if index % 2 == 0 else "assistant",
+        "timestamp": base + timedelta(milliseconds=index),
+        "feature_type": "chat",
+    }
+
+
+async def seed(start: int, end: int, rng: random.Random, base: datetime, index_only: bool):
+    for batch_start in range(start, end, INSERT_BATCH):
+        batch_end = min(end, batch_start + INSERT_BATCH)
+        messages = [make_message(index, rng, base) for index in range(batch_start, batch_end)]
+        if index_only:
+            server.index_messages(messages, {
+                message["session_id"]: f"Benchmark session {message['session_id'].rsplit('-', 1)[1]}"
+                for message in messages
+            })
+            continue
+        first_session = batch_start // MESSAGES_PER_SESSION
+        last_session = (batch_end - 1) // MESSAGES_PER_SESSION
+        sessions = [
+            {"id": f"bench-session-{number}", "title": f"Benchmark session {number}",
+             "created_at": base, "updated_at": base}
+            for number in range(first_session, last_session + 1)
+            if number * MESSAGES_PER_SESSION >= batch_start
+        ]
+        if sessions:
+            await server.db.chat_sessions.insert_many(sessions, ordered=False)
+        await server.db.chat_messages.insert_many(messages, ordered=False)
+
+
+async def run(sizes: List[int], iterations: int, limit: int, index_only: bool, keep: bool, database: str) -> List[Dict[str, Any]]:
+    if not index_only:
+        server.db = server.client[database]
+        server.analytics_db = server.analytics_database(server.client, database)
+        await server.db.client.drop_database(database)
+        await server.ensure_indexes()
+
+    rng = random.Random(0)
+    base = datetime(2024, 1, 1)
+    results = []
+    seeded = 0
+    try:
+        for size in sorted(sizes):
+            seed_start = time.perf_counter()
+            await seed(seeded, size, rng, base, index_only)
+            seed_seconds = time.perf_counter() - seed_start
+            seeded = size
+
+            sync_start = time.perf_counter()
+            if not index_only:
+                await server.sync_search_indexes()
+            sync_seconds = time.perf_counter() - sync_start
+
+            for name, text in QUERIES.items():
+                if index_only:
+                    parsed = server.parse_search_query(text)
+
+                    async def search_once():
+                        return server.message_search_index.search(parsed, limit)
+
+                    hits = len(await search_once())
+                else:
+                    request = server.SearchRequest(query=text, search_type="conversations", limit=limit)
+
+                    async def search_once():
+                        return await server.advanced_search(request)
+
+                    hits = (await search_once())["total_results"]
+                latencies = await time_async(search_once, iterations)
+                result = {
+                    "messages": size,
+                    "query": name,
+                    "text": text,
+                    "results": hits,
+                    "latency_ms": latency_summary(latencies),
+                    "seed_seconds": round(seed_seconds, 2),
+                    "index_sync_seconds": round(sync_seconds, 2),
+                    "indexed_terms": server.message_search_index.stats()["terms"],
+                }
+                progress(
+                    f"{size:>9} msgs  {name:<10} p50 {result['latency_ms']['p50']:>9.2f} ms  "
+                    f"p99 {result['latency_ms']['p99']:>9.2f} ms  {hits:>3} results"
+                )
+                results.append(result)
+    finally:
+        if not index_only and not keep:
+            await server.db.client.drop_database(database)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,100000,1000000", help="Comma-separated message counts")
+    parser.add_argument("--iterations", type=int, default=20, help="Timed searches per query and size")
+    parser.add_argument("--limit", type=int, default=20, help="Search result limit, as sent by the frontend")
+    parser.add_argument("--index-only", action="store_true", help="Time only the in-process index, without MongoDB")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch database afterwards")
+    parser.add_argument("--database", default=f"{server.DB_NAME}_search_bench", help="Scratch database name")
+    parser.add_argument("--output", help="JSON results file (printed to stdout when omitted)")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    results = asyncio.run(run(sizes, args.iterations, args.limit, args.index_only, args.keep, args.database))
+    write_results(args.output, "search", results, LIBRARIES, {
+        "sizes": sizes,
+        "iterations": args.iterations,
+        "limit": args.limit,
+        "index_only": args.index_only,
+        "messages_per_session": MESSAGES_PER_SESSION,
+        "words_per_message": WORDS_PER_MESSAGE,
+    })
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Measure the CPU cost of turning stored documents into response bodies, per endpoint.
+
+For each list endpoint this times the old path, which validated every document into its model,
+ran FastAPI's response_model serialization and rendered with the standard json encoder, against
+the fast path the endpoints now take: trusted_rows() plus FastJSONResponse (orjson). Documents
+are synthetic and shaped like the stored ones, so no MongoDB is needed and only serialization is
+measured.
+
+    cd backend
+    python -m benchmarks.serialization --sizes 100,1000 --output results/serialization.json
+"""
+
+import argparse
+import asyncio
+import json
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+
+from benchmarks.common import latency_summary, progress, time_async, write_results
+from benchmarks.corpus import VOCABULARY
+
+import server
+
+LIBRARIES = ["fastapi", "pydantic", "orjson"]
+BASE_TIME = datetime(2024, 1, 1)
+
+
+def make_message(index: int) -> Dict[str, Any]:
+    words = [VOCABULARY[(index * 7 + offset) % len(VOCABULARY)] for offset in range(60)]
+    return {
+        "id": str(uuid.uuid4()),
+        "session_id": "bench-session",
+        "content": " ".join(words),
+        "role": "user" if index % 2 == 0 else "assistant",
+        "timestamp": BASE_TIME + timedelta(seconds=index),
+        "feature_type": "chat",
+    }
+
+
+def make_session(index: int) -> Dict[str, Any]:
+    return {
+        "id": str(uuid.uuid4()),
+        "title": f"Session {index}",
+        "created_at": BASE_TIME + timedelta(minutes=index),
+        "updated_at": BASE_TIME + timedelta(minutes=index, seconds=30),
+        "document_filename": f"document-{index}.pdf",
+        "document_type": "pdf",
+        "document_ids": [str(uuid.uuid4())],
+    }
+
+
+async def iterate(items):
+    for item in items:
+        yield item
+
+
+def response_field(path: str):
+    for route in server.api_router.routes:
+        if getattr(route, "path", None) == path and "GET" in route.methods:
+            return route.response_field
+    raise LookupError(path)
+
+
+async def validated_body(path: str, content: Any) -> bytes:
+    """The old path: FastAPI re-validates and encodes the returned models before rendering"""
+    encoded = await serialize_response(field=response_field(path), response_content=content)
+    return JSONResponse(encoded).body
+
+
+def endpoint_cases(size: int) -> Dict[str, Dict[str, Callable]]:
+    messages = [make_message(index) for index in range(size)]
+    sessions = [make_session(index) for index in range(size)]
+
+    async def sessions_old():
+        return await validated_body("/api/sessions", [server.ChatSession(**session) for session in sessions])
+
+    async def sessions_new():
+        return server.FastJSONResponse(server.trusted_rows(server.ChatSession, sessions)).body
+
+    async def summaries_old():
+        page = server.SessionPage(sessions=[server.SessionSummary(**session) for session in sessions])
+        return await validated_body("/api/sessions/summary", page)
+
+    async def summaries_new():
+        page = {"sessions": server.trusted_rows(server.SessionSummary, sessions), "next_cursor": None}
+        return server.FastJSONResponse(page).body
+
+    async def page_old():
+        page = server.MessagePage(messages=[server.ChatMessage(**message) for message in messages])
+        return await validated_body("/api/sessions/{session_id}/messages/page", page)
+
+    async def page_new():
+        page = {"messages": server.trusted_rows(server.ChatMessage, messages), "next_cursor": None}
+        return server.FastJSONResponse(page).body
+
+    async def stream_old():
+        return "".join(json.dumps(jsonable_encoder(server.ChatMessage(**message))) + "\n" for message in messages)
+
+    async def stream_new():
+        return b"".join([chunk async for chunk in server.stream_messages_ndjson(iterate(messages))])
+
+    return {
+        "GET /sessions": {"validated": sessions_old, "trusted": sessions_new},
+        "GET /sessions/summary": {"validated": summaries_old, "trusted": summaries_new},
+        "GET /sessions/{id}/messages/page": {"validated": page_old, "trusted": page_new},
+        "GET /sessions/{id}/messages/stream": {"validated": stream_old, "trusted": stream_new},
+    }
+
+
+async def run(sizes: List[int], iterations: int) -> List[Dict[str, Any]]:
+    results = []
+    for size in sizes:
+        for endpoint, paths in endpoint_cases(size).items():
+            timings = {}
+            for path, render in paths.items():
+                body = await render()
+                timings[path] = {
+                    "latency_ms": latency_summary(await time_async(render, iterations)),
+                    "body_bytes": len(body),
+                }
+            speedup = timings["validated"]["latency_ms"]["p50"] / max(timings["trusted"]["latency_ms"]["p50"], 1e-6)
+            progress(
+                f"{endpoint:<36} {size:>6}  validated p50 {timings['validated']['latency_ms']['p50']:>8.2f} ms  "
+                f"trusted p50 {timings['trusted']['latency_ms']['p50']:>8.2f} ms  x{speedup:.1f}"
+            )
+            results.append({"endpoint": endpoint, "items": size, **timings, "speedup_p50": round(speedup, 2)})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="100,1000", help="Comma-separated item counts per response")
+    parser.add_argument("--iterations", type=int, default=20, help="Timed renders per endpoint, path and size")
+    parser.add_argument("--output", help="JSON results file (printed to stdout when omitted)")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    results = asyncio.run(run(sizes, args.iterations))
+    write_results(args.output, "serialization", results, LIBRARIES, {
+        "sizes": sizes,
+        "iterations": args.iterations,
+    })
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Measure the cost of importing server.py: wall time, peak RSS and which heavy libraries load.
+
+Each sample runs in a fresh interpreter so nothing is cached between runs. Compare two
+revisions by running this on each and diffing the JSON output.
+
+    cd backend
+    python -m benchmarks.startup --runs 5 --output results/startup.json
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+from typing import Any, Dict, List
+
+from benchmarks.common import BACKEND_DIR, latency_summary, progress, write_results
+
+HEAVY_MODULES = ["PyPDF2", "openpyxl", "pandas", "docx", "pptx", "psutil", "pkg_resources", "reportlab"]
+
+PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+import server
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    "import_ms": elapsed * 1000,
+    "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "loaded": [name for name in %r if name in sys.modules],
+}))
+""" % (HEAVY_MODULES,)
+
+
+def sample() -> Dict[str, Any]:
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE],
+        cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters to sample")
+    parser.add_argument("--output", help="JSON results file (printed to stdout when omitted)")
+    args = parser.parse_args()
+    
+    samples: List[Dict[str, Any]] = [sample() for _ in range(args.runs)]
+    rss_mb = [entry["max_rss_kb"] / 1024 for entry in samples]
+    result = {
+        "import_ms": latency_summary([entry["import_ms"] for entry in samples]),
+        "max_rss_mb": {"min": round(min(rss_mb), 1), "max": round(max(rss_mb), 1)},
+        "heavy_modules_loaded": samples[-1]["loaded"],
+    }
+    progress(f"import p50 {result['import_ms']['p50']:.0f} ms, peak RSS {result['max_rss_mb']['max']} MB, "
+             f"heavy modules loaded: {', '.join(result['heavy_modules_loaded']) or 'none'}")
+    write_results(args.output, "startup", [result], ["fastapi", "motor", "pydantic"], {"runs": args.runs})
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,71 @@
-from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException, Query
+from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException, Query, Request, BackgroundTasks
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase, AsyncIOMotorGridFSBucket
+from gridfs.errors import NoFile
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
 import os
+import socket
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple, Iterable
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 import io
-import PyPDF2
 import httpx
 import json
 from emergentintegrations.llm.chat import LlmChat, UserMessage
-import psutil
 import subprocess
 import sys
-import pkg_resources
 from typing import Union
 import asyncio
 import time
 import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, OrderedDict
+from array import array
+import bisect
+import heapq
+import math
 
 # Document processing imports
-import openpyxl
-import pandas as pd
-from docx import Document as DocxDocument
-from pptx import Presentation
+# Parser libraries (PyPDF2, python-docx, openpyxl, python-pptx) are imported by each
+# registered extractor on first use, so workers start without paying for them.
 import csv
 import mimetypes
+import re
+import unicodedata
+from urllib.parse import quote
+import hashlib
+import base64
+import zlib
+import bson
+import codecs
+import importlib.metadata
+import importlib.util
+from abc import ABC, abstractmethod
+from functools import lru_cache, partial
+from typing import NamedTuple
+try:
+    import zstandard
+except ImportError:  # zstd compression is optional; zlib is always available
+    zstandard = None
+try:
+    import orjson
+except ImportError:  # Responses fall back to the standard json encoder
+    orjson = None
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+    from python_multipart.exceptions import MultipartParseError
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+    from multipart.exceptions import MultipartParseError
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -39,6 +73,92 @@ load_dotenv(ROOT_DIR / '.env')
 # Environment configuration with defaults for local development
 MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
 DB_NAME = os.environ.get('DB_NAME', 'chatpdf_database')
+# Connection pool: per-server connection bounds, how long a request waits for a free connection
+# (0 waits indefinitely), and wire compressors in order of preference
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', '100'))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', '0'))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', '5000'))
+MONGO_COMPRESSORS = os.environ.get('MONGO_COMPRESSORS', 'zstd,zlib')
+# Read routing for insights, search and exports: primary, primaryPreferred, secondary,
+# secondaryPreferred or nearest; secondaries are only used when a replica set has them
+MONGO_ANALYTICS_READ_PREFERENCE = os.environ.get('MONGO_ANALYTICS_READ_PREFERENCE', 'secondaryPreferred')
+MONGO_ANALYTICS_MAX_STALENESS_SECONDS = int(os.environ.get('MONGO_ANALYTICS_MAX_STALENESS_SECONDS', '0'))  # 0: no limit, else >= 90
+# Storage backend: 'mongo', or 'memory' to keep sessions, messages and documents in the process
+# (benchmarks and in-process tests; nothing survives a restart)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'mongo').lower()
+if STORAGE_BACKEND not in ('mongo', 'memory'):
+    STORAGE_BACKEND = 'mongo'
+
+# Extraction cache configuration
+EXTRACTION_CACHE_ENABLED = os.environ.get('EXTRACTION_CACHE_ENABLED', 'true').lower() == 'true'
+EXTRACTION_CACHE_DIR = Path(os.environ.get('EXTRACTION_CACHE_DIR', str(ROOT_DIR / '.extraction_cache')))
+EXTRACTION_CACHE_MAX_BYTES = int(os.environ.get('EXTRACTION_CACHE_MAX_MB', '512')) * 1024 * 1024
+
+# Upload and extraction limits
+EXTRACTION_WORKERS = int(os.environ.get('EXTRACTION_WORKERS', str(min(4, os.cpu_count() or 1))))
+BATCH_UPLOAD_MAX_FILES = int(os.environ.get('BATCH_UPLOAD_MAX_FILES', '50'))
+UPLOAD_MAX_FILE_BYTES = int(os.environ.get('UPLOAD_MAX_FILE_MB', '50')) * 1024 * 1024
+
+# Session cache: hot sessions are served from memory for up to the TTL; other workers see writes after it expires
+SESSION_CACHE_MAX_ENTRIES = int(os.environ.get('SESSION_CACHE_MAX_ENTRIES', '1000'))
+SESSION_CACHE_TTL_SECONDS = float(os.environ.get('SESSION_CACHE_TTL_SECONDS', '30'))
+
+# Number of previous messages sent to the model as conversation context
+CHAT_HISTORY_MESSAGES = int(os.environ.get('CHAT_HISTORY_MESSAGES', '10'))
+
+# Chat write path: 'sync' (written before responding), 'background' (written after the response is sent)
+# or 'write_behind' (queued in memory and flushed in batches; see ChatWriteQueue for what can be lost)
+CHAT_WRITE_MODE = os.environ.get('CHAT_WRITE_MODE', 'sync').lower()
+if CHAT_WRITE_MODE not in ('sync', 'background', 'write_behind'):
+    CHAT_WRITE_MODE = 'sync'
+CHAT_WRITE_BATCH_SIZE = int(os.environ.get('CHAT_WRITE_BATCH_SIZE', '500'))
+CHAT_WRITE_FLUSH_INTERVAL = int(os.environ.get('CHAT_WRITE_FLUSH_INTERVAL_MS', '200')) / 1000
+CHAT_WRITE_QUEUE_MAX = int(os.environ.get('CHAT_WRITE_QUEUE_MAX', '5000'))
+
+# Full-text search: how often each worker picks up documents and messages written by other workers
+SEARCH_INDEX_POLL_SECONDS = float(os.environ.get('SEARCH_INDEX_POLL_SECONDS', '5'))
+# Ranking: weight of filename/session-title matches relative to body matches, and the age at which
+# the recency bonus halves
+SEARCH_TITLE_BOOST = float(os.environ.get('SEARCH_TITLE_BOOST', '2.0'))
+SEARCH_RECENCY_HALF_LIFE_DAYS = float(os.environ.get('SEARCH_RECENCY_HALF_LIFE_DAYS', '30'))
+# Each worker keeps its own copy of the index in memory; a warning is logged once an index's
+# estimated size passes this many MB (0 disables the warning)
+SEARCH_INDEX_WARN_MB = float(os.environ.get('SEARCH_INDEX_WARN_MB', '512'))
+
+# Usage rollups for /insights: how often each worker adds its counters to Mongo, and how often
+# finished days are compacted and the totals recounted from the collections
+USAGE_FLUSH_SECONDS = float(os.environ.get('USAGE_FLUSH_SECONDS', '5'))
+USAGE_RECONCILE_SECONDS = float(os.environ.get('USAGE_RECONCILE_SECONDS', '3600'))
+
+# Retention: sessions inactive for SESSION_RETENTION_DAYS and messages older than MESSAGE_RETENTION_DAYS
+# expire through TTL indexes (0 keeps them forever). Documents no session references are removed by a
+# rate-limited background GC once they are older than the grace period.
+SESSION_RETENTION_DAYS = float(os.environ.get('SESSION_RETENTION_DAYS', '0'))
+MESSAGE_RETENTION_DAYS = float(os.environ.get('MESSAGE_RETENTION_DAYS', '0'))
+DOCUMENT_GC_GRACE_HOURS = float(os.environ.get('DOCUMENT_GC_GRACE_HOURS', '24'))
+RETENTION_GC_INTERVAL_SECONDS = float(os.environ.get('RETENTION_GC_INTERVAL_SECONDS', '600'))
+RETENTION_GC_BATCH_SIZE = int(os.environ.get('RETENTION_GC_BATCH_SIZE', '200'))
+RETENTION_GC_MAX_DELETES_PER_SECOND = float(os.environ.get('RETENTION_GC_MAX_DELETES_PER_SECOND', '20'))
+
+# Cold message archive: messages older than MESSAGE_ARCHIVE_AFTER_DAYS, or beyond the newest
+# MESSAGE_ARCHIVE_KEEP_RECENT of their session, move into compressed blocks (0 disables a rule)
+MESSAGE_ARCHIVE_AFTER_DAYS = float(os.environ.get('MESSAGE_ARCHIVE_AFTER_DAYS', '30'))
+MESSAGE_ARCHIVE_KEEP_RECENT = int(os.environ.get('MESSAGE_ARCHIVE_KEEP_RECENT', '500'))
+MESSAGE_ARCHIVE_BLOCK_SIZE = int(os.environ.get('MESSAGE_ARCHIVE_BLOCK_SIZE', '500'))
+MESSAGE_ARCHIVE_INTERVAL_SECONDS = float(os.environ.get('MESSAGE_ARCHIVE_INTERVAL_SECONDS', '3600'))
+
+# PDF extraction engine: 'auto' (pypdfium2 when installed), 'pypdfium2' or 'pypdf2'
+PDF_EXTRACTION_ENGINE = os.environ.get('PDF_EXTRACTION_ENGINE', 'auto').lower()
+
+# Document text storage configuration
+DOCUMENT_TEXT_CODEC = os.environ.get('DOCUMENT_TEXT_CODEC', 'zlib')  # 'zlib' or 'zstd'
+DOCUMENT_CACHE_MAX_CHARS = int(os.environ.get('DOCUMENT_CACHE_MAX_MB', '128')) * 1024 * 1024
+DOCUMENT_STORAGE_MIGRATION = os.environ.get('DOCUMENT_STORAGE_MIGRATION', 'true').lower() == 'true'
+# Compressed text above this size goes to GridFS instead of the document record
+DOCUMENT_INLINE_TEXT_MAX_BYTES = int(os.environ.get('DOCUMENT_INLINE_TEXT_MAX_KB', '1024')) * 1024
+STORE_ORIGINAL_FILES = os.environ.get('STORE_ORIGINAL_FILES', 'true').lower() == 'true'
+ORIGINALS_BUCKET = "document_originals"
+TEXT_BUCKET = "document_text"
 
 # Configure logging
 logging.basicConfig(
@@ -160,14 +280,184 @@ if not OPENROUTER_API_KEYS and not GEMINI_API_KEYS:
     raise ValueError("At least one AI provider API key is required (OPENROUTER_API_KEY or GEMINI_API_KEY)")
 
 # MongoDB connection
-client = AsyncIOMotorClient(MONGO_URL)
+class MongoPoolMonitor(monitoring.ConnectionPoolListener):
+    """Connection pool counters per server, reported as pool saturation by the health endpoints"""
+    
+    def __init__(self, max_pool_size: int):
+        self.max_pool_size = max_pool_size
+        self._servers: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()  # Events arrive from the driver's threads
+    
+    def _server(self, event) -> Dict[str, Any]:
+        address = "%s:%s" % event.address
+        server = self._servers.get(address)
+        if server is None:
+            server = self._servers[address] = {
+                "open": 0, "in_use": 0, "waiting": 0, "peak_in_use": 0, "peak_waiting": 0,
+                "checkouts": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0, "checkout_failures": {}, "clears": 0
+            }
+        return server
+    
+    def pool_created(self, event):
+        pass
+    
+    def pool_ready(self, event):
+        pass
+    
+    def pool_cleared(self, event):
+        with self._lock:
+            self._server(event)["clears"] += 1
+    
+    def pool_closed(self, event):
+        pass
+    
+    def connection_created(self, event):
+        with self._lock:
+            self._server(event)["open"] += 1
+    
+    def connection_ready(self, event):
+        pass
+    
+    def connection_closed(self, event):
+        with self._lock:
+            self._server(event)["open"] -= 1
+    
+    def connection_check_out_started(self, event):
+        with self._lock:
+            server = self._server(event)
+            server["waiting"] += 1
+            server["peak_waiting"] = max(server["peak_waiting"], server["waiting"])
+    
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            server = self._server(event)
+            server["waiting"] -= 1
+            server["checkout_failures"][event.reason] = server["checkout_failures"].get(event.reason, 0) + 1
+    
+    def connection_checked_out(self, event):
+        wait_ms = (getattr(event, "duration", None) or 0) * 1000
+        with self._lock:
+            server = self._server(event)
+            server["waiting"] -= 1
+            server["in_use"] += 1
+            server["peak_in_use"] = max(server["peak_in_use"], server["in_use"])
+            server["checkouts"] += 1
+            server["wait_ms_total"] += wait_ms
+            server["wait_ms_max"] = max(server["wait_ms_max"], wait_ms)
+    
+    def connection_checked_in(self, event):
+        with self._lock:
+            self._server(event)["in_use"] -= 1
+    
+    def saturation(self) -> float:
+        """Highest share of the pool in use on any server"""
+        with self._lock:
+            busiest = max((server["in_use"] for server in self._servers.values()), default=0)
+        return busiest / self.max_pool_size if self.max_pool_size else 0.0
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            servers = {
+                address: {
+                    **{key: value for key, value in server.items() if key != "wait_ms_total"},
+                    "checkout_failures": dict(server["checkout_failures"]),
+                    "saturation": round(server["in_use"] / self.max_pool_size, 3) if self.max_pool_size else None,
+                    "wait_ms_avg": round(server["wait_ms_total"] / server["checkouts"], 3) if server["checkouts"] else 0.0,
+                    "wait_ms_max": round(server["wait_ms_max"], 3)
+                }
+                for address, server in self._servers.items()
+            }
+        return {
+            "max_pool_size": self.max_pool_size,
+            "min_pool_size": MONGO_MIN_POOL_SIZE,
+            "wait_queue_timeout_ms": MONGO_WAIT_QUEUE_TIMEOUT_MS or None,
+            "compressors": mongo_compressors(),
+            "analytics_read_preference": analytics_read_preference().mongos_mode,
+            "servers": servers
+        }
+
+mongo_pool_monitor = MongoPoolMonitor(MONGO_MAX_POOL_SIZE)
+
+ANALYTICS_READ_MODES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+def mongo_compressors() -> List[str]:
+    """Configured compressors whose libraries are installed; zlib is built in"""
+    modules = {"zstd": "zstandard", "snappy": "snappy", "zlib": None}
+    return [
+        name for name in (part.strip() for part in MONGO_COMPRESSORS.split(","))
+        if name in modules and (modules[name] is None or importlib.util.find_spec(modules[name]) is not None)
+    ]
+
+def analytics_read_preference():
+    mode = ANALYTICS_READ_MODES.get(MONGO_ANALYTICS_READ_PREFERENCE, SecondaryPreferred)
+    if mode is Primary:
+        return Primary()
+    return mode(max_staleness=MONGO_ANALYTICS_MAX_STALENESS_SECONDS or -1)
+
+def create_mongo_client() -> AsyncIOMotorClient:
+    """Motor client with the configured pool bounds, wire compression and pool monitoring"""
+    options: Dict[str, Any] = {
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "event_listeners": [mongo_pool_monitor],
+        "appname": "chatpdf-backend"
+    }
+    if MONGO_WAIT_QUEUE_TIMEOUT_MS > 0:
+        options["waitQueueTimeoutMS"] = MONGO_WAIT_QUEUE_TIMEOUT_MS
+    compressors = mongo_compressors()
+    if compressors:
+        options["compressors"] = compressors
+    return AsyncIOMotorClient(MONGO_URL, **options)
+
+def analytics_database(mongo_client: AsyncIOMotorClient, name: str = DB_NAME) -> AsyncIOMotorDatabase:
+    """Handle for read-only insights, search and export queries, kept off the primary when possible"""
+    return mongo_client.get_database(name, read_preference=analytics_read_preference())
+
+client = create_mongo_client()
 db = client[DB_NAME]
+analytics_db = analytics_database(client)
 
 # OpenRouter API configuration
 OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
 
+# JSON responses
+# Every response is rendered with orjson. Endpoints that return a FastJSONResponse themselves skip
+# FastAPI's response_model pass (dump, re-validate, jsonable_encoder), so list endpoints hand it
+# documents shaped by trusted_row instead of models: building models costs more than encoding them,
+# and model_construct is no cheaper than validation with pydantic 2.
+def _orjson_default(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    return jsonable_encoder(value)
+
+def dump_json(content: Any) -> bytes:
+    if orjson is None:
+        return json.dumps(jsonable_encoder(content), separators=(",", ":")).encode("utf-8")
+    return orjson.dumps(content, default=_orjson_default, option=orjson.OPT_NON_STR_KEYS)
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dump_json(content)
+
+def trusted_row(model, document: Dict[str, Any]) -> Dict[str, Any]:
+    """A stored document as `model` would serialize it: its fields only, with defaults filled in.
+    Values are not validated, so use it only for documents the server wrote through that model"""
+    return {
+        name: document[name] if name in document else (None if field.is_required() else field.get_default(call_default_factory=True))
+        for name, field in model.model_fields.items()
+    }
+
+def trusted_rows(model, documents) -> List[Dict[str, Any]]:
+    return [trusted_row(model, document) for document in documents]
+
 # Create the main app
-app = FastAPI(title="Baloch AI chat PdF & GPT API", version="2.0.0")
+app = FastAPI(title="Baloch AI chat PdF & GPT API", version="2.0.0", default_response_class=FastJSONResponse)
 api_router = APIRouter(prefix="/api")
 
 # AI Functions
@@ -322,11 +612,32 @@ async def startup_event():
     if GEMINI_API_KEYS:
         for i, key in enumerate(GEMINI_API_KEYS, 1):
             logger.info(f"   Gemini Key {i}: ...{key[-10:]}")
+    if EXTRACTION_CACHE_ENABLED:
+        parsers = list(EXTRACTOR_REGISTRY.values()) + [get_pdf_parser(engine) for engine in PDF_ENGINES]
+        current_versions = {parser.name: get_extractor_version(parser) for parser in parsers}
+        removed = await asyncio.to_thread(extraction_cache.prune_stale_versions, current_versions)
+        logger.info(f"🗃️  Extraction cache: {EXTRACTION_CACHE_DIR} ({removed} stale entries removed)")
+    asyncio.create_task(run_search_index_sync())
+    if CHAT_WRITE_MODE == "write_behind":
+        chat_write_queue.start()
+    usage_rollup.start()
+    if storage.backend == "mongo":
+        asyncio.create_task(run_ensure_indexes())
+        asyncio.create_task(run_usage_compaction())
+        retention_gc.start()
+        asyncio.create_task(run_message_archiver())
+        if DOCUMENT_STORAGE_MIGRATION:
+            asyncio.create_task(run_document_storage_migration())
+    else:
+        logger.info("🧪 In-memory storage: data is not persisted and MongoDB maintenance jobs are off")
     logger.info("✅ Baloch AI chat PdF & GPT Backend ready!")
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
     logger.info("🛑 Shutting down Baloch AI chat PdF & GPT Backend...")
+    await chat_write_queue.stop()
+    await usage_rollup.stop()
+    retention_gc.stop()
     client.close()
     logger.info("✅ Database connection closed")
 
@@ -397,7 +708,8 @@ async def detailed_health_check():
             "active_sessions": metrics.active_sessions,
             "total_api_calls": metrics.total_api_calls,
             "error_rate": metrics.error_rate
-        }
+        },
+        "mongo_pool": mongo_pool_monitor.stats()
     }
     
     return {
@@ -544,10 +856,11 @@ async def apply_auto_fix(issue: HealthIssue) -> dict:
     elif issue.category == "database":
         # Database reconnection attempt
         try:
-            global client, db
+            global client, db, analytics_db
             client.close()
-            client = AsyncIOMotorClient(MONGO_URL)
+            client = create_mongo_client()
             db = client[DB_NAME]
+            analytics_db = analytics_database(client)
             
             # Test connection
             await client.admin.command('ping')
@@ -578,9 +891,52 @@ async def get_health_metrics():
     return {
         "current_metrics": get_system_metrics(),
         "history": health_monitor_data.get("metrics_history", [])[-50:],  # Last 50 data points
+        "extraction_cache": await asyncio.to_thread(extraction_cache.stats),
+        "document_text_cache": document_text_cache.stats(),
+        "session_cache": session_cache.stats(),
+        "chat_writes": chat_write_queue.stats(),
+        "usage_rollup": usage_rollup.stats(),
+        "retention_gc": retention_gc.stats(),
+        "mongo_pool": mongo_pool_monitor.stats(),
+        "message_archive": message_archive_status,
+        "search_index": {"documents": document_search_index.stats(), "messages": message_search_index.stats()},
         "uptime": (datetime.utcnow() - health_monitor_data["start_time"]).total_seconds()
     }
 
+# Check that endpoint queries are served by indexes
+@api_router.get("/system-health/indexes")
+async def get_index_health():
+    """Report index provisioning status and the explain() plan of each endpoint query"""
+    if storage.backend != "mongo":
+        raise HTTPException(status_code=501, detail="Index reports need MongoDB storage")
+    queries = await explain_indexed_queries()
+    return {
+        "provisioning": index_status,
+        "queries": queries,
+        "all_indexed": all(query.get("uses_index") for query in queries)
+    }
+
+# Retention settings and garbage collection
+@api_router.get("/system-health/retention")
+async def get_retention_status():
+    """Report retention settings and what the GC has reclaimed"""
+    return {
+        "session_retention_days": SESSION_RETENTION_DAYS or None,
+        "message_retention_days": MESSAGE_RETENTION_DAYS or None,
+        "document_gc_grace_hours": DOCUMENT_GC_GRACE_HOURS,
+        "gc": retention_gc.stats()
+    }
+
+@api_router.post("/system-health/retention/gc")
+async def run_retention_gc():
+    """Run one GC pass now instead of waiting for the next interval"""
+    if storage.backend != "mongo":
+        raise HTTPException(status_code=501, detail="Retention GC needs MongoDB storage")
+    summary = await retention_gc.run_pass()
+    if summary is None:
+        raise HTTPException(status_code=409, detail="Another worker is running the retention GC")
+    return summary
+
 # Middleware to track API calls and response times
 @app.middleware("http")
 async def track_api_metrics(request, call_next):
@@ -633,20 +989,49 @@ class ChatSession(BaseModel):
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
     document_filename: Optional[str] = None  # Changed from pdf_filename
-    document_content: Optional[str] = None   # Changed from pdf_content
     document_type: Optional[str] = None      # New field to store document type
+    # Document text and outline live only in the documents collection; sessions reference them
+    document_ids: List[str] = []
+    document_batch_id: Optional[str] = None
     
     # Keep old fields for backward compatibility
     pdf_filename: Optional[str] = None
-    pdf_content: Optional[str] = None
+
+class SessionSummary(BaseModel):
+    """Sidebar view of a session: no outline, document references or legacy content"""
+    id: str
+    title: str
+    created_at: datetime
+    updated_at: datetime
+    document_filename: Optional[str] = None
+    document_type: Optional[str] = None
+    pdf_filename: Optional[str] = None
+
+class SessionPage(BaseModel):
+    sessions: List[SessionSummary]
+    next_cursor: Optional[str] = None  # Pass back as ?cursor= to get the next page; None on the last page
+
+class MessagePage(BaseModel):
+    messages: List[ChatMessage]
+    next_cursor: Optional[str] = None  # Pass back as ?cursor= to get the next page; None on the last page
 
 class Document(BaseModel):  # Renamed from PDFDocument
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     filename: str
-    content: str
+    # Extracted text is stored compressed; see compress_text/load_document_text
+    content_compressed: bytes = b""
+    content_codec: str = "zlib"
+    content_length: int = 0
+    content_file_id: Optional[str] = None   # GridFS id when the compressed text is too large to inline
+    original_file_id: Optional[str] = None  # GridFS id of the uploaded file, kept for re-extraction
+    file_sha256: Optional[str] = None
     upload_date: datetime = Field(default_factory=datetime.utcnow)
     file_size: int
     file_type: str = "pdf"  # New field to store document type
+    outline: List[Dict[str, Any]] = []  # Chapter index with character offsets into content
+    batch_id: Optional[str] = None  # Set when uploaded through the batch endpoint
+    text_updated_at: Optional[datetime] = None  # Changes whenever the stored text does
+    ref_count: int = 0  # Sessions referencing this document; kept exact by the retention GC
 
 class SendMessageRequest(BaseModel):
     session_id: str
@@ -739,6 +1124,8 @@ health_monitor_data = {
 # Health Monitoring Functions
 async def check_database_health() -> tuple[bool, str]:
     """Check MongoDB connection health"""
+    if storage.backend == "memory":
+        return True, "In-memory storage (STORAGE_BACKEND=memory)"
     try:
         # Try to ping the database
         await client.admin.command('ping')
@@ -808,15 +1195,15 @@ async def check_dependencies() -> tuple[bool, str, list]:
         'fastapi', 'uvicorn', 'motor', 'pymongo', 'httpx', 'PyPDF2',
         'anthropic', 'emergentintegrations', 'psutil', 'reportlab',
         'python-docx', 'python-dotenv', 'pydantic', 'openpyxl', 
-        'pandas', 'python-pptx', 'lxml'
+        'python-pptx', 'lxml'
     ]
     
     missing_packages = []
     
     for package in required_packages:
         try:
-            pkg_resources.get_distribution(package)
-        except pkg_resources.DistributionNotFound:
+            importlib.metadata.distribution(package)
+        except importlib.metadata.PackageNotFoundError:
             missing_packages.append(package)
     
     if missing_packages:
@@ -827,6 +1214,7 @@ async def check_dependencies() -> tuple[bool, str, list]:
 def get_system_metrics() -> HealthMetrics:
     """Get current system performance metrics"""
     try:
+        import psutil
         cpu_usage = psutil.cpu_percent()
         memory = psutil.virtual_memory()
         disk = psutil.disk_usage('/')
@@ -908,7 +1296,7 @@ async def perform_comprehensive_health_check() -> SystemHealthStatus:
     
     # Calculate active sessions
     try:
-        metrics.active_sessions = await db.chat_sessions.count_documents({})
+        metrics.active_sessions = await storage.sessions.count()
     except:
         metrics.active_sessions = 0
     
@@ -1061,10 +1449,11 @@ async def apply_auto_fix(issue: HealthIssue) -> dict:
     elif issue.category == "database":
         # Database reconnection attempt
         try:
-            global client, db
+            global client, db, analytics_db
             client.close()
-            client = AsyncIOMotorClient(MONGO_URL)
+            client = create_mongo_client()
             db = client[DB_NAME]
+            analytics_db = analytics_database(client)
             
             # Test connection
             await client.admin.command('ping')
@@ -1101,6 +1490,8 @@ health_monitor_data = {
 # Health Monitoring Functions
 async def check_database_health() -> tuple[bool, str]:
     """Check MongoDB connection health"""
+    if storage.backend == "memory":
+        return True, "In-memory storage (STORAGE_BACKEND=memory)"
     try:
         # Try to ping the database
         await client.admin.command('ping')
@@ -1170,15 +1561,15 @@ async def check_dependencies() -> tuple[bool, str, list]:
         'fastapi', 'uvicorn', 'motor', 'pymongo', 'httpx', 'PyPDF2',
         'anthropic', 'emergentintegrations', 'psutil', 'reportlab',
         'python-docx', 'python-dotenv', 'pydantic', 'openpyxl', 
-        'pandas', 'python-pptx', 'lxml'
+        'python-pptx', 'lxml'
     ]
     
     missing_packages = []
     
     for package in required_packages:
         try:
-            pkg_resources.get_distribution(package)
-        except pkg_resources.DistributionNotFound:
+            importlib.metadata.distribution(package)
+        except importlib.metadata.PackageNotFoundError:
             missing_packages.append(package)
     
     if missing_packages:
@@ -1189,6 +1580,7 @@ async def check_dependencies() -> tuple[bool, str, list]:
 def get_system_metrics() -> HealthMetrics:
     """Get current system performance metrics"""
     try:
+        import psutil
         cpu_usage = psutil.cpu_percent()
         memory = psutil.virtual_memory()
         disk = psutil.disk_usage('/')
@@ -1254,6 +1646,19 @@ async def analyze_performance_issues(metrics: HealthMetrics) -> List[HealthIssue
             severity=4 if metrics.error_rate > 25 else 3
         ))
     
+    # Requests queueing for Mongo connections
+    pool_saturation = mongo_pool_monitor.saturation()
+    if pool_saturation > 0.8:
+        issues.append(HealthIssue(
+            issue_type="performance",
+            category="database",
+            title="Mongo Connection Pool Saturated",
+            description=f"{pool_saturation * 100:.0f}% of the {MONGO_MAX_POOL_SIZE}-connection pool is in use",
+            suggested_fix="Raise MONGO_MAX_POOL_SIZE or route more reads to secondaries",
+            auto_fixable=False,
+            severity=3 if pool_saturation >= 1 else 2
+        ))
+    
     return issues
 
 async def perform_comprehensive_health_check() -> SystemHealthStatus:
@@ -1270,7 +1675,7 @@ async def perform_comprehensive_health_check() -> SystemHealthStatus:
     
     # Calculate active sessions
     try:
-        metrics.active_sessions = await db.chat_sessions.count_documents({})
+        metrics.active_sessions = await storage.sessions.count()
     except:
         metrics.active_sessions = 0
     
@@ -1358,271 +1763,3457 @@ async def perform_comprehensive_health_check() -> SystemHealthStatus:
         uptime=uptime
     )
 
+# Document Outline Functions
+# Outline entries are {"title", "level", "start", "end"} where start/end are
+# character offsets into the extracted text, so a chapter is a plain slice.
+OUTLINE_KEYWORD_HEADING = re.compile(r'^(chapter|part|unit|lesson|appendix|section)\b', re.IGNORECASE)
+OUTLINE_NUMBERED_HEADING = re.compile(r'^(\d+(?:\.\d+){0,3})\.?\s+[A-Z]')
+OUTLINE_MAX_HEADING_LENGTH = 100
+
+def _text_heading_level(line: str) -> Optional[int]:
+    """Guess whether a plain-text line is a heading and return its level"""
+    if not line or len(line) > OUTLINE_MAX_HEADING_LENGTH:
+        return None
+    keyword = OUTLINE_KEYWORD_HEADING.match(line)
+    if keyword:
+        return 2 if keyword.group(1).lower() == 'section' else 1
+    numbered = OUTLINE_NUMBERED_HEADING.match(line)
+    if numbered and len(line) <= 80:
+        return numbered.group(1).count('.') + 1
+    if line.isupper() and 4 <= len(line) <= 60 and sum(c.isalpha() for c in line) >= 4:
+        return 1
+    return None
+
+def _finalize_outline(entries: List[Dict[str, Any]], text_length: int) -> List[Dict[str, Any]]:
+    """Sort outline entries and close each one at the next heading of the same or higher level"""
+    entries = sorted(
+        (entry for entry in entries if 0 <= entry["start"] <= text_length),
+        key=lambda entry: entry["start"]
+    )
+    open_entries = []
+    for entry in entries:
+        while open_entries and open_entries[-1]["level"] >= entry["level"]:
+            open_entries.pop()["end"] = entry["start"]
+        open_entries.append(entry)
+    for entry in open_entries:
+        entry["end"] = text_length
+    return entries
+
+def _strip_with_outline(text: str, outline: List[Dict[str, Any]]) -> Tuple[str, List[Dict[str, Any]]]:
+    """Strip surrounding whitespace from text and shift outline offsets to match"""
+    stripped = text.strip()
+    shift = len(text) - len(text.lstrip())
+    for entry in outline:
+        entry["start"] = min(max(entry["start"] - shift, 0), len(stripped))
+    return stripped, _finalize_outline(outline, len(stripped))
+
+def build_text_outline(text: str) -> List[Dict[str, Any]]:
+    """Build an outline for plain text using a heading heuristic"""
+    entries = []
+    offset = 0
+    for line in text.split('\n'):
+        heading = line.strip()
+        level = _text_heading_level(heading)
+        if level is not None:
+            entries.append({"title": heading, "level": level, "start": offset})
+        offset += len(line) + 1
+    return _finalize_outline(entries, len(text))
+
+def find_outline_section(outline: List[Dict[str, Any]], chapter_segment: str) -> Optional[Dict[str, Any]]:
+    """Find the outline entry matching a chapter name (exact title first, then substring)"""
+    needle = chapter_segment.strip().lower()
+    if not needle:
+        return None
+    
+    partial_match = None
+    for entry in outline:
+        title = entry["title"].lower()
+        if title == needle:
+            return entry
+        if partial_match is None and needle in title:
+            partial_match = entry
+    return partial_match
+
 # Document Processing Functions
-async def extract_text_from_pdf(file_content: bytes) -> str:
-    """Extract text from PDF files"""
-    try:
-        pdf_file = io.BytesIO(file_content)
-        pdf_reader = PyPDF2.PdfReader(pdf_file)
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text() + "\n"
-        return text.strip()
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error processing PDF: {str(e)}")
+# Each parser returns (text, outline) so the chapter index is built in the same pass.
+# Parsers are registered by extension and import their library on first use.
+class DocumentParser(NamedTuple):
+    name: str            # Extractor name used in cache keys
+    parse: Any           # Callable[[bytes], Tuple[str, outline]]
+    label: str           # Label used in error messages
+    revision: str        # Bump when the parser's output changes
+    distribution: Optional[str] = None  # Library whose version also versions the output
 
-async def extract_text_from_docx(file_content: bytes) -> str:
-    """Extract text from DOCX files"""
+EXTRACTOR_REGISTRY: Dict[str, DocumentParser] = {}
+
+def register_extractor(*extensions: str, name: str, label: str, revision: str, distribution: Optional[str] = None):
+    """Register a parser for one or more file extensions"""
+    def decorator(parse):
+        parser = DocumentParser(name, parse, label, revision, distribution)
+        for extension in extensions:
+            EXTRACTOR_REGISTRY[extension] = parser
+        return parse
+    return decorator
+
+# PDF engines only turn bytes into page texts and bookmarks; outline assembly is shared.
+# Bookmarks are (title, level, page index) with level 1 for top-level entries.
+class PdfEngine(NamedTuple):
+    name: str
+    extract: Any         # Callable[[bytes], Tuple[List[str], List[Tuple[str, int, int]]]]
+    distribution: str    # Library the engine needs, also used to version its output
+
+PDF_ENGINES: Dict[str, PdfEngine] = {}
+PDF_FALLBACK_ENGINE = "pypdf2"
+
+def register_pdf_engine(name: str, distribution: str):
+    """Register a PDF text extraction engine"""
+    def decorator(extract):
+        PDF_ENGINES[name] = PdfEngine(name, extract, distribution)
+        return extract
+    return decorator
+
+def _collect_pdf_bookmarks(reader, nodes, level: int, bookmarks: List[Tuple[str, int, int]]):
+    for node in nodes:
+        if isinstance(node, list):
+            _collect_pdf_bookmarks(reader, node, level + 1, bookmarks)
+            continue
+        page_index = reader.get_destination_page_number(node)
+        if page_index is not None:
+            bookmarks.append((str(node.title).strip(), level, page_index))
+
+@register_pdf_engine("pypdf2", distribution="PyPDF2")
+def _extract_pdf_pypdf2(file_content: bytes) -> Tuple[List[str], List[Tuple[str, int, int]]]:
+    import PyPDF2
+    
+    pdf_reader = PyPDF2.PdfReader(io.BytesIO(file_content))
+    page_texts = [page.extract_text() or "" for page in pdf_reader.pages]
+    bookmarks = []
     try:
-        doc_file = io.BytesIO(file_content)
-        doc = DocxDocument(doc_file)
-        text = ""
-        for paragraph in doc.paragraphs:
-            text += paragraph.text + "\n"
-        return text.strip()
+        _collect_pdf_bookmarks(pdf_reader, pdf_reader.outline, 1, bookmarks)
     except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error processing DOCX: {str(e)}")
+        logger.warning(f"Could not read PDF bookmarks: {e}")
+        bookmarks = []
+    return page_texts, bookmarks
 
-async def extract_text_from_xlsx(file_content: bytes) -> str:
-    """Extract text from XLSX files"""
+@register_pdf_engine("pypdfium2", distribution="pypdfium2")
+def _extract_pdf_pypdfium2(file_content: bytes) -> Tuple[List[str], List[Tuple[str, int, int]]]:
+    import pypdfium2
+    
+    pdf = pypdfium2.PdfDocument(file_content)
     try:
-        excel_file = io.BytesIO(file_content)
-        workbook = openpyxl.load_workbook(excel_file)
-        text = ""
+        page_texts = []
+        for page_index in range(len(pdf)):
+            page = pdf[page_index]
+            text_page = page.get_textpage()
+            page_texts.append(text_page.get_text_range().replace("\r\n", "\n"))
+            text_page.close()
+            page.close()
         
-        for sheet_name in workbook.sheetnames:
-            sheet = workbook[sheet_name]
-            text += f"Sheet: {sheet_name}\n"
-            
-            for row in sheet.iter_rows(values_only=True):
-                row_text = []
-                for cell in row:
-                    if cell is not None:
-                        row_text.append(str(cell))
-                if row_text:
-                    text += " | ".join(row_text) + "\n"
-            text += "\n"
+        bookmarks = []
+        try:
+            for bookmark in pdf.get_toc():
+                dest = bookmark.get_dest()
+                page_index = dest.get_index() if dest is not None else None
+                if page_index is not None:
+                    bookmarks.append(((bookmark.get_title() or "").strip(), bookmark.level + 1, page_index))
+        except Exception as e:
+            logger.warning(f"Could not read PDF bookmarks: {e}")
+            bookmarks = []
+        return page_texts, bookmarks
+    finally:
+        pdf.close()
+
+def _assemble_pdf(page_texts: List[str], bookmarks: List[Tuple[str, int, int]]) -> Tuple[str, List[Dict[str, Any]]]:
+    """Join page texts and turn bookmarks into outline entries"""
+    parts = []
+    page_offsets = []
+    offset = 0
+    for page_text in page_texts:
+        page_offsets.append(offset)
+        page_text = page_text + "\n"
+        parts.append(page_text)
+        offset += len(page_text)
+    text = "".join(parts)
+    
+    outline = [
+        {"title": title, "level": level, "start": page_offsets[page_index], "page": page_index + 1}
+        for title, level, page_index in bookmarks
+        if 0 <= page_index < len(page_offsets)
+    ]
+    if outline:
+        # Move each bookmark from the top of its page to the heading itself when it can be found
+        page_ends = page_offsets[1:] + [len(text)]
+        for entry in outline:
+            heading_offset = text.find(entry["title"], entry["start"], page_ends[entry["page"] - 1])
+            if heading_offset != -1:
+                entry["start"] = heading_offset
+        return _strip_with_outline(text, outline)
+    
+    text = text.strip()
+    return text, build_text_outline(text)
+
+def resolve_pdf_engine(requested: Optional[str] = None) -> str:
+    """Name of the PDF engine to use for a request, falling back to the configured default"""
+    name = (requested or PDF_EXTRACTION_ENGINE).lower()
+    if name == "auto":
+        return "pypdfium2" if importlib.util.find_spec("pypdfium2") is not None else PDF_FALLBACK_ENGINE
+    if name not in PDF_ENGINES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown PDF engine: {name}. Available engines: auto, {', '.join(PDF_ENGINES.keys())}"
+        )
+    return name
+
+def _parse_pdf(file_content: bytes, engine: str = PDF_FALLBACK_ENGINE) -> Tuple[str, List[Dict[str, Any]]]:
+    """Extract a PDF with the given engine; extract_document retries failures with PyPDF2"""
+    page_texts, bookmarks = PDF_ENGINES[engine].extract(file_content)
+    return _assemble_pdf(page_texts, bookmarks)
+
+@lru_cache(maxsize=None)
+def get_pdf_parser(engine: str) -> DocumentParser:
+    """Document parser for one PDF engine; each engine gets its own extraction cache namespace"""
+    return DocumentParser(
+        f"pdf-{engine}", partial(_parse_pdf, engine=engine), "PDF", "2", PDF_ENGINES[engine].distribution
+    )
+
+if PDF_EXTRACTION_ENGINE != "auto" and PDF_EXTRACTION_ENGINE not in PDF_ENGINES:
+    logger.warning(
+        f"Unknown PDF_EXTRACTION_ENGINE '{PDF_EXTRACTION_ENGINE}'; using auto. "
+        f"Available engines: auto, {', '.join(PDF_ENGINES.keys())}"
+    )
+    PDF_EXTRACTION_ENGINE = "auto"
+
+EXTRACTOR_REGISTRY["pdf"] = get_pdf_parser(resolve_pdf_engine())
+
+def _docx_heading_level(style_name: str) -> Optional[int]:
+    if style_name == "Title":
+        return 0
+    if style_name.startswith("Heading"):
+        level = style_name[len("Heading"):].strip()
+        return int(level) if level.isdigit() else 1
+    return None
+
+@register_extractor("docx", name="docx", label="DOCX", revision="1", distribution="python-docx")
+def _parse_docx(file_content: bytes) -> Tuple[str, List[Dict[str, Any]]]:
+    from docx import Document as DocxDocument
+    
+    doc = DocxDocument(io.BytesIO(file_content))
+    parts = []
+    outline = []
+    offset = 0
+    for paragraph in doc.paragraphs:
+        style_name = paragraph.style.name if paragraph.style is not None else ""
+        level = _docx_heading_level(style_name or "")
+        if level is not None and paragraph.text.strip():
+            outline.append({"title": paragraph.text.strip(), "level": level, "start": offset})
+        line = paragraph.text + "\n"
+        parts.append(line)
+        offset += len(line)
+    return _strip_with_outline("".join(parts), outline)
+
+@register_extractor("xlsx", "xls", name="xlsx", label="XLSX", revision="1", distribution="openpyxl")
+def _parse_xlsx(file_content: bytes) -> Tuple[str, List[Dict[str, Any]]]:
+    import openpyxl
+    
+    workbook = openpyxl.load_workbook(io.BytesIO(file_content))
+    parts = []
+    outline = []
+    offset = 0
+    
+    for sheet_name in workbook.sheetnames:
+        sheet = workbook[sheet_name]
+        outline.append({"title": sheet_name, "level": 1, "start": offset})
+        lines = [f"Sheet: {sheet_name}\n"]
         
-        return text.strip()
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error processing XLSX: {str(e)}")
+        for row in sheet.iter_rows(values_only=True):
+            row_text = [str(cell) for cell in row if cell is not None]
+            if row_text:
+                lines.append(" | ".join(row_text) + "\n")
+        lines.append("\n")
+        
+        sheet_text = "".join(lines)
+        parts.append(sheet_text)
+        offset += len(sheet_text)
+    
+    return _strip_with_outline("".join(parts), outline)
 
-async def extract_text_from_csv(file_content: bytes) -> str:
-    """Extract text from CSV files"""
+@register_extractor("csv", name="csv", label="CSV", revision="1")
+def _parse_csv(file_content: bytes) -> Tuple[str, List[Dict[str, Any]]]:
+    reader = csv.reader(io.StringIO(file_content.decode('utf-8')))
+    text = "".join(" | ".join(row) + "\n" for row in reader)
+    return text.strip(), []
+
+@register_extractor("txt", name="txt", label="TXT", revision="1")
+def _parse_txt(file_content: bytes) -> Tuple[str, List[Dict[str, Any]]]:
     try:
-        csv_file = io.StringIO(file_content.decode('utf-8'))
-        reader = csv.reader(csv_file)
-        text = ""
+        text = file_content.decode('utf-8').strip()
+    except UnicodeDecodeError:
+        text = file_content.decode('latin-1').strip()
+    return text, build_text_outline(text)
+
+@register_extractor("pptx", name="pptx", label="PPTX", revision="1", distribution="python-pptx")
+def _parse_pptx(file_content: bytes) -> Tuple[str, List[Dict[str, Any]]]:
+    from pptx import Presentation
+    
+    presentation = Presentation(io.BytesIO(file_content))
+    parts = []
+    outline = []
+    offset = 0
+    
+    for slide_num, slide in enumerate(presentation.slides, 1):
+        title_shape = slide.shapes.title
+        slide_title = title_shape.text.strip() if title_shape is not None and title_shape.has_text_frame else ""
+        outline.append({
+            "title": f"Slide {slide_num}: {slide_title}" if slide_title else f"Slide {slide_num}",
+            "level": 1,
+            "start": offset
+        })
         
-        for row in reader:
-            text += " | ".join(row) + "\n"
+        lines = [f"Slide {slide_num}:\n"]
+        for shape in slide.shapes:
+            if hasattr(shape, "text"):
+                lines.append(shape.text + "\n")
+        lines.append("\n")
         
-        return text.strip()
+        slide_text = "".join(lines)
+        parts.append(slide_text)
+        offset += len(slide_text)
+    
+    return _strip_with_outline("".join(parts), outline)
+
+@lru_cache(maxsize=None)
+def get_extractor_version(parser: DocumentParser) -> str:
+    """Version string of an extractor: its revision plus the installed library version"""
+    if not parser.distribution:
+        return f"r{parser.revision}"
+    try:
+        library_version = importlib.metadata.version(parser.distribution)
+    except importlib.metadata.PackageNotFoundError:
+        library_version = "unknown"
+    return f"r{parser.revision}-{parser.distribution}-{library_version}"
+
+def _run_parser(parser: DocumentParser, file_content: bytes) -> Tuple[str, List[Dict[str, Any]]]:
+    """Run a document parser, turning parser failures into HTTP 400 errors"""
+    try:
+        return parser.parse(file_content)
     except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error processing CSV: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Error processing {parser.label}: {str(e)}")
+
+async def extract_text_from_pdf(file_content: bytes) -> str:
+    """Extract text from PDF files"""
+    return _run_parser(EXTRACTOR_REGISTRY['pdf'], file_content)[0]
+
+async def extract_text_from_docx(file_content: bytes) -> str:
+    """Extract text from DOCX files"""
+    return _run_parser(EXTRACTOR_REGISTRY['docx'], file_content)[0]
+
+async def extract_text_from_xlsx(file_content: bytes) -> str:
+    """Extract text from XLSX files"""
+    return _run_parser(EXTRACTOR_REGISTRY['xlsx'], file_content)[0]
+
+async def extract_text_from_csv(file_content: bytes) -> str:
+    """Extract text from CSV files"""
+    return _run_parser(EXTRACTOR_REGISTRY['csv'], file_content)[0]
 
 async def extract_text_from_txt(file_content: bytes) -> str:
     """Extract text from TXT files"""
-    try:
-        return file_content.decode('utf-8').strip()
-    except UnicodeDecodeError:
-        try:
-            return file_content.decode('latin-1').strip()
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Error processing TXT: {str(e)}")
+    return _run_parser(EXTRACTOR_REGISTRY['txt'], file_content)[0]
 
 async def extract_text_from_pptx(file_content: bytes) -> str:
     """Extract text from PPTX files"""
-    try:
-        ppt_file = io.BytesIO(file_content)
-        presentation = Presentation(ppt_file)
-        text = ""
+    return _run_parser(EXTRACTOR_REGISTRY['pptx'], file_content)[0]
+
+# Parsing is CPU-bound, so it runs on a bounded worker pool instead of the event loop
+extraction_executor = ThreadPoolExecutor(max_workers=EXTRACTION_WORKERS, thread_name_prefix="extraction")
+
+async def run_parser_in_worker(parser: DocumentParser, file_content: bytes) -> Tuple[str, List[Dict[str, Any]]]:
+    """Run a document parser on the extraction worker pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(extraction_executor, _run_parser, parser, file_content)
+
+# Extraction Cache
+class ExtractionCache:
+    """Disk-backed cache of extraction results with size-bounded LRU eviction.
+    
+    Entries are stored as <root>/<extractor>/<version>/<file sha256>.json, so bumping one
+    extractor's version only invalidates that extractor's entries. Recency is tracked with
+    file mtimes, which keeps the LRU order shared between workers using the same directory.
+    """
+    
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._total_bytes: Optional[int] = None
+        self._lock = threading.Lock()
+    
+    def _entry_path(self, extractor: str, version: str, file_hash: str) -> Path:
+        return self.root / extractor / version / f"{file_hash}.json"
+    
+    def _entries(self) -> List[Path]:
+        return list(self.root.glob("*/*/*.json")) if self.root.exists() else []
+    
+    def _ensure_size_known(self):
+        if self._total_bytes is None:
+            self._total_bytes = sum(path.stat().st_size for path in self._entries())
+    
+    def get(self, extractor: str, version: str, file_hash: str) -> Optional[Dict[str, Any]]:
+        path = self._entry_path(extractor, version, file_hash)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            os.utime(path)  # Mark as recently used
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+    
+    def put(self, extractor: str, version: str, file_hash: str, text: str, outline: List[Dict[str, Any]]):
+        path = self._entry_path(extractor, version, file_hash)
+        payload = json.dumps({
+            "extractor": extractor,
+            "version": version,
+            "text": text,
+            "outline": outline,
+            "created_at": datetime.utcnow().isoformat()
+        })
+        with self._lock:
+            self._ensure_size_known()  # Scan before writing so the new entry is not counted by the scan too
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                replaced_bytes = path.stat().st_size  # Overwritten entries must not be counted twice
+            except OSError:
+                replaced_bytes = 0
+            tmp_path = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not write extraction cache entry {path}: {e}")
+            return
         
-        for slide_num, slide in enumerate(presentation.slides, 1):
-            text += f"Slide {slide_num}:\n"
-            
-            for shape in slide.shapes:
-                if hasattr(shape, "text"):
-                    text += shape.text + "\n"
-            text += "\n"
+        with self._lock:
+            self._ensure_size_known()
+            self._total_bytes += len(payload.encode('utf-8')) - replaced_bytes
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+    
+    def _evict(self):
+        """Delete least recently used entries until the cache is back under 90% of its budget"""
+        entries = []
+        for path in self._entries():
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
         
-        return text.strip()
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error processing PPTX: {str(e)}")
+        total = sum(size for _, size, _ in entries)
+        target = int(self.max_bytes * 0.9)
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+        self._total_bytes = total
+    
+    def prune_stale_versions(self, current_versions: Dict[str, str]) -> int:
+        """Remove entries written by older versions of the given extractors, and by extractors no longer registered"""
+        removed = 0
+        extractor_dirs = [path for path in self.root.iterdir() if path.is_dir()] if self.root.is_dir() else []
+        for extractor_dir in extractor_dirs:
+            version = current_versions.get(extractor_dir.name)
+            for version_dir in extractor_dir.iterdir():
+                if version_dir.name == version or not version_dir.is_dir():
+                    continue
+                for path in version_dir.glob("*.json"):
+                    try:
+                        path.unlink()
+                        removed += 1
+                    except OSError:
+                        pass
+                try:
+                    version_dir.rmdir()
+                except OSError:
+                    pass
+            if version is None:
+                try:
+                    extractor_dir.rmdir()
+                except OSError:
+                    pass
+        with self._lock:
+            self._total_bytes = None
+        return removed
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._ensure_size_known()
+            total_bytes = self._total_bytes
+        lookups = self.hits + self.misses
+        return {
+            "enabled": EXTRACTION_CACHE_ENABLED,
+            "directory": str(self.root),
+            "size_bytes": total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups * 100) if lookups else 0,
+            "evictions": self.evictions
+        }
 
-async def extract_text_from_document(file_content: bytes, filename: str) -> str:
-    """Extract text from various document formats"""
+extraction_cache = ExtractionCache(EXTRACTION_CACHE_DIR, EXTRACTION_CACHE_MAX_BYTES)
+
+async def extract_document(file_content: bytes, filename: str, pdf_engine: Optional[str] = None) -> Tuple[str, List[Dict[str, Any]]]:
+    """Extract text and chapter outline from various document formats, consulting the extraction cache first"""
     file_extension = filename.lower().split('.')[-1]
     
-    extractors = {
-        'pdf': extract_text_from_pdf,
-        'docx': extract_text_from_docx,
-        'xlsx': extract_text_from_xlsx,
-        'xls': extract_text_from_xlsx,  # Using same function for now
-        'csv': extract_text_from_csv,
-        'txt': extract_text_from_txt,
-        'pptx': extract_text_from_pptx,
-    }
-    
-    if file_extension in extractors:
-        return await extractors[file_extension](file_content)
-    else:
+    if file_extension not in EXTRACTOR_REGISTRY:
         raise HTTPException(
             status_code=400, 
-            detail=f"Unsupported file format: {file_extension}. Supported formats: {', '.join(extractors.keys())}"
+            detail=f"Unsupported file format: {file_extension}. Supported formats: {', '.join(EXTRACTOR_REGISTRY.keys())}"
         )
+    
+    parser = EXTRACTOR_REGISTRY[file_extension]
+    if file_extension == "pdf" and pdf_engine:
+        parser = get_pdf_parser(resolve_pdf_engine(pdf_engine))
+    
+    try:
+        return await extract_with_parser(parser, file_content)
+    except HTTPException as e:
+        fallback = get_pdf_parser(PDF_FALLBACK_ENGINE)
+        if file_extension != "pdf" or parser == fallback:
+            raise
+        # Retried under the fallback parser's own cache namespace, so its output is never cached as the faster engine's
+        logger.warning(f"PDF parser {parser.name} failed ({e.detail}); falling back to {fallback.name}")
+        return await extract_with_parser(fallback, file_content)
+
+async def extract_with_parser(parser: DocumentParser, file_content: bytes) -> Tuple[str, List[Dict[str, Any]]]:
+    """Run one parser through the extraction cache"""
+    if not EXTRACTION_CACHE_ENABLED:
+        return await run_parser_in_worker(parser, file_content)
+    
+    version = get_extractor_version(parser)
+    file_hash = hashlib.sha256(file_content).hexdigest()
+    
+    cached = await asyncio.to_thread(extraction_cache.get, parser.name, version, file_hash)
+    if cached is not None:
+        return cached["text"], cached["outline"]
+    
+    text, outline = await run_parser_in_worker(parser, file_content)
+    await asyncio.to_thread(extraction_cache.put, parser.name, version, file_hash, text, outline)
+    return text, outline
+
+async def extract_text_from_document(file_content: bytes, filename: str) -> str:
+    """Extract text from various document formats"""
+    text, _ = await extract_document(file_content, filename)
+    return text
 
 def get_supported_file_types() -> List[str]:
-    """Return list of supported file types"""
-    return ['pdf', 'docx', 'xlsx', 'xls', 'csv', 'txt', 'pptx']
+    """Return list of supported file types, as registered by the extractors"""
+    return list(EXTRACTOR_REGISTRY.keys())
 
 def is_supported_file_type(filename: str) -> bool:
     """Check if file type is supported"""
     file_extension = filename.lower().split('.')[-1]
     return file_extension in get_supported_file_types()
 
-# API Routes
-@api_router.post("/sessions", response_model=ChatSession)
-async def create_session(request: CreateSessionRequest):
-    session = ChatSession(
-        title=request.title
-    )
-    await db.chat_sessions.insert_one(session.dict())
-    return session
+async def get_session_outline(session: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Return the outline of a session's document(s), read from the document records rather than the session"""
+    document_ids = session.get("document_ids") or []
+    if not document_ids:
+        return build_text_outline(await load_session_document_text(session))
+    if session.get("document_batch_id"):
+        _, outline = await load_batch_document(session)
+        return outline
+    
+    record = await storage.documents.get(document_ids[0], ("outline",))
+    if record is None:
+        return []
+    if "outline" not in record:
+        # Documents stored before outlines existed get theirs built once
+        record["outline"] = build_text_outline(await load_document_text(document_ids[0]) or "")
+        await storage.documents.update(document_ids[0], {"outline": record["outline"]})
+    return record["outline"]
 
-@api_router.get("/sessions", response_model=List[ChatSession])
-async def get_sessions():
-    sessions = await db.chat_sessions.find().sort("updated_at", -1).to_list(100)
-    return [ChatSession(**session) for session in sessions]
+# Document Storage Functions
+def compress_bytes(data: bytes, codec: str = DOCUMENT_TEXT_CODEC) -> Tuple[bytes, str]:
+    """Compress data, falling back to zlib when zstandard is not installed"""
+    if codec == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(level=3).compress(data), 'zstd'
+    return zlib.compress(data, 6), 'zlib'
 
-@api_router.get("/supported-formats")
-async def get_supported_formats():
-    """Get list of supported document formats"""
-    return {
-        "supported_formats": get_supported_file_types(),
-        "message": "Supported document formats for upload"
+def decompress_bytes(data: bytes, codec: str) -> bytes:
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Data is zstd-compressed but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+def compress_text(text: str, codec: str = DOCUMENT_TEXT_CODEC) -> Tuple[bytes, str]:
+    """Compress document text with compress_bytes"""
+    return compress_bytes(text.encode('utf-8'), codec)
+
+def decompress_text(data: bytes, codec: str) -> str:
+    return decompress_bytes(data, codec).decode('utf-8')
+
+class DocumentTextCache:
+    """LRU cache of decompressed document text, bounded by total characters"""
+    
+    def __init__(self, max_chars: int):
+        self.max_chars = max_chars
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._chars = 0
+    
+    def get(self, key: str) -> Optional[str]:
+        text = self._entries.get(key)
+        if text is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return text
+    
+    def put(self, key: str, text: str):
+        if len(text) > self.max_chars:
+            return
+        self.discard(key)
+        self._entries[key] = text
+        self._chars += len(text)
+        while self._chars > self.max_chars:
+            _, evicted = self._entries.popitem(last=False)
+            self._chars -= len(evicted)
+    
+    def discard(self, key: str):
+        text = self._entries.pop(key, None)
+        if text is not None:
+            self._chars -= len(text)
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "chars": self._chars,
+            "max_chars": self.max_chars,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups * 100) if lookups else 0
+        }
+
+document_text_cache = DocumentTextCache(DOCUMENT_CACHE_MAX_CHARS)
+
+def gridfs_bucket(bucket_name: str) -> AsyncIOMotorGridFSBucket:
+    # Built per call so buckets follow the current client after a database reconnect
+    return AsyncIOMotorGridFSBucket(db, bucket_name=bucket_name)
+
+async def read_blob_text(file_id: str, codec: str) -> str:
+    """Stream compressed text out of the text blob store, decompressing and decoding chunk by chunk"""
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Document is zstd-compressed but zstandard is not installed")
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+    else:
+        decompressor = zlib.decompressobj()
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    
+    parts = []
+    async for chunk in storage.documents.iter_blob(TEXT_BUCKET, file_id):
+        parts.append(decoder.decode(decompressor.decompress(chunk)))
+    parts.append(decoder.decode(decompressor.flush(), final=True))
+    return "".join(parts)
+
+async def store_document_text(document_id: str, text: str) -> Dict[str, Any]:
+    """Compress text and store it inline or, when oversized, in GridFS; returns the document fields to set"""
+    compressed, codec = await asyncio.to_thread(compress_text, text)
+    now = datetime.utcnow()
+    fields = {
+        "content_codec": codec,
+        "content_length": len(text),
+        "content_compressed": compressed,
+        "content_file_id": None,
+        # Millisecond precision, as Mongo stores it, so the search index sees the same version everywhere
+        "text_updated_at": now.replace(microsecond=now.microsecond // 1000 * 1000)
     }
+    if len(compressed) > DOCUMENT_INLINE_TEXT_MAX_BYTES:
+        file_id = f"{document_id}:{uuid.uuid4().hex}"
+        await storage.documents.put_blob(
+            TEXT_BUCKET,
+            file_id,
+            f"{document_id}.txt.{codec}",
+            compressed,
+            metadata={"document_id": document_id, "codec": codec, "content_length": len(text)}
+        )
+        fields["content_compressed"] = b""
+        fields["content_file_id"] = file_id
+    return fields
 
-@api_router.post("/sessions/{session_id}/upload-document")
-async def upload_document(session_id: str, file: UploadFile = File(...)):
-    # Verify session exists
-    session = await db.chat_sessions.find_one({"id": session_id})
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
-    
-    # Validate file type
-    if not is_supported_file_type(file.filename):
-        supported_types = ", ".join(get_supported_file_types())
-        raise HTTPException(
-            status_code=400, 
-            detail=f"Unsupported file type. Supported formats: {supported_types}"
+async def save_document(filename: str, text: str, file_size: int, file_type: str,
+                        outline: List[Dict[str, Any]], batch_id: Optional[str] = None,
+                        original: Optional[bytes] = None) -> Document:
+    """Store extracted text once, compressed, plus the original upload in GridFS"""
+    document_id = str(uuid.uuid4())
+    text_fields = await store_document_text(document_id, text)
+    
+    original_fields = {}
+    if original is not None and STORE_ORIGINAL_FILES:
+        original_fields = {
+            "original_file_id": f"{document_id}:original",
+            "file_sha256": hashlib.sha256(original).hexdigest()
+        }
+        await storage.documents.put_blob(
+            ORIGINALS_BUCKET,
+            original_fields["original_file_id"],
+            filename,
+            original,
+            metadata={"document_id": document_id, "file_type": file_type, "sha256": original_fields["file_sha256"]}
         )
     
-    # Read and process document
-    file_content = await file.read()
-    document_text = await extract_text_from_document(file_content, file.filename)
-    
-    # Get file type
-    file_type = file.filename.lower().split('.')[-1]
-    
-    # Save document
     document = Document(
-        filename=file.filename,
-        content=document_text,
-        file_size=len(file_content),
-        file_type=file_type
+        id=document_id,
+        filename=filename,
+        file_size=file_size,
+        file_type=file_type,
+        outline=outline,
+        batch_id=batch_id,
+        **text_fields,
+        **original_fields
     )
-    await db.documents.insert_one(document.dict())
-    
-    # Update session with document info (both new and old fields for compatibility)
-    await db.chat_sessions.update_one(
-        {"id": session_id},
-        {
-            "$set": {
-                "document_filename": file.filename,
-                "document_content": document_text,
-                "document_type": file_type,
-                # Keep old fields for backward compatibility
-                "pdf_filename": file.filename,
-                "pdf_content": document_text,
-                "updated_at": datetime.utcnow()
-            }
-        }
+    await storage.documents.insert(document.dict())
+    usage_rollup.record("documents", at=document.upload_date)
+    document_text_cache.put(document.id, text)
+    await asyncio.to_thread(
+        document_search_index.add, document.id, text, document.text_updated_at,
+        title=filename, updated_at=document.text_updated_at
     )
-    
-    return {
-        "message": "Document uploaded successfully",
-        "filename": file.filename,
-        "file_type": file_type,
-        "content_length": len(document_text)
-    }
+    return document
 
-# Keep the old PDF upload endpoint for backward compatibility
-@api_router.post("/sessions/{session_id}/upload-pdf")
-async def upload_pdf(session_id: str, file: UploadFile = File(...)):
-    # Verify session exists
-    session = await db.chat_sessions.find_one({"id": session_id})
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
+async def load_document_text(document_id: str) -> Optional[str]:
+    """Load a document's text, decompressing it on first use and caching the result"""
+    text = document_text_cache.get(document_id)
+    if text is not None:
+        return text
+    
+    record = await storage.documents.get(
+        document_id, ("content_compressed", "content_codec", "content_file_id", "content")
+    )
+    if not record:
+        return None
+    codec = record.get("content_codec", "zlib")
+    if record.get("content_file_id"):
+        text = await read_blob_text(record["content_file_id"], codec)
+    elif record.get("content_compressed") is not None:
+        text = await asyncio.to_thread(decompress_text, record["content_compressed"], codec)
+    else:
+        text = record.get("content") or ""  # Written before compressed storage
+    document_text_cache.put(document_id, text)
+    return text
+
+async def replace_document_text(document_id: str, text: str, outline: List[Dict[str, Any]]):
+    """Swap in newly extracted text and outline for a document; sessions read both through the reference"""
+    record = await storage.documents.get(document_id, ("content_file_id", "batch_id", "filename"))
+    fields = await store_document_text(document_id, text)
+    fields["outline"] = outline
+    await storage.documents.update(document_id, fields)
+    
+    if record and record.get("content_file_id"):
+        try:
+            await storage.documents.delete_blob(TEXT_BUCKET, record["content_file_id"])
+        except Exception as e:
+            logger.warning(f"Could not delete old text blob {record['content_file_id']}: {e}")
     
-    # Validate file type
-    if not file.filename.lower().endswith('.pdf'):
-        raise HTTPException(status_code=400, detail="Only PDF files are allowed")
+    document_text_cache.put(document_id, text)
+    await asyncio.to_thread(
+        document_search_index.add, document_id, text, fields["text_updated_at"],
+        title=(record or {}).get("filename", ""), updated_at=fields["text_updated_at"]
+    )
     
-    # Read and process PDF
-    file_content = await file.read()
-    pdf_text = await extract_text_from_pdf(file_content)
+    # Batch sessions rebuild their combined text and outline on next use
+    if record and record.get("batch_id"):
+        document_text_cache.discard(f"batch:{record['batch_id']}")
+
+async def session_has_document(session: Dict[str, Any]) -> bool:
+    if session.get("document_ids"):
+        return True
+    if not session.get("has_legacy_text", True):
+        return False
+    return bool(await storage.sessions.legacy_document_text(session["id"]))
+
+async def load_session_document_text(session: Dict[str, Any]) -> str:
+    """Return the text of a session's document(s), whether referenced or stored inline by older versions"""
+    document_ids = session.get("document_ids") or []
+    if not document_ids:
+        if not session.get("has_legacy_text", True):
+            return ""
+        # Sessions the storage migration has not reached yet still hold their text inline
+        return await storage.sessions.legacy_document_text(session["id"]) or ""
+    
+    batch_id = session.get("document_batch_id")
+    if not batch_id:
+        return await load_document_text(document_ids[0]) or ""
+    
+    combined = document_text_cache.get(f"batch:{batch_id}")
+    if combined is not None:
+        return combined
+    combined, _ = await load_batch_document(session)
+    return combined
+
+async def load_batch_document(session: Dict[str, Any]) -> Tuple[str, List[Dict[str, Any]]]:
+    """Combine the text and outlines of a batch session's documents, caching the combined text"""
+    document_ids = session["document_ids"]
+    records = await storage.documents.find_many(document_ids, ("filename", "outline"))
+    parts = []
+    for document_id in document_ids:
+        text = await load_document_text(document_id)
+        if text is not None and document_id in records:
+            parts.append((records[document_id]["filename"], text, records[document_id].get("outline") or []))
+    combined, outline = combine_batch_documents(parts)
+    document_text_cache.put(f"batch:{session['document_batch_id']}", combined)
+    return combined, outline
+
+# Job Leases
+# Jobs that must not run on two workers at once take a lease: a document in job_leases naming the
+# holder and an expiry. A holder that dies stops renewing, so its lease lapses on its own.
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+class JobLease:
+    """Exclusive claim on a named job, renewed while the job runs"""
     
-    # Save PDF document
-    pdf_doc = Document(
-        filename=file.filename,
-        content=pdf_text,
-        file_size=len(file_content),
-        file_type="pdf"
-    )
-    await db.documents.insert_one(pdf_doc.dict())
+    def __init__(self, name: str, seconds: float):
+        self.name = name
+        self.seconds = seconds
+        self._renew_at = 0.0
     
-    # Update session with PDF info
-    await db.chat_sessions.update_one(
-        {"id": session_id},
-        {
-            "$set": {
-                "document_filename": file.filename,
-                "document_content": pdf_text,
-                "document_type": "pdf",
-                "pdf_filename": file.filename,
-                "pdf_content": pdf_text,
-                "updated_at": datetime.utcnow()
+    async def acquire(self) -> bool:
+        now = datetime.utcnow()
+        try:
+            lease = await db.job_leases.find_one_and_update(
+                {"_id": self.name, "$or": [{"owner": WORKER_ID}, {"expires_at": {"$lte": now}}]},
+                {"$set": {"owner": WORKER_ID, "expires_at": now + timedelta(seconds=self.seconds)}},
+                upsert=True, return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            return False  # Another worker holds an unexpired lease
+        self._renew_at = time.monotonic() + self.seconds / 2
+        return lease is not None
+    
+    async def renew(self) -> bool:
+        """Extend the lease once half of it has run out; False if another worker has taken it over"""
+        if time.monotonic() < self._renew_at:
+            return True
+        return await self.acquire()
+    
+    async def release(self):
+        await db.job_leases.delete_one({"_id": self.name, "owner": WORKER_ID})
+
+async def migrate_document_storage() -> Dict[str, int]:
+    """Backfill compressed single-copy storage for documents and sessions written by older versions"""
+    migrated = {"documents": 0, "sessions": 0}
+    
+    # Compress documents that still hold plain `content`
+    async for record in db.documents.find({"content": {"$type": "string"}}, {"_id": 0, "id": 1, "content": 1}):
+        compressed, codec = await asyncio.to_thread(compress_text, record["content"])
+        await db.documents.update_one(
+            {"id": record["id"]},
+            {
+                "$set": {
+                    "content_compressed": compressed,
+                    "content_codec": codec,
+                    "content_length": len(record["content"])
+                },
+                "$unset": {"content": ""}
             }
-        }
+        )
+        migrated["documents"] += 1
+    
+    # Replace inline session text with a reference to a document record
+    legacy_filter = {"$or": [{"document_content": {"$type": "string"}}, {"pdf_content": {"$type": "string"}}]}
+    async for session in db.chat_sessions.find(legacy_filter, {"_id": 0}):
+        if not await document_migration_lease.renew():
+            break  # Taken over by another worker
+        update: Dict[str, Any] = {"$unset": {"document_content": "", "pdf_content": ""}}
+        text = session.get("document_content") or session.get("pdf_content")
+        document = None
+        if text and not session.get("document_ids"):
+            filename = session.get("document_filename") or session.get("pdf_filename") or "document"
+            document = await save_document(
+                filename=filename,
+                text=text,
+                file_size=len(text.encode('utf-8')),
+                file_type=session.get("document_type") or "pdf",
+                outline=session.get("document_outline") or []
+            )
+            update["$set"] = {"document_ids": [document.id], "document_batch_id": None}
+        # Only while the inline text is still there, so a session migrated meanwhile keeps its reference
+        result = await db.chat_sessions.update_one({"id": session["id"], **legacy_filter}, update)
+        session_cache.invalidate(session["id"])
+        if not result.matched_count:
+            if document is not None:
+                await delete_document(document.id)
+            continue
+        if document is not None:
+            await retarget_document_refs([], [document.id])
+        migrated["sessions"] += 1
+    
+    # Sessions created before this change carry null text fields
+    await db.chat_sessions.update_many(
+        {"$or": [{"document_content": {"$exists": True, "$eq": None}}, {"pdf_content": {"$exists": True, "$eq": None}}]},
+        {"$unset": {"document_content": "", "pdf_content": ""}}
     )
     
-    return {
-        "message": "PDF uploaded successfully",
-        "filename": file.filename,
-        "file_type": "pdf",
-        "content_length": len(pdf_text)
-    }
+    # Outlines are read from the document records now; cached sessions never hold them
+    await db.chat_sessions.update_many({"document_outline": {"$exists": True}}, {"$unset": {"document_outline": ""}})
+    return migrated
 
-@api_router.post("/sessions/{session_id}/messages")
-async def send_message(session_id: str, request: SendMessageRequest):
-    # Verify session exists
-    session = await db.chat_sessions.find_one({"id": session_id})
+document_migration_lease = JobLease("document-storage-migration", 300)
+
+async def run_document_storage_migration():
+    try:
+        # Workers starting together would otherwise migrate the same sessions twice
+        if not await document_migration_lease.acquire():
+            logger.info("📦 Document storage migration is running on another worker")
+            return
+        try:
+            migrated = await migrate_document_storage()
+        finally:
+            await document_migration_lease.release()
+        logger.info(f"📦 Document storage migration: {migrated['documents']} documents compressed, {migrated['sessions']} sessions moved to references")
+    except Exception as e:
+        logger.error(f"Document storage migration failed: {e}")
+
+# Storage Repositories
+# Handlers reach sessions, messages, documents (with their blobs) and usage counters through these
+# repositories rather than Motor collections. STORAGE_BACKEND=memory swaps MongoDB for indexed dicts
+# in the process, so the request path can be benchmarked and tested without external services.
+# The MongoDB-only jobs (index provisioning, message archive, retention GC, usage reconcile) are
+# not started with the in-memory backend.
+BLOB_CHUNK_SIZE = 255 * 1024  # GridFS default chunk size
+
+class SessionRepository(ABC):
+    @abstractmethod
+    async def insert(self, session: Dict[str, Any]):
+        ...
+    
+    @abstractmethod
+    async def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Session metadata and document references, without legacy inline document text.
+        
+        has_legacy_text says whether the session still holds such text, so document-less sessions
+        skip the legacy_document_text lookup.
+        """
+    
+    @abstractmethod
+    async def legacy_document_text(self, session_id: str) -> Optional[str]:
+        """Inline text of a session written before documents were stored by reference"""
+    
+    @abstractmethod
+    async def list_recent(self, limit: int) -> List[Dict[str, Any]]:
+        """Most recently updated first, without legacy inline document text"""
+    
+    @abstractmethod
+    async def page(self, after: Optional[Tuple[datetime, str]], limit: int) -> List[Dict[str, Any]]:
+        """Summary fields of the sessions after a keyset position, in (updated_at, id) descending order"""
+    
+    @abstractmethod
+    async def titles(self, session_ids: List[str], analytics: bool = False) -> Dict[str, str]:
+        ...
+    
+    @abstractmethod
+    async def update(self, session_id: str, update: Dict[str, Any]) -> bool:
+        """Apply a $set/$unset/$inc update; False when the session does not exist"""
+    
+    @abstractmethod
+    async def touch_many(self, touched: Dict[str, datetime]):
+        """Set updated_at of several sessions at once"""
+    
+    @abstractmethod
+    async def delete(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Delete a session and return it, or None when it does not exist"""
+    
+    @abstractmethod
+    async def count(self) -> int:
+        ...
+
+class MessageRepository(ABC):
+    @abstractmethod
+    async def insert_many(self, messages: List[Dict[str, Any]], ordered: bool = True):
+        ...
+    
+    @abstractmethod
+    def iter_session(self, session_id: str, feature_type: Optional[str] = None,
+                     after: Optional[Tuple[datetime, str]] = None, limit: int = 0, analytics: bool = False):
+        """Async iterator over a session's stored messages after a keyset position, oldest first"""
+    
+    @abstractmethod
+    async def recent(self, session_id: str, feature_type: Optional[str], limit: int) -> List[Dict[str, Any]]:
+        """role and content of a session's newest `limit` messages, oldest first"""
+    
+    @abstractmethod
+    async def find_by_ids(self, message_ids: List[str], analytics: bool = False) -> Dict[str, Dict[str, Any]]:
+        ...
+    
+    @abstractmethod
+    def changed_since(self, since: Optional[datetime]):
+        """Async iterator over messages with a timestamp at or after `since` (all when None)"""
+    
+    @abstractmethod
+    async def delete_session(self, session_id: str) -> int:
+        """Delete every message of a session, archived ones included; returns how many were deleted"""
+
+class DocumentRepository(ABC):
+    @abstractmethod
+    async def insert(self, document: Dict[str, Any]):
+        ...
+    
+    @abstractmethod
+    async def get(self, document_id: str, fields: Tuple[str, ...]) -> Optional[Dict[str, Any]]:
+        """A document with at least `fields`, or None"""
+    
+    @abstractmethod
+    async def find_many(self, document_ids: List[str], fields: Tuple[str, ...],
+                        analytics: bool = False) -> Dict[str, Dict[str, Any]]:
+        ...
+    
+    @abstractmethod
+    async def update(self, document_id: str, fields: Dict[str, Any]):
+        ...
+    
+    @abstractmethod
+    async def add_refs(self, document_ids: List[str], amount: int):
+        ...
+    
+    @abstractmethod
+    def changed_since(self, since: Optional[datetime]):
+        """Async iterator over documents whose text changed at or after `since` (all when None)"""
+    
+    @abstractmethod
+    async def put_blob(self, bucket: str, file_id: str, filename: str, data: bytes, metadata: Dict[str, Any]):
+        ...
+    
+    @abstractmethod
+    def iter_blob(self, bucket: str, file_id: str):
+        """Async iterator over a blob's chunks"""
+    
+    @abstractmethod
+    async def delete_blob(self, bucket: str, file_id: str):
+        ...
+
+class UsageRepository(ABC):
+    @abstractmethod
+    async def add(self, days: Dict[str, Counter], totals: Dict[datetime, Counter], now: datetime):
+        """Add per-day deltas and running-total deltas per minute bucket; dotted fields like features.chat count per feature"""
+    
+    @abstractmethod
+    async def read(self, days: List[str]) -> Tuple[Dict[str, Any], Counter]:
+        """The running totals and the message counts of the given days"""
+
+# MongoDB repositories use the module-level db and analytics_db on every call, so they follow the
+# current client after a database reconnect
+class MongoSessionRepository(SessionRepository):
+    async def insert(self, session: Dict[str, Any]):
+        await db.chat_sessions.insert_one(session)
+    
+    async def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        sessions = await db.chat_sessions.aggregate([
+            {"$match": {"id": session_id}},
+            {"$limit": 1},
+            {"$addFields": {"has_legacy_text": SESSION_HAS_LEGACY_TEXT}},
+            {"$project": SESSION_EXCLUDE_CONTENT}
+        ]).to_list(1)
+        return sessions[0] if sessions else None
+    
+    async def legacy_document_text(self, session_id: str) -> Optional[str]:
+        session = await db.chat_sessions.find_one({"id": session_id}, {"_id": 0, "document_content": 1, "pdf_content": 1})
+        return (session or {}).get("document_content") or (session or {}).get("pdf_content")
+    
+    async def list_recent(self, limit: int) -> List[Dict[str, Any]]:
+        return await db.chat_sessions.find({}, SESSION_EXCLUDE_CONTENT).sort("updated_at", -1).to_list(limit)
+    
+    async def page(self, after: Optional[Tuple[datetime, str]], limit: int) -> List[Dict[str, Any]]:
+        query = position_filter("updated_at", after, "$lt") if after else {}
+        return await db.chat_sessions.find(query, SESSION_SUMMARY_PROJECTION).sort(
+            [("updated_at", DESCENDING), ("id", DESCENDING)]
+        ).limit(limit).to_list(limit)
+    
+    async def titles(self, session_ids: List[str], analytics: bool = False) -> Dict[str, str]:
+        return {
+            session["id"]: session.get("title", "")
+            async for session in (analytics_db if analytics else db).chat_sessions.find(
+                {"id": {"$in": session_ids}}, {"_id": 0, "id": 1, "title": 1}
+            )
+        }
+    
+    async def update(self, session_id: str, update: Dict[str, Any]) -> bool:
+        result = await db.chat_sessions.update_one({"id": session_id}, update)
+        return result.matched_count > 0
+    
+    async def touch_many(self, touched: Dict[str, datetime]):
+        await db.chat_sessions.bulk_write(
+            [UpdateOne({"id": session_id}, {"$set": {"updated_at": updated_at}}) for session_id, updated_at in touched.items()],
+            ordered=False
+        )
+    
+    async def delete(self, session_id: str) -> Optional[Dict[str, Any]]:
+        return await db.chat_sessions.find_one_and_delete({"id": session_id}, {"_id": 0, "document_ids": 1})
+    
+    async def count(self) -> int:
+        return await db.chat_sessions.count_documents({})
+
+class MongoMessageRepository(MessageRepository):
+    async def insert_many(self, messages: List[Dict[str, Any]], ordered: bool = True):
+        await db.chat_messages.insert_many(messages, ordered=ordered)
+    
+    async def iter_session(self, session_id: str, feature_type: Optional[str] = None,
+                           after: Optional[Tuple[datetime, str]] = None, limit: int = 0, analytics: bool = False):
+        messages_cursor = (analytics_db if analytics else db).chat_messages.find(
+            session_messages_filter(session_id, feature_type, after), MESSAGE_PROJECTION
+        ).sort([("timestamp", ASCENDING), ("id", ASCENDING)]).batch_size(MESSAGE_BATCH_SIZE)
+        if limit > 0:
+            messages_cursor = messages_cursor.limit(limit)
+        async for message in messages_cursor:
+            yield message
+    
+    async def recent(self, session_id: str, feature_type: Optional[str], limit: int) -> List[Dict[str, Any]]:
+        # Newest first with a limit walks the (session_id[, feature_type], timestamp, id) index backwards
+        recent = await db.chat_messages.find(
+            session_messages_filter(session_id, feature_type), {"_id": 0, "role": 1, "content": 1}
+        ).sort([("timestamp", DESCENDING), ("id", DESCENDING)]).limit(limit).to_list(limit)
+        recent.reverse()
+        return recent
+    
+    async def find_by_ids(self, message_ids: List[str], analytics: bool = False) -> Dict[str, Dict[str, Any]]:
+        return {
+            message["id"]: message
+            async for message in (analytics_db if analytics else db).chat_messages.find(
+                {"id": {"$in": message_ids}},
+                {"_id": 0, "id": 1, "session_id": 1, "content": 1, "timestamp": 1, "feature_type": 1}
+            )
+        }
+    
+    async def changed_since(self, since: Optional[datetime]):
+        query = {"timestamp": {"$gte": since}} if since else {}
+        async for message in db.chat_messages.find(query, {"_id": 0, "id": 1, "session_id": 1, "content": 1, "timestamp": 1}):
+            yield message
+    
+    async def delete_session(self, session_id: str) -> int:
+        deleted = await db.chat_messages.delete_many({"session_id": session_id})
+        archived = 0
+        async for block in db.chat_message_archive.find({"session_id": session_id}, {"_id": 0, "count": 1}):
+            archived += block["count"]
+        await db.chat_message_archive.delete_many({"session_id": session_id})
+        return deleted.deleted_count + archived
+
+class MongoDocumentRepository(DocumentRepository):
+    async def insert(self, document: Dict[str, Any]):
+        await db.documents.insert_one(document)
+    
+    async def get(self, document_id: str, fields: Tuple[str, ...]) -> Optional[Dict[str, Any]]:
+        return await db.documents.find_one({"id": document_id}, {"_id": 0, **{field: 1 for field in fields}})
+    
+    async def find_many(self, document_ids: List[str], fields: Tuple[str, ...],
+                        analytics: bool = False) -> Dict[str, Dict[str, Any]]:
+        return {
+            record["id"]: record
+            async for record in (analytics_db if analytics else db).documents.find(
+                {"id": {"$in": document_ids}}, {"_id": 0, "id": 1, **{field: 1 for field in fields}}
+            )
+        }
+    
+    async def update(self, document_id: str, fields: Dict[str, Any]):
+        await db.documents.update_one({"id": document_id}, {"$set": fields})
+    
+    async def add_refs(self, document_ids: List[str], amount: int):
+        await db.documents.update_many({"id": {"$in": document_ids}}, {"$inc": {"ref_count": amount}})
+    
+    async def changed_since(self, since: Optional[datetime]):
+        query = {"text_updated_at": {"$gte": since}} if since else {}
+        async for record in db.documents.find(query, {"_id": 0, "id": 1, "filename": 1, "text_updated_at": 1, "upload_date": 1}):
+            yield record
+    
+    async def put_blob(self, bucket: str, file_id: str, filename: str, data: bytes, metadata: Dict[str, Any]):
+        await gridfs_bucket(bucket).upload_from_stream_with_id(file_id, filename, data, metadata=metadata)
+    
+    async def iter_blob(self, bucket: str, file_id: str):
+        # Read chunk by chunk without loading the file whole
+        grid_out = await gridfs_bucket(bucket).open_download_stream(file_id)
+        while True:
+            chunk = await grid_out.readchunk()
+            if not chunk:
+                break
+            yield chunk
+    
+    async def delete_blob(self, bucket: str, file_id: str):
+        await gridfs_bucket(bucket).delete(file_id)
+
+class MongoUsageRepository(UsageRepository):
+    async def add(self, days: Dict[str, Counter], totals: Dict[datetime, Counter], now: datetime):
+        operations = [
+            UpdateOne({"_id": f"day:{day}"}, {"$inc": dict(counts), "$set": {"date": day, "updated_at": now}}, upsert=True)
+            for day, counts in days.items()
+        ]
+        operations.extend(
+            UpdateOne({"_id": f"delta:{bucket.isoformat()}"},
+                      {"$inc": dict(counts), "$set": {"bucket": bucket, "updated_at": now}}, upsert=True)
+            for bucket, counts in totals.items()
+        )
+        await db.usage_counters.bulk_write(operations, ordered=False)
+    
+    async def read(self, days: List[str]) -> Tuple[Dict[str, Any], Counter]:
+        baseline, deltas, compacted, live = await asyncio.gather(
+            analytics_db.usage_counters.find_one({"_id": USAGE_TOTALS_ID}, {"_id": 0}),
+            analytics_db.usage_counters.find({"bucket": {"$exists": True}}, {"_id": 0}).to_list(None),
+            analytics_db.daily_usage.find({"_id": {"$in": days}}, {"_id": 1, "message_count": 1}).to_list(len(days)),
+            analytics_db.usage_counters.find(
+                {"_id": {"$in": [f"day:{day}" for day in days]}}, {"_id": 0, "date": 1, "message_count": 1}
+            ).to_list(len(days))
+        )
+        totals = {**(baseline or {}), "features": dict((baseline or {}).get("features") or {})}
+        watermark = totals.get("watermark")
+        for delta in deltas:
+            # Buckets before the watermark are already in the recounted baseline
+            if watermark is not None and delta["bucket"] < watermark:
+                continue
+            for field in ("sessions", "messages", "documents"):
+                totals[field] = totals.get(field, 0) + delta.get(field, 0)
+            for feature, count in (delta.get("features") or {}).items():
+                totals["features"][feature] = totals["features"].get(feature, 0) + count
+            if totals.get("updated_at") is None or delta["updated_at"] > totals["updated_at"]:
+                totals["updated_at"] = delta["updated_at"]
+        
+        # A finished day is read from daily_usage; its live counter only holds writes that landed after compaction
+        day_counts: Counter = Counter()
+        for record in compacted:
+            day_counts[record["_id"]] += record.get("message_count", 0)
+        for record in live:
+            day_counts[record["date"]] += record.get("message_count", 0)
+        return totals, day_counts
+
+# In-memory repositories: documents live in dicts keyed by id, and every ordered query walks a sorted
+# list of (sort key, id) tuples kept up to date with bisect, the way MongoDB walks an index.
+# Reads return copies, so callers cannot change stored documents by accident.
+def apply_update(document: Dict[str, Any], update: Dict[str, Any]):
+    """Apply the $set, $unset and $inc operators the handlers use to a stored document"""
+    unsupported = update.keys() - {"$set", "$unset", "$inc"}
+    if unsupported:
+        raise ValueError(f"Unsupported update operators for in-memory storage: {', '.join(sorted(unsupported))}")
+    document.update(update.get("$set", {}))
+    for field in update.get("$unset", {}):
+        document.pop(field, None)
+    for field, amount in update.get("$inc", {}).items():
+        document[field] = document.get(field, 0) + amount
+
+def apply_projection(document: Dict[str, Any], projection: Dict[str, int]) -> Dict[str, Any]:
+    """Copy of a stored document with a MongoDB-style inclusion or exclusion projection applied"""
+    if any(value for field, value in projection.items() if field != "_id"):
+        return {field: document[field] for field, value in projection.items() if value and field in document}
+    return {field: value for field, value in document.items() if field not in projection}
+
+def _sorted_remove(keys: List[Tuple], key: Tuple):
+    position = bisect.bisect_left(keys, key)
+    if position < len(keys) and keys[position] == key:
+        del keys[position]
+
+class MemorySessionRepository(SessionRepository):
+    def __init__(self):
+        self._sessions: Dict[str, Dict[str, Any]] = {}
+        self._by_updated: List[Tuple[datetime, str]] = []  # (updated_at, id), ascending
+    
+    def _index(self, session: Dict[str, Any]):
+        bisect.insort(self._by_updated, (session["updated_at"], session["id"]))
+    
+    def _unindex(self, session: Dict[str, Any]):
+        _sorted_remove(self._by_updated, (session["updated_at"], session["id"]))
+    
+    async def insert(self, session: Dict[str, Any]):
+        if session["id"] in self._sessions:
+            raise ValueError(f"Session {session['id']} already exists")
+        self._sessions[session["id"]] = dict(session)
+        self._index(session)
+    
+    async def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        session = self._sessions.get(session_id)
+        if session is None:
+            return None
+        return {
+            **apply_projection(session, SESSION_EXCLUDE_CONTENT),
+            "has_legacy_text": bool(session.get("document_content") or session.get("pdf_content"))
+        }
+    
+    async def legacy_document_text(self, session_id: str) -> Optional[str]:
+        session = self._sessions.get(session_id) or {}
+        return session.get("document_content") or session.get("pdf_content")
+    
+    async def list_recent(self, limit: int) -> List[Dict[str, Any]]:
+        return [
+            apply_projection(self._sessions[session_id], SESSION_EXCLUDE_CONTENT)
+            for _, session_id in reversed(self._by_updated[-limit:])
+        ]
+    
+    async def page(self, after: Optional[Tuple[datetime, str]], limit: int) -> List[Dict[str, Any]]:
+        end = bisect.bisect_left(self._by_updated, after) if after else len(self._by_updated)
+        keys = self._by_updated[max(end - limit, 0):end]
+        return [apply_projection(self._sessions[session_id], SESSION_SUMMARY_PROJECTION) for _, session_id in reversed(keys)]
+    
+    async def titles(self, session_ids: List[str], analytics: bool = False) -> Dict[str, str]:
+        return {
+            session_id: self._sessions[session_id].get("title", "")
+            for session_id in session_ids if session_id in self._sessions
+        }
+    
+    async def update(self, session_id: str, update: Dict[str, Any]) -> bool:
+        current = self._sessions.get(session_id)
+        if current is None:
+            return False
+        session = dict(current)
+        apply_update(session, update)
+        self._unindex(current)
+        self._sessions[session_id] = session
+        self._index(session)
+        return True
+    
+    async def touch_many(self, touched: Dict[str, datetime]):
+        for session_id, updated_at in touched.items():
+            await self.update(session_id, {"$set": {"updated_at": updated_at}})
+    
+    async def delete(self, session_id: str) -> Optional[Dict[str, Any]]:
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self._unindex(session)
+        return session
+    
+    async def count(self) -> int:
+        return len(self._sessions)
+
+class MemoryMessageRepository(MessageRepository):
+    def __init__(self):
+        self._messages: Dict[str, Dict[str, Any]] = {}
+        # (timestamp, id) per session and per (session, feature_type); None stands for every feature
+        self._by_session: Dict[Tuple[str, Optional[str]], List[Tuple[datetime, str]]] = {}
+        self._by_time: List[Tuple[datetime, str]] = []
+    
+    async def insert_many(self, messages: List[Dict[str, Any]], ordered: bool = True):
+        for message in messages:
+            if message["id"] in self._messages:
+                continue  # Already stored, e.g. by a retried write-behind batch
+            stored = {field: value for field, value in message.items() if field != "_id"}
+            key = (stored["timestamp"], stored["id"])
+            self._messages[stored["id"]] = stored
+            bisect.insort(self._by_session.setdefault((stored["session_id"], None), []), key)
+            bisect.insort(self._by_session.setdefault((stored["session_id"], stored.get("feature_type")), []), key)
+            bisect.insort(self._by_time, key)
+    
+    async def iter_session(self, session_id: str, feature_type: Optional[str] = None,
+                           after: Optional[Tuple[datetime, str]] = None, limit: int = 0, analytics: bool = False):
+        keys = self._by_session.get((session_id, feature_type or None), [])
+        start = bisect.bisect_right(keys, after) if after else 0
+        for _, message_id in keys[start:start + limit] if limit > 0 else keys[start:]:
+            message = self._messages.get(message_id)
+            if message is not None:
+                yield dict(message)
+    
+    async def recent(self, session_id: str, feature_type: Optional[str], limit: int) -> List[Dict[str, Any]]:
+        keys = self._by_session.get((session_id, feature_type or None), [])[-limit:]
+        return [
+            {"role": self._messages[message_id]["role"], "content": self._messages[message_id]["content"]}
+            for _, message_id in keys
+        ]
+    
+    async def find_by_ids(self, message_ids: List[str], analytics: bool = False) -> Dict[str, Dict[str, Any]]:
+        return {message_id: dict(self._messages[message_id]) for message_id in message_ids if message_id in self._messages}
+    
+    async def changed_since(self, since: Optional[datetime]):
+        start = bisect.bisect_left(self._by_time, (since,)) if since else 0
+        for _, message_id in self._by_time[start:]:
+            message = self._messages.get(message_id)
+            if message is not None:
+                yield dict(message)
+    
+    async def delete_session(self, session_id: str) -> int:
+        keys = self._by_session.pop((session_id, None), [])
+        removed = set()
+        for _, message_id in keys:
+            message = self._messages.pop(message_id)
+            self._by_session.pop((session_id, message.get("feature_type")), None)
+            removed.add(message_id)
+        if removed:
+            self._by_time = [key for key in self._by_time if key[1] not in removed]
+        return len(removed)
+
+class MemoryDocumentRepository(DocumentRepository):
+    def __init__(self):
+        self._documents: Dict[str, Dict[str, Any]] = {}
+        self._by_text_updated: List[Tuple[datetime, str]] = []
+        self._blobs: Dict[Tuple[str, str], bytes] = {}
+    
+    @staticmethod
+    def _version(document: Dict[str, Any]) -> Tuple[datetime, str]:
+        return (document.get("text_updated_at") or document["upload_date"], document["id"])
+    
+    async def insert(self, document: Dict[str, Any]):
+        if document["id"] in self._documents:
+            raise ValueError(f"Document {document['id']} already exists")
+        self._documents[document["id"]] = dict(document)
+        bisect.insort(self._by_text_updated, self._version(document))
+    
+    async def get(self, document_id: str, fields: Tuple[str, ...]) -> Optional[Dict[str, Any]]:
+        document = self._documents.get(document_id)
+        return dict(document) if document is not None else None
+    
+    async def find_many(self, document_ids: List[str], fields: Tuple[str, ...],
+                        analytics: bool = False) -> Dict[str, Dict[str, Any]]:
+        return {
+            document_id: dict(self._documents[document_id])
+            for document_id in document_ids if document_id in self._documents
+        }
+    
+    async def update(self, document_id: str, fields: Dict[str, Any]):
+        current = self._documents.get(document_id)
+        if current is None:
+            return
+        document = {**current, **fields}
+        _sorted_remove(self._by_text_updated, self._version(current))
+        self._documents[document_id] = document
+        bisect.insort(self._by_text_updated, self._version(document))
+    
+    async def add_refs(self, document_ids: List[str], amount: int):
+        for document_id in document_ids:
+            if document_id in self._documents:
+                document = self._documents[document_id] = dict(self._documents[document_id])
+                document["ref_count"] = document.get("ref_count", 0) + amount
+    
+    async def changed_since(self, since: Optional[datetime]):
+        start = bisect.bisect_left(self._by_text_updated, (since,)) if since else 0
+        for _, document_id in self._by_text_updated[start:]:
+            document = self._documents.get(document_id)
+            if document is not None:
+                yield dict(document)
+    
+    async def put_blob(self, bucket: str, file_id: str, filename: str, data: bytes, metadata: Dict[str, Any]):
+        self._blobs[(bucket, file_id)] = bytes(data)
+    
+    async def iter_blob(self, bucket: str, file_id: str):
+        data = self._blobs.get((bucket, file_id))
+        if data is None:
+            raise FileNotFoundError(f"No blob {file_id} in {bucket}")
+        for offset in range(0, len(data), BLOB_CHUNK_SIZE):
+            yield data[offset:offset + BLOB_CHUNK_SIZE]
+    
+    async def delete_blob(self, bucket: str, file_id: str):
+        if self._blobs.pop((bucket, file_id), None) is None:
+            raise FileNotFoundError(f"No blob {file_id} in {bucket}")
+
+class MemoryUsageRepository(UsageRepository):
+    def __init__(self):
+        self._totals: Dict[str, Any] = {}
+        self._days: Counter = Counter()
+    
+    async def add(self, days: Dict[str, Counter], totals: Dict[datetime, Counter], now: datetime):
+        for day, counts in days.items():
+            self._days[day] += counts.get("message_count", 0)
+        for counts in totals.values():
+            for field, amount in counts.items():
+                if field.startswith("features."):
+                    features = self._totals.setdefault("features", {})
+                    feature = field.split(".", 1)[1]
+                    features[feature] = features.get(feature, 0) + amount
+                else:
+                    self._totals[field] = self._totals.get(field, 0) + amount
+        self._totals["updated_at"] = now
+    
+    async def read(self, days: List[str]) -> Tuple[Dict[str, Any], Counter]:
+        totals = {**self._totals, "features": dict(self._totals.get("features") or {})}
+        return totals, Counter({day: self._days[day] for day in days if self._days[day]})
+
+class Storage(NamedTuple):
+    backend: str
+    sessions: SessionRepository
+    messages: MessageRepository
+    documents: DocumentRepository
+    usage: UsageRepository
+
+def create_storage(backend: str) -> Storage:
+    if backend == "memory":
+        return Storage("memory", MemorySessionRepository(), MemoryMessageRepository(),
+                       MemoryDocumentRepository(), MemoryUsageRepository())
+    return Storage("mongo", MongoSessionRepository(), MongoMessageRepository(),
+                   MongoDocumentRepository(), MongoUsageRepository())
+
+storage = create_storage(STORAGE_BACKEND)
+
+# Session Cache
+class SessionCache:
+    """LRU cache of session documents with a TTL, kept current by the write helpers below.
+    
+    Sessions are read without document text or outline, so entries hold only metadata and
+    document references. A miss fills the cache through begin_fill/finish_fill: writes and
+    invalidations that land while the storage read is in flight bump the session's generation,
+    and the stale copy that read returns is then not cached.
+    """
+    
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_fills = 0
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        # Only sessions with a fill in flight are tracked, so both dicts stay small
+        self._generations: Dict[str, int] = {}
+        self._fills: Dict[str, int] = {}
+    
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(session_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[session_id]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(session_id)
+        self.hits += 1
+        return dict(entry[1])
+    
+    def put(self, session: Dict[str, Any]):
+        if self.max_entries <= 0:
+            return
+        self._entries[session["id"]] = (time.monotonic() + self.ttl_seconds, dict(session))
+        self._entries.move_to_end(session["id"])
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def begin_fill(self, session_id: str) -> int:
+        """Start a storage read for a miss; returns the generation to pass to finish_fill"""
+        self._fills[session_id] = self._fills.get(session_id, 0) + 1
+        return self._generations.setdefault(session_id, 0)
+    
+    def finish_fill(self, session_id: str, generation: int, session: Optional[Dict[str, Any]]):
+        """Cache what the read returned unless the session was written or invalidated meanwhile"""
+        if session is not None:
+            if self._generations.get(session_id) == generation:
+                self.put(session)
+            else:
+                self.stale_fills += 1
+        remaining = self._fills.get(session_id, 1) - 1
+        if remaining:
+            self._fills[session_id] = remaining
+        else:
+            self._fills.pop(session_id, None)
+            self._generations.pop(session_id, None)
+    
+    def _bump(self, session_id: str):
+        if session_id in self._generations:
+            self._generations[session_id] += 1
+    
+    def apply(self, session_id: str, update: Dict[str, Any]):
+        """Write a plain $set through to the cached copy; drop the entry for any other update"""
+        self._bump(session_id)
+        entry = self._entries.get(session_id)
+        if entry is None:
+            return
+        if update.keys() == {"$set"}:
+            entry[1].update(update["$set"])
+        else:
+            del self._entries[session_id]
+    
+    def invalidate(self, session_id: str):
+        self._bump(session_id)
+        self._entries.pop(session_id, None)
+    
+    def clear(self):
+        for session_id in self._generations:
+            self._generations[session_id] += 1
+        self._entries.clear()
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups * 100) if lookups else 0,
+            "evictions": self.evictions,
+            "stale_fills": self.stale_fills
+        }
+
+session_cache = SessionCache(SESSION_CACHE_MAX_ENTRIES, SESSION_CACHE_TTL_SECONDS)
+
+async def get_session_or_404(session_id: str) -> Dict[str, Any]:
+    """Load a session through the session cache, raising 404 when it does not exist"""
+    session = session_cache.get(session_id)
+    if session is not None:
+        return session
+    generation = session_cache.begin_fill(session_id)
+    session = None
+    try:
+        session = await storage.sessions.get(session_id)
+    finally:
+        session_cache.finish_fill(session_id, generation, session)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
+    return session
+
+async def update_session(session_id: str, update: Dict[str, Any]):
+    """Update one session in storage and write the change through to the session cache"""
+    updated = await storage.sessions.update(session_id, update)
+    session_cache.apply(session_id, update)
+    return updated
+
+# Chat Write Path
+class ChatWriteQueue:
+    """Write-behind buffer for chat messages, flushed in batches by a background task.
+    
+    Durability: in write_behind mode a turn is acknowledged once its messages are in this
+    in-process queue. If the process dies, messages still queued are lost: at most
+    CHAT_WRITE_QUEUE_MAX messages, normally about one flush interval of traffic. A clean
+    shutdown flushes the queue. A batch stays queued until its insert is acknowledged, and messages
+    from a failed batch are retried on the next flush. When a flush cannot make room, new turns
+    are refused with 503 rather than growing the queue past CHAT_WRITE_QUEUE_MAX.
+    Until a message is flushed, only this worker's chat history sees it; message listings,
+    exports and other workers see it after the flush.
+    """
+    
+    def __init__(self, batch_size: int, interval_seconds: float, max_pending: int):
+        self.batch_size = batch_size
+        self.interval_seconds = interval_seconds
+        self.max_pending = max_pending
+        self.flushed = 0
+        self.batches = 0
+        self.failures = 0
+        self._pending: List[Dict[str, Any]] = []
+        self._touched: Dict[str, datetime] = {}
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping: Optional[asyncio.Event] = None
+        self._in_flight = 0  # Head of _pending currently being inserted
+    
+    async def enqueue(self, messages: List[Dict[str, Any]], touch_session_id: Optional[str] = None):
+        if len(self._pending) + len(messages) > self.max_pending:
+            await self.flush()  # Backpressure: the writer that fills the queue pays for the flush
+            if len(self._pending) + len(messages) > self.max_pending:
+                raise HTTPException(status_code=503, detail="Chat write queue is full; try again shortly")
+        self._pending.extend(messages)
+        if touch_session_id:
+            self._touched[touch_session_id] = datetime.utcnow()
+    
+    def pending_for(self, session_id: str, feature_type: Optional[str] = None) -> List[Dict[str, Any]]:
+        # The batch being inserted may already be visible in storage, so it is left out here
+        return [
+            message for message in self._pending[self._in_flight:]
+            if message["session_id"] == session_id and (feature_type is None or message["feature_type"] == feature_type)
+        ]
+    
+    async def flush(self):
+        async with self._lock:
+            while self._pending or self._touched:
+                # The batch stays at the head of the queue until the insert is acknowledged, so a
+                # cancelled flush leaves it there for the next one; only flush removes from the head
+                batch = self._pending[:self.batch_size]
+                touched, self._touched = self._touched, {}
+                self._in_flight = len(batch)
+                try:
+                    insert_result, touch_result = await asyncio.gather(
+                        storage.messages.insert_many(batch, ordered=False) if batch else asyncio.sleep(0),
+                        storage.sessions.touch_many(touched) if touched else asyncio.sleep(0),
+                        return_exceptions=True
+                    )
+                except asyncio.CancelledError:
+                    for session_id, updated_at in touched.items():
+                        self._touched.setdefault(session_id, updated_at)
+                    raise
+                finally:
+                    self._in_flight = 0
+                del self._pending[:len(batch)]
+                
+                retry = []
+                if isinstance(insert_result, BulkWriteError):
+                    # insert_many assigned each message an _id, so messages that did reach the server
+                    # fail again as duplicates on retry; only the other errors need another attempt
+                    retry = [
+                        batch[error["index"]] for error in insert_result.details.get("writeErrors", [])
+                        if error.get("code") != 11000
+                    ]
+                elif isinstance(insert_result, Exception):
+                    retry = batch
+                if isinstance(touch_result, Exception):
+                    for session_id, updated_at in touched.items():
+                        self._touched.setdefault(session_id, updated_at)
+                
+                self.flushed += len(batch) - len(retry)
+                self.batches += 1
+                if retry or isinstance(touch_result, Exception):
+                    self.failures += 1
+                    self._pending[:0] = retry
+                    error = insert_result if isinstance(insert_result, Exception) else touch_result
+                    logger.error(f"Chat write-behind flush failed, {len(self._pending)} messages pending: {error}")
+                    return
+    
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+            if self._pending or self._touched:
+                try:
+                    await self.flush()
+                except Exception as e:
+                    logger.error(f"Chat write-behind flush error: {e}")
+    
+    def start(self):
+        if self._task is None:
+            self._stopping = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Let a flush in progress finish, then flush whatever is still queued"""
+        if self._task is not None:
+            self._stopping.set()
+            await self._task
+            self._task = None
+        await self.flush()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": CHAT_WRITE_MODE,
+            "pending": len(self._pending),
+            "flushed": self.flushed,
+            "batches": self.batches,
+            "failures": self.failures
+        }
+
+chat_write_queue = ChatWriteQueue(CHAT_WRITE_BATCH_SIZE, CHAT_WRITE_FLUSH_INTERVAL, CHAT_WRITE_QUEUE_MAX)
+
+async def write_chat_messages(session_id: str, messages: List[Dict[str, Any]], touch_session: bool):
+    """Insert a turn's messages in one round trip, concurrently with the session timestamp update"""
+    writes = [storage.messages.insert_many(messages)]
+    if touch_session:
+        writes.append(update_session(session_id, {"$set": {"updated_at": datetime.utcnow()}}))
+    await asyncio.gather(*writes)
+
+async def write_chat_messages_logged(session_id: str, messages: List[Dict[str, Any]], touch_session: bool):
+    try:
+        await write_chat_messages(session_id, messages, touch_session)
+    except Exception as e:
+        logger.error(f"Could not save {len(messages)} messages for session {session_id}: {e}")
+
+async def persist_chat_messages(session: Dict[str, Any], messages: List[ChatMessage],
+                                background_tasks: Optional[BackgroundTasks] = None, touch_session: bool = True):
+    """Save chat messages according to CHAT_WRITE_MODE; session is the record the handler already loaded"""
+    session_id = session["id"]
+    documents = [message.dict() for message in messages]
+    index_messages(documents, {session_id: session.get("title", "")})
+    usage_rollup.record_messages(documents)
+    if CHAT_WRITE_MODE == "write_behind":
+        await chat_write_queue.enqueue(documents, session_id if touch_session else None)
+        if touch_session:
+            session_cache.apply(session_id, {"$set": {"updated_at": datetime.utcnow()}})
+    elif CHAT_WRITE_MODE == "background" and background_tasks is not None:
+        background_tasks.add_task(write_chat_messages_logged, session_id, documents, touch_session)
+    else:
+        await write_chat_messages(session_id, documents, touch_session)
+
+# Usage Rollups
+# /insights reads precomputed numbers from usage_counters: a recounted baseline, per-minute deltas and
+# one document per day. Writes add to in-memory deltas that each worker applies to Mongo with $inc,
+# into the bucket of the minute the item was created or deleted. A periodic job compacts finished
+# days into daily_usage from the messages themselves and recounts the items created before a
+# watermark a few minutes back; readers add only the buckets from the watermark on, so deltas other
+# workers flush after the recount are not counted twice, and a reconcile never replaces a newer one.
+# The recount corrects drift from crashes and TTL expiry; a deletion landing between the watermark
+# and the recount is subtracted twice until the next reconcile.
+USAGE_TOTALS_ID = "totals"
+USAGE_HISTORY_DAYS = 7
+USAGE_KEY_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+# Items newer than this may still be on their way to Mongo (an AI call, the write-behind queue)
+USAGE_RECONCILE_LAG = timedelta(minutes=5)
+
+def usage_day(moment: datetime) -> str:
+    return moment.strftime("%Y-%m-%d")
+
+def usage_bucket(moment: datetime) -> datetime:
+    return moment.replace(second=0, microsecond=0)
+
+def usage_feature_key(feature_type: Optional[str]) -> str:
+    """Feature types become field names, so anything but a plain identifier is counted as 'other'"""
+    feature = feature_type or "chat"
+    return feature if USAGE_KEY_PATTERN.match(feature) else "other"
+
+class UsageRollup:
+    """Usage deltas accumulated in memory and added to usage_counters every USAGE_FLUSH_SECONDS"""
+    
+    def __init__(self, interval_seconds: float):
+        self.interval_seconds = interval_seconds
+        self.flushed_at: Optional[datetime] = None
+        self.flushes = 0
+        self.failures = 0
+        self._totals: Dict[datetime, Counter] = {}
+        self._days: Dict[str, Counter] = {}
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+    
+    def record(self, field: str, amount: int = 1, at: Optional[datetime] = None):
+        """Count sessions, documents or messages created (positive, at their creation time) or deleted (negative)"""
+        self._totals.setdefault(usage_bucket(at or datetime.utcnow()), Counter())[field] += amount
+    
+    def record_messages(self, messages: List[Dict[str, Any]]):
+        for message in messages:
+            feature = usage_feature_key(message.get("feature_type"))
+            day = self._days.setdefault(usage_day(message["timestamp"]), Counter())
+            day["message_count"] += 1
+            day[f"features.{feature}"] += 1
+            bucket = self._totals.setdefault(usage_bucket(message["timestamp"]), Counter())
+            bucket["messages"] += 1
+            bucket[f"features.{feature}"] += 1
+    
+    def _restore(self, totals: Dict[datetime, Counter], days: Dict[str, Counter]):
+        for bucket, counts in totals.items():
+            self._totals.setdefault(bucket, Counter()).update(counts)
+        for day, counts in days.items():
+            self._days.setdefault(day, Counter()).update(counts)
+    
+    async def flush(self):
+        async with self._lock:
+            totals, self._totals = self._totals, {}
+            days, self._days = self._days, {}
+            if not totals and not days:
+                return
+            now = datetime.utcnow()
+            try:
+                await storage.usage.add(days, totals, now)
+            except Exception as e:
+                # Retried on the next flush; a partially applied batch is corrected by the next reconcile
+                self.failures += 1
+                self._restore(totals, days)
+                logger.error(f"Usage counter flush failed: {e}")
+                return
+            self.flushes += 1
+            self.flushed_at = now
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            await self.flush()
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending_fields": sum(len(counts) for counts in self._totals.values())
+                              + sum(len(counts) for counts in self._days.values()),
+            "flushes": self.flushes,
+            "failures": self.failures,
+            "flushed_at": self.flushed_at
+        }
+
+usage_rollup = UsageRollup(USAGE_FLUSH_SECONDS)
+
+async def compact_daily_usage():
+    """Rebuild finished days from chat_messages and the archive into daily_usage and drop their live counters.
+    
+    Reads go to the primary: a lagging secondary would undercount a day whose counter is then deleted.
+    """
+    now = datetime.utcnow()
+    today = usage_day(now)
+    recent = {usage_day(now - timedelta(days=offset)) for offset in range(1, USAGE_HISTORY_DAYS)}
+    compacted = {record["_id"] async for record in db.daily_usage.find({"_id": {"$in": list(recent)}}, {"_id": 1})}
+    live = {record["date"] async for record in db.usage_counters.find({"date": {"$lt": today}}, {"_id": 0, "date": 1})}
+    
+    for day in sorted(live | (recent - compacted)):
+        start = datetime.strptime(day, "%Y-%m-%d")
+        end = start + timedelta(days=1)
+        features: Counter = Counter()
+        async for group in db.chat_messages.aggregate([
+            {"$match": {"timestamp": {"$gte": start, "$lt": end}}},
+            {"$group": {"_id": "$feature_type", "count": {"$sum": 1}}}
+        ]):
+            features[usage_feature_key(group["_id"])] += group["count"]
+        # MESSAGE_ARCHIVE_KEEP_RECENT can archive messages of days still in the window
+        async for block in db.chat_message_archive.find(
+            {"last_timestamp": {"$gte": start}, "first_timestamp": {"$lt": end}},
+            {"_id": 0, "first_timestamp": 1, "last_timestamp": 1, "features": 1, "codec": 1, "data": 1}
+        ).batch_size(1):
+            if block["first_timestamp"] >= start and block["last_timestamp"] < end:
+                features.update(block.get("features") or {})
+                continue
+            for message in await asyncio.to_thread(decode_message_block, block):
+                if start <= message["timestamp"] < end:
+                    features[usage_feature_key(message.get("feature_type"))] += 1
+        await db.daily_usage.replace_one(
+            {"_id": day},
+            {"_id": day, "message_count": sum(features.values()), "features": dict(features), "compacted_at": now},
+            upsert=True
+        )
+        await db.usage_counters.delete_one({"_id": f"day:{day}"})
+
+async def reconcile_usage_totals():
+    """Recount the totals of items created before the watermark, reading from the primary"""
+    watermark = usage_bucket(datetime.utcnow() - USAGE_RECONCILE_LAG)
+    before = {"$lt": watermark}
+    total_sessions, total_messages, total_documents, feature_groups, popular_pdfs = await asyncio.gather(
+        db.chat_sessions.count_documents({"created_at": before}),
+        db.chat_messages.count_documents({"timestamp": before}),
+        db.documents.count_documents({"upload_date": before}),
+        db.chat_messages.aggregate([
+            {"$match": {"timestamp": before}},
+            {"$group": {"_id": "$feature_type", "count": {"$sum": 1}}}
+        ]).to_list(None),
+        db.chat_sessions.aggregate([
+            {"$match": {"pdf_filename": {"$exists": True, "$ne": None}}},
+            {"$group": {"_id": "$pdf_filename", "usage_count": {"$sum": 1}}},
+            {"$sort": {"usage_count": -1}},
+            {"$limit": 5}
+        ]).to_list(5)
+    )
+    features: Counter = Counter()
+    for group in feature_groups:
+        features[usage_feature_key(group["_id"])] += group["count"]
+    async for block in db.chat_message_archive.find({"last_timestamp": before}, {"_id": 0, "count": 1, "features": 1}):
+        total_messages += block["count"]
+        features.update(block.get("features") or {})
+    now = datetime.utcnow()
+    try:
+        # Only replaces a baseline counted up to an older watermark
+        await db.usage_counters.update_one(
+            {"_id": USAGE_TOTALS_ID, "$or": [{"watermark": {"$lte": watermark}}, {"watermark": {"$exists": False}}]},
+            {"$set": {
+                "sessions": total_sessions,
+                "messages": total_messages,
+                "documents": total_documents,
+                "features": dict(features),
+                "popular_pdfs": popular_pdfs,
+                "watermark": watermark,
+                "updated_at": now,
+                "reconciled_at": now
+            }},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return  # Another worker has already reconciled up to a later watermark
+    await db.usage_counters.delete_many({"bucket": {"$lt": watermark}})
+
+async def run_usage_compaction():
+    while True:
+        try:
+            await usage_rollup.flush()
+            totals = await db.usage_counters.find_one({"_id": USAGE_TOTALS_ID}, {"_id": 0, "reconciled_at": 1})
+            reconciled_at = (totals or {}).get("reconciled_at")
+            # Skipped when another worker has reconciled within the interval
+            if reconciled_at is None or datetime.utcnow() - reconciled_at >= timedelta(seconds=USAGE_RECONCILE_SECONDS):
+                await compact_daily_usage()
+                await reconcile_usage_totals()
+        except Exception as e:
+            logger.error(f"Usage compaction failed: {e}")
+        await asyncio.sleep(USAGE_RECONCILE_SECONDS)
+
+# Retention and Garbage Collection
+# Sessions and messages past their retention expire through TTL indexes (see MONGO_INDEXES).
+# Documents carry a ref_count of the sessions using them; the GC removes unreferenced ones with
+# their GridFS blobs, and messages left behind by deleted or expired sessions. Session deletes the
+# GC cannot see (TTL expiry, crashes between writes) are caught by a rolling sweep that recounts
+# ref_count from the sessions.
+async def retarget_document_refs(old_ids: List[str], new_ids: List[str]):
+    """Move a session's document references: +1 for newly referenced documents, -1 for dropped ones"""
+    added = [document_id for document_id in new_ids if document_id not in old_ids]
+    removed = [document_id for document_id in old_ids if document_id not in new_ids]
+    if added:
+        await storage.documents.add_refs(added, 1)
+    if removed:
+        await storage.documents.add_refs(removed, -1)
+
+async def stored_bytes(collection, query: Dict[str, Any]) -> int:
+    """BSON size of the documents matching a query"""
+    groups = await collection.aggregate([
+        {"$match": query},
+        {"$group": {"_id": None, "bytes": {"$sum": {"$bsonSize": "$$ROOT"}}}}
+    ]).to_list(1)
+    return groups[0]["bytes"] if groups else 0
+
+async def delete_document(document_id: str) -> int:
+    """Remove a document record with its text blob and original upload; returns the bytes reclaimed"""
+    # Deleting the record first means only one caller goes on to count it and remove its blobs
+    record = await db.documents.find_one_and_delete({"id": document_id})
+    if not record:
+        return 0
+    reclaimed = len(bson.encode(record))
+    for bucket, file_id in ((TEXT_BUCKET, record.get("content_file_id")), (ORIGINALS_BUCKET, record.get("original_file_id"))):
+        if not file_id:
+            continue
+        blob = await db[f"{bucket}.files"].find_one({"_id": file_id}, {"length": 1})
+        try:
+            await gridfs_bucket(bucket).delete(file_id)
+            reclaimed += (blob or {}).get("length", 0)
+        except NoFile:
+            pass  # Already gone
+        except Exception as e:
+            logger.warning(f"Could not delete blob {file_id} from {bucket}: {e}")
+    document_text_cache.discard(document_id)
+    document_search_index.remove(document_id)
+    usage_rollup.record("documents", -1)
+    return reclaimed
+
+class RetentionGC:
+    """Background cleanup of unreferenced documents and orphaned messages.
+    
+    Each pass touches at most `batch_size` items per step and deletes at most
+    `max_deletes_per_second`, so a large backlog is worked off over several passes
+    instead of loading the database all at once. Passes hold the retention-gc lease,
+    so only one worker runs them at a time.
+    """
+    
+    def __init__(self, interval_seconds: float, batch_size: int, max_deletes_per_second: float):
+        self.interval_seconds = interval_seconds
+        self.batch_size = batch_size
+        self.max_deletes_per_second = max_deletes_per_second
+        self.totals = {"passes": 0, "documents_deleted": 0, "messages_deleted": 0, "refs_corrected": 0, "bytes_reclaimed": 0}
+        self.last_pass: Optional[Dict[str, Any]] = None
+        self._document_cursor = ""  # Rolling positions, so successive passes cover the whole collection
+        self._session_cursor = ""
+        self._lock = asyncio.Lock()
+        self._lease = JobLease("retention-gc", 300)
+        self._task: Optional[asyncio.Task] = None
+    
+    async def _pace(self, deleted: int = 1) -> bool:
+        """Wait out the delete rate; False once the lease is lost and the pass should stop"""
+        if self.max_deletes_per_second > 0 and deleted:
+            await asyncio.sleep(deleted / self.max_deletes_per_second)
+        return await self._lease.renew()
+    
+    async def verify_document_refs(self) -> int:
+        """Recount ref_count for the next batch of documents"""
+        records = await db.documents.find(
+            {"id": {"$gt": self._document_cursor}}, {"_id": 0, "id": 1, "ref_count": 1}
+        ).sort("id", ASCENDING).limit(self.batch_size).to_list(self.batch_size)
+        self._document_cursor = records[-1]["id"] if len(records) == self.batch_size else ""
+        corrected = 0
+        for record in records:
+            actual = await db.chat_sessions.count_documents({"document_ids": record["id"]})
+            if actual != record.get("ref_count"):
+                # Only if unchanged since it was read, so a concurrent upload's increment is not overwritten
+                result = await db.documents.update_one(
+                    {"id": record["id"], "ref_count": record.get("ref_count")}, {"$set": {"ref_count": actual}}
+                )
+                corrected += result.modified_count
+        return corrected
+    
+    async def collect_documents(self) -> Tuple[int, int]:
+        """Delete unreferenced documents past the grace period; returns (documents, bytes)"""
+        cutoff = datetime.utcnow() - timedelta(hours=DOCUMENT_GC_GRACE_HOURS)
+        candidates = await db.documents.find(
+            {"ref_count": {"$lte": 0}, "upload_date": {"$lt": cutoff}}, {"_id": 0, "id": 1}
+        ).limit(self.batch_size).to_list(self.batch_size)
+        deleted = reclaimed = 0
+        for record in candidates:
+            # A session may have picked the document up since its count was last checked
+            if await db.chat_sessions.count_documents({"document_ids": record["id"]}, limit=1):
+                continue
+            document_bytes = await delete_document(record["id"])
+            if document_bytes:
+                deleted += 1
+                reclaimed += document_bytes
+            if not await self._pace():
+                break
+        return deleted, reclaimed
     
-    # Save user message
+    async def collect_orphan_messages(self) -> Tuple[int, int]:
+        """Delete messages of sessions that no longer exist, walking session ids along the message index.
+        
+        Messages go in id-limited batches paced like every other delete, at most batch_size per pass;
+        a session with more is picked up again by the next pass.
+        """
+        deleted = reclaimed = 0
+        budget = self.batch_size
+        for _ in range(self.batch_size):
+            message = await db.chat_messages.find_one(
+                {"session_id": {"$gt": self._session_cursor}}, {"_id": 0, "session_id": 1},
+                sort=[("session_id", ASCENDING), ("timestamp", ASCENDING), ("id", ASCENDING)]
+            )
+            if message is None:
+                self._session_cursor = ""
+                break
+            session_id = message["session_id"]
+            if await db.chat_sessions.count_documents({"id": session_id}, limit=1):
+                self._session_cursor = session_id
+                continue
+            ids = [
+                record["id"] for record in await db.chat_messages.find(
+                    {"session_id": session_id}, {"_id": 0, "id": 1}
+                ).limit(budget).to_list(budget)
+            ]
+            batch = {"session_id": session_id, "id": {"$in": ids}}
+            reclaimed += await stored_bytes(db.chat_messages, batch)
+            result = await db.chat_messages.delete_many(batch)
+            deleted += result.deleted_count
+            budget -= len(ids)
+            for message_id in ids:
+                message_search_index.remove(message_id)
+            if not await db.chat_messages.count_documents({"session_id": session_id}, limit=1):
+                # Archive blocks hold many messages each; they count as one delete per block
+                reclaimed += await stored_bytes(db.chat_message_archive, {"session_id": session_id})
+                blocks = await db.chat_message_archive.delete_many({"session_id": session_id})
+                message_search_index.remove_session(session_id)
+                self._session_cursor = session_id
+                if not await self._pace(result.deleted_count + blocks.deleted_count):
+                    break
+            elif not await self._pace(result.deleted_count):
+                break
+            if budget <= 0:
+                break
+        return deleted, reclaimed
+    
+    async def run_pass(self) -> Optional[Dict[str, Any]]:
+        """One GC pass; None when another worker holds the lease"""
+        async with self._lock:
+            if not await self._lease.acquire():
+                return None
+            try:
+                started = time.perf_counter()
+                corrected = await self.verify_document_refs()
+                documents_deleted, document_bytes = await self.collect_documents()
+                messages_deleted, message_bytes = await self.collect_orphan_messages()
+            finally:
+                await self._lease.release()
+            summary = {
+                "documents_deleted": documents_deleted,
+                "messages_deleted": messages_deleted,
+                "refs_corrected": corrected,
+                "bytes_reclaimed": document_bytes + message_bytes,
+                "duration_seconds": round(time.perf_counter() - started, 3),
+                "finished_at": datetime.utcnow()
+            }
+            for key in ("documents_deleted", "messages_deleted", "refs_corrected", "bytes_reclaimed"):
+                self.totals[key] += summary[key]
+            self.totals["passes"] += 1
+            self.last_pass = summary
+            if messages_deleted:
+                usage_rollup.record("messages", -messages_deleted)
+            return summary
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            try:
+                summary = await self.run_pass()
+                if summary and (summary["documents_deleted"] or summary["messages_deleted"]):
+                    logger.info(
+                        f"🧹 Retention GC removed {summary['documents_deleted']} documents and "
+                        f"{summary['messages_deleted']} messages, {summary['bytes_reclaimed']} bytes reclaimed"
+                    )
+            except Exception as e:
+                logger.error(f"Retention GC pass failed: {e}")
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+    
+    def stats(self) -> Dict[str, Any]:
+        return {**self.totals, "last_pass": self.last_pass}
+
+retention_gc = RetentionGC(RETENTION_GC_INTERVAL_SECONDS, RETENTION_GC_BATCH_SIZE, RETENTION_GC_MAX_DELETES_PER_SECOND)
+
+# Full-Text Search
+# Search runs on in-process inverted indexes instead of $regex scans. A worker indexes what it
+# writes right away and picks up other workers' writes by polling Mongo past a timestamp watermark.
+# Hits are re-read from Mongo, so entries deleted elsewhere are dropped at query time.
+SEARCH_TOKEN_PATTERN = re.compile(r"[^\W_]+")  # Words, with underscores as separators as in file names
+SEARCH_PHRASE_PATTERN = re.compile(r'"([^"]*)"')
+SEARCH_POLL_OVERLAP = timedelta(seconds=30)  # Re-scan window for late writes, e.g. write-behind flushes
+
+def search_tokens(text: str) -> List[Tuple[str, int]]:
+    """Lowercased word tokens of a text with their character offsets"""
+    return [(match.group().lower(), match.start()) for match in SEARCH_TOKEN_PATTERN.finditer(text)]
+
+class SearchQuery(NamedTuple):
+    terms: List[str]          # Words that must all appear
+    phrases: List[List[str]]  # Word sequences that must appear consecutively
+
+def parse_search_query(query: str) -> SearchQuery:
+    """Split a query into quoted phrases and loose terms; the input is only tokenized, never used as a pattern"""
+    phrases = []
+    terms = []
+    for quoted in SEARCH_PHRASE_PATTERN.findall(query):
+        words = [token for token, _ in search_tokens(quoted)]
+        if len(words) > 1:
+            phrases.append(words)
+        else:
+            terms.extend(words)
+    terms.extend(token for token, _ in search_tokens(SEARCH_PHRASE_PATTERN.sub(" ", query)))
+    return SearchQuery(list(dict.fromkeys(terms)), phrases)
+
+SEARCH_FIELDS = ("body", "title")
+BM25_K1 = 1.2
+BM25_B = 0.75
+SEARCH_RECENCY_WEIGHT = 0.25  # Share of the score that decays with age; old items keep the rest
+SEARCH_MAX_MATCH_OFFSETS = 64
+SEARCH_SNIPPET_COUNT = 3
+SEARCH_SNIPPET_CHARS = 240
+SEARCH_SNIPPET_LEAD = 60  # Context kept before the first match of a window
+SEARCH_SCORE_CHUNK = 2048  # Candidates filtered per lock hold during a search
+
+class SearchHit(NamedTuple):
+    item_id: str
+    score: float
+    matches: Tuple[int, ...]  # Character offsets of body matches, for snippets
+
+def _index_field(text: str) -> Tuple[Dict[str, array], array]:
+    """Token positions and token character offsets of one field"""
+    positions: Dict[str, array] = {}
+    offsets = array("I")
+    for position, (token, offset) in enumerate(search_tokens(text)):
+        offsets.append(offset)
+        token_positions = positions.get(token)
+        if token_positions is None:
+            token_positions = positions[token] = array("I")
+        token_positions.append(position)
+    return positions, offsets
+
+# Rough per-object costs behind SearchIndex.estimated_bytes(): a posting is a dict slot plus a
+# small array, a position or offset is one 4-byte array item, and each item carries its entry
+# record (term tuples, offsets array, length slots)
+SEARCH_POSTING_BYTES = 150
+SEARCH_POSITION_BYTES = 4
+SEARCH_ITEM_BYTES = 1800
+
+class SearchIndex:
+    """Inverted index per field (body, title) from token to {item id: token positions}, ranked with BM25.
+    
+    Matching is by whole token: a query word matches only the same word, never a substring of one.
+    The index lives in process memory, one copy per worker, built by a full scan at startup.
+    """
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.ready = False
+        self.postings = 0   # (token, item) pairs across fields
+        self.positions = 0  # Stored token positions and character offsets
+        self._size_warned = False
+        self.watermark: Optional[datetime] = None
+        self._postings: Dict[str, Dict[str, Dict[str, array]]] = {field: {} for field in SEARCH_FIELDS}
+        self._lengths: Dict[str, Dict[str, int]] = {field: {} for field in SEARCH_FIELDS}
+        self._total_lengths: Dict[str, int] = {field: 0 for field in SEARCH_FIELDS}
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._session_items: Dict[str, set] = {}
+        self._lock = threading.Lock()
+    
+    def contains(self, item_id: str) -> bool:
+        return item_id in self._entries
+    
+    def version(self, item_id: str) -> Any:
+        entry = self._entries.get(item_id)
+        return entry["version"] if entry else None
+    
+    def session_of(self, item_id: str) -> Optional[str]:
+        entry = self._entries.get(item_id)
+        return entry["session_id"] if entry else None
+    
+    def add(self, item_id: str, text: str, version: Any = None, session_id: Optional[str] = None,
+            title: str = "", updated_at: Optional[datetime] = None):
+        """Index an item, replacing any previous version of it"""
+        # Tokenize outside the lock so large documents do not block searches
+        body_positions, offsets = _index_field(text)
+        title_positions, title_offsets = _index_field(title or "")
+        fields = {"body": (body_positions, len(offsets)), "title": (title_positions, len(title_offsets))}
+        postings_added = len(body_positions) + len(title_positions)
+        positions_added = 2 * len(offsets) + len(title_offsets)
+        
+        with self._lock:
+            self._remove(item_id)
+            for field, (positions, length) in fields.items():
+                postings = self._postings[field]
+                for token, token_positions in positions.items():
+                    postings.setdefault(token, {})[item_id] = token_positions
+                self._lengths[field][item_id] = length
+                self._total_lengths[field] += length
+            self._entries[item_id] = {
+                "version": version,
+                "session_id": session_id,
+                "updated_at": updated_at.timestamp() if updated_at else None,
+                "terms": {field: tuple(positions) for field, (positions, _) in fields.items()},
+                "offsets": offsets,
+                "size": (postings_added, positions_added)
+            }
+            self.postings += postings_added
+            self.positions += positions_added
+            if session_id:
+                self._session_items.setdefault(session_id, set()).add(item_id)
+            oversized = SEARCH_INDEX_WARN_MB and self.estimated_bytes() > SEARCH_INDEX_WARN_MB * 1024 * 1024
+        if oversized and not self._size_warned:
+            self._size_warned = True
+            logger.warning(
+                f"Search index '{self.name}' is about {self.estimated_bytes() / 1024 / 1024:.0f} MB per worker "
+                f"(SEARCH_INDEX_WARN_MB={SEARCH_INDEX_WARN_MB:g})"
+            )
+    
+    def _remove(self, item_id: str):
+        entry = self._entries.pop(item_id, None)
+        if entry is None:
+            return
+        self.postings -= entry["size"][0]
+        self.positions -= entry["size"][1]
+        for field, terms in entry["terms"].items():
+            field_postings = self._postings[field]
+            for term in terms:
+                postings = field_postings.get(term)
+                if postings is not None:
+                    postings.pop(item_id, None)
+                    if not postings:
+                        del field_postings[term]
+            self._total_lengths[field] -= self._lengths[field].pop(item_id, 0)
+        session_items = self._session_items.get(entry["session_id"])
+        if session_items is not None:
+            session_items.discard(item_id)
+            if not session_items:
+                del self._session_items[entry["session_id"]]
+    
+    def remove(self, item_id: str):
+        with self._lock:
+            self._remove(item_id)
+    
+    def remove_session(self, session_id: str):
+        with self._lock:
+            for item_id in list(self._session_items.get(session_id, ())):
+                self._remove(item_id)
+    
+    def _phrase_starts(self, field: str, phrase: List[str], item_id: str) -> List[int]:
+        postings = self._postings[field]
+        if not all(item_id in postings.get(token, ()) for token in phrase):
+            return []
+        following = [set(postings[token][item_id]) for token in phrase[1:]]
+        return [
+            start for start in postings[phrase[0]][item_id]
+            if all(start + distance in positions for distance, positions in enumerate(following, 1))
+        ]
+    
+    def _match_offsets(self, item_id: str, tokens: List[str]) -> Tuple[int, ...]:
+        """Sorted character offsets of query tokens in an item's body"""
+        postings = self._postings["body"]
+        offsets = self._entries[item_id]["offsets"]
+        positions = set()
+        for token in tokens:
+            positions.update(postings.get(token, {}).get(item_id, ()))
+        return tuple(offsets[position] for position in sorted(positions)[:SEARCH_MAX_MATCH_OFFSETS])
+    
+    def search(self, query: SearchQuery, limit: int) -> List[SearchHit]:
+        """Items containing every term and phrase in any field, ranked by BM25 with title boost and recency"""
+        needed = list(query.terms)
+        for phrase in query.phrases:
+            needed.extend(token for token in phrase if token not in needed)
+        if not needed:
+            return []
+        
+        now = datetime.utcnow().timestamp()
+        half_life = SEARCH_RECENCY_HALF_LIFE_DAYS * 86400
+        boosts = {"body": 1.0, "title": SEARCH_TITLE_BOOST}
+        with self._lock:
+            total = len(self._entries)
+            # Per token: (token, [(field, postings, idf, boost, lengths, average length)])
+            token_fields = []
+            for token in needed:
+                fields = []
+                for field in SEARCH_FIELDS:
+                    postings = self._postings[field].get(token)
+                    if postings:
+                        idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+                        average = self._total_lengths[field] / total or 1
+                        fields.append((field, postings, idf, boosts[field], self._lengths[field], average))
+                if not fields:
+                    return []
+                token_fields.append((token, fields))
+            
+            # Walk the rarest token's postings and probe the others
+            token_fields.sort(key=lambda item: sum(len(field[1]) for field in item[1]))
+            rarest = token_fields[0][1]
+            candidates = list(rarest[0][1]) if len(rarest) == 1 else list({
+                item_id for field in rarest for item_id in field[1]
+            })
+        others = [fields for _, fields in token_fields[1:]]
+        probes = [(postings, lengths) for _, fields in token_fields for _, postings, _, _, lengths, _ in fields]
+        weights = [(boost * idf, average) for _, fields in token_fields for _, _, idf, boost, _, average in fields]
+        
+        # Filter and collect term frequencies a chunk at a time under the lock so indexing can
+        # proceed between chunks; items removed meanwhile are skipped. Scoring runs unlocked.
+        scored = []
+        for chunk_start in range(0, len(candidates), SEARCH_SCORE_CHUNK):
+            matched = []
+            with self._lock:
+                for item_id in candidates[chunk_start:chunk_start + SEARCH_SCORE_CHUNK]:
+                    entry = self._entries.get(item_id)
+                    if entry is None:
+                        continue
+                    if not all(any(item_id in field[1] for field in fields) for fields in others):
+                        continue
+                    if query.phrases and not all(
+                        self._phrase_starts("body", phrase, item_id) or self._phrase_starts("title", phrase, item_id)
+                        for phrase in query.phrases
+                    ):
+                        continue
+                    frequencies = [(len(postings.get(item_id, ())), lengths.get(item_id, 0)) for postings, lengths in probes]
+                    matched.append((item_id, entry["updated_at"], frequencies))
+            
+            for item_id, updated_at, frequencies in matched:
+                score = 0.0
+                for (frequency, length), (weight, average) in zip(frequencies, weights):
+                    if frequency:
+                        norm = BM25_K1 * (1 - BM25_B + BM25_B * length / average)
+                        score += weight * frequency * (BM25_K1 + 1) / (frequency + norm)
+                if updated_at is not None:
+                    age = max(0.0, now - updated_at)
+                    score *= 1 - SEARCH_RECENCY_WEIGHT + SEARCH_RECENCY_WEIGHT * 0.5 ** (age / half_life)
+                scored.append((score, item_id))
+        
+        hits = []
+        with self._lock:
+            for score, item_id in heapq.nlargest(limit, scored):
+                if item_id in self._entries:
+                    hits.append(SearchHit(item_id, round(score, 4), self._match_offsets(item_id, needed)))
+        return hits
+    
+    def estimated_bytes(self) -> int:
+        return (len(self._entries) * SEARCH_ITEM_BYTES + self.postings * SEARCH_POSTING_BYTES
+                + self.positions * SEARCH_POSITION_BYTES)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "items": len(self._entries),
+            "terms": len(self._postings["body"]),
+            "title_terms": len(self._postings["title"]),
+            "postings": self.postings,
+            "estimated_mb": round(self.estimated_bytes() / 1024 / 1024, 1),
+            "watermark": self.watermark
+        }
+
+def snippet_windows(matches: Tuple[int, ...], text: str) -> List[Tuple[int, int, List[int]]]:
+    """Pick up to SEARCH_SNIPPET_COUNT non-overlapping windows covering the most matches, in text order"""
+    windows = []
+    index = 0
+    while index < len(matches):
+        start = max(0, matches[index] - SEARCH_SNIPPET_LEAD)
+        end = min(len(text), start + SEARCH_SNIPPET_CHARS)
+        covered = []
+        while index < len(matches) and matches[index] < end:
+            covered.append(matches[index])
+            index += 1
+        distinct = len({match.group().lower() for match in map(partial(SEARCH_TOKEN_PATTERN.match, text), covered) if match})
+        windows.append((distinct, len(covered), -start, start, end, covered))
+    best = heapq.nlargest(SEARCH_SNIPPET_COUNT, windows)
+    return sorted((start, end, covered) for _, _, _, start, end, covered in best)
+
+def build_snippets(text: str, matches: Tuple[int, ...]) -> List[Dict[str, Any]]:
+    """Snippet windows with highlight ranges relative to each snippet"""
+    if not matches:
+        return [{"text": text[:SEARCH_SNIPPET_CHARS], "start": 0, "highlights": []}] if text else []
+    snippets = []
+    for start, end, covered in snippet_windows(matches, text):
+        highlights = []
+        for offset in covered:
+            # Match the token at its indexed offset for its exact end
+            token = SEARCH_TOKEN_PATTERN.match(text, offset)
+            if token:
+                highlights.append([offset - start, min(token.end(), end) - start])
+        snippets.append({"text": text[start:end], "start": start, "highlights": highlights})
+    return snippets
+
+document_search_index = SearchIndex("documents")
+message_search_index = SearchIndex("messages")
+
+def index_messages(messages: List[Dict[str, Any]], titles: Dict[str, str]):
+    """Index messages with the titles of their sessions"""
+    for message in messages:
+        message_search_index.add(
+            message["id"], message["content"],
+            session_id=message["session_id"],
+            title=titles.get(message["session_id"], ""),
+            updated_at=message.get("timestamp")
+        )
+
+def _newer(current: Optional[datetime], candidate: Optional[datetime]) -> Optional[datetime]:
+    if candidate is None:
+        return current
+    return candidate if current is None or candidate > current else current
+
+async def sync_search_indexes():
+    """Index messages and documents written since the last sync, including other workers' writes"""
+    since = message_search_index.watermark
+    newest = since
+    batch = []
+    
+    async def index_batch():
+        titles = await storage.sessions.titles(list({message["session_id"] for message in batch}))
+        await asyncio.to_thread(index_messages, batch, titles)
+    
+    async for message in storage.messages.changed_since(since - SEARCH_POLL_OVERLAP if since else None):
+        newest = _newer(newest, message.get("timestamp"))
+        if not message_search_index.contains(message["id"]):
+            batch.append(message)
+        if len(batch) >= 1000:
+            await index_batch()
+            batch = []
+    if since is None and storage.backend == "mongo":
+        # Archived messages never pass the watermark again, so they are only read on the first sync
+        async for block in db.chat_message_archive.find({}, {"_id": 0, "data": 1, "codec": 1}).batch_size(1):
+            for message in await asyncio.to_thread(decode_message_block, block):
+                if not message_search_index.contains(message["id"]):
+                    batch.append(message)
+            if len(batch) >= 1000:
+                await index_batch()
+                batch = []
+    if batch:
+        await index_batch()
+    message_search_index.watermark = newest
+    message_search_index.ready = True
+    
+    since = document_search_index.watermark
+    newest = since
+    async for record in storage.documents.changed_since(since - SEARCH_POLL_OVERLAP if since else None):
+        # Documents stored before text_updated_at existed are versioned by their upload date
+        version = record.get("text_updated_at") or record.get("upload_date")
+        newest = _newer(newest, record.get("text_updated_at"))
+        if document_search_index.version(record["id"]) != version:
+            text = await load_document_text(record["id"])
+            if text is not None:
+                await asyncio.to_thread(
+                    document_search_index.add, record["id"], text, version,
+                    title=record.get("filename", ""), updated_at=version
+                )
+    document_search_index.watermark = newest or since or datetime(1970, 1, 1)
+    document_search_index.ready = True
+
+async def run_search_index_sync():
+    while True:
+        try:
+            await sync_search_indexes()
+        except Exception as e:
+            logger.error(f"Search index sync failed: {e}")
+        await asyncio.sleep(SEARCH_INDEX_POLL_SECONDS)
+
+# Keyset Pagination
+# Cursors encode the (timestamp, id) of the last item returned, so each page is an index range
+# scan that continues after that item instead of skipping over everything before it.
+def encode_keyset_cursor(position: datetime, item_id: str) -> str:
+    """Opaque cursor pointing just after the item at (position, item_id)"""
+    payload = json.dumps({"at": position.isoformat(), "id": item_id})
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii")
+
+def decode_keyset_cursor(cursor: str) -> Tuple[datetime, str]:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(payload["at"]), str(payload["id"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def position_filter(field: str, position: Tuple[datetime, str], operator: str, inclusive: bool = False,
+                    id_field: str = "id") -> Dict[str, Any]:
+    """Filter selecting the items before ($lt) or after ($gt) the item at (field value, id)"""
+    value, item_id = position
+    return {"$or": [{field: {operator: value}}, {field: value, id_field: {operator + ("e" if inclusive else ""): item_id}}]}
+
+# Session Listing
+SESSION_EXCLUDE_CONTENT = {"_id": 0, "document_content": 0, "pdf_content": 0, "document_outline": 0}
+# True when a session still holds non-empty inline text from before documents were stored by reference
+SESSION_HAS_LEGACY_TEXT = {"$or": [
+    {"$gt": [{"$ifNull": [f"${field}", ""]}, ""]} for field in ("document_content", "pdf_content")
+]}
+SESSION_SUMMARY_PROJECTION = {
+    "_id": 0, "id": 1, "title": 1, "created_at": 1, "updated_at": 1,
+    "document_filename": 1, "document_type": 1, "pdf_filename": 1
+}
+
+# Message Retrieval
+MESSAGE_PROJECTION = {"_id": 0}
+MESSAGE_BATCH_SIZE = 200
+
+def session_messages_filter(session_id: str, feature_type: Optional[str] = None,
+                            after: Optional[Tuple[datetime, str]] = None) -> Dict[str, Any]:
+    query = {"session_id": session_id}
+    if feature_type:
+        query["feature_type"] = feature_type
+    if after:
+        query.update(position_filter("timestamp", after, "$gt"))
+    return query
+
+async def iter_session_messages(session_id: str, feature_type: Optional[str] = None, cursor: Optional[str] = None,
+                                limit: int = 0, analytics: bool = False):
+    """Yield a session's messages oldest first: archived blocks, then the hot collection one batch at a time.
+    
+    The archiver may move messages while this runs, so archived_through is read again after every hot
+    batch is fetched; messages it has moved past the last one yielded are read from the archive instead.
+    """
+    position = decode_keyset_cursor(cursor) if cursor else None
+    await get_session_or_404(session_id)
+    database = analytics_db if analytics else db
+    
+    async def archived_until(through: Tuple[datetime, str]):
+        async for message in iter_archived_messages(session_id, feature_type, position, database):
+            # A block written ahead of archived_through still has its hot copies
+            if (message["timestamp"], message["id"]) > through:
+                return
+            yield message
+    
+    through = await read_archived_position(session_id, database)
+    while True:
+        if through and (position is None or position < through):
+            async for message in archived_until(through):
+                yield message
+                limit -= 1
+                if limit == 0:
+                    return
+            position = through
+        
+        fetched = 0
+        moved = None
+        async for message in storage.messages.iter_session(session_id, feature_type, position, limit, analytics):
+            if fetched % MESSAGE_BATCH_SIZE == 0:
+                moved = await read_archived_position(session_id, database)
+                if moved and (position is None or moved > position):
+                    break  # Archived past what was yielded since the last check; continue from the archive
+            fetched += 1
+            yield message
+            position = (message["timestamp"], message["id"])
+            limit -= 1
+            if limit == 0:
+                return
+        else:
+            return
+        through = moved
+
+async def fetch_chat_history(session_id: str, feature_type: str, limit: int = CHAT_HISTORY_MESSAGES) -> List[Dict[str, str]]:
+    """The last `limit` messages relevant to a feature, oldest first; plain chat sees every feature"""
+    feature_filter = None if feature_type == "chat" else feature_type
+    recent = await storage.messages.recent(session_id, feature_filter, limit)
+    # Read from storage: an archiver run on another worker does not update this worker's cached session
+    if len(recent) < limit and await read_archived_position(session_id):
+        older = await archived_history_tail(session_id, feature_filter, limit - len(recent))
+        recent = [{"role": message["role"], "content": message["content"]} for message in older] + recent
+    if CHAT_WRITE_MODE == "write_behind":
+        # Messages still waiting in the write-behind queue are newer than anything stored
+        pending = chat_write_queue.pending_for(session_id, None if feature_type == "chat" else feature_type)
+        recent = (recent + [{"role": message["role"], "content": message["content"]} for message in pending])[-limit:]
+    return recent
+
+async def stream_messages_json_array(messages):
+    """Serialize messages as one JSON array, item by item"""
+    yield b"["
+    first = True
+    async for message in messages:
+        yield (b"" if first else b",") + dump_json(trusted_row(ChatMessage, message))
+        first = False
+    yield b"]"
+
+async def stream_messages_ndjson(messages):
+    """Serialize messages as newline-delimited JSON, one message per line"""
+    async for message in messages:
+        yield dump_json(trusted_row(ChatMessage, message)) + b"\n"
+
+EXPORT_CHUNK_CHARS = 64 * 1024
+
+async def stream_export_text(session: Dict[str, Any], messages):
+    """Format a plain-text transcript as messages are read, yielding roughly EXPORT_CHUNK_CHARS at a time"""
+    header = f"Chat Session: {session['title']}\nCreated: {session['created_at']}\n"
+    if session.get('pdf_filename'):
+        header += f"PDF: {session['pdf_filename']}\n"
+    yield (header + "\n" + "="*50 + "\n\n").encode('utf-8')
+    
+    parts = []
+    size = 0
+    async for msg in messages:
+        role_label = "User" if msg["role"] == "user" else "Assistant"
+        part = f"[{msg['timestamp']}] {role_label}:\n{msg['content']}\n\n"
+        parts.append(part)
+        size += len(part)
+        if size >= EXPORT_CHUNK_CHARS:
+            yield "".join(parts).encode('utf-8')
+            parts = []
+            size = 0
+    if parts:
+        yield "".join(parts).encode('utf-8')
+
+# Cold Message Archive
+# Old messages of long sessions move into chat_message_archive as compressed blocks of BSON
+# documents, so chat_messages and its indexes only hold recent turns. A session's archive is always
+# a prefix of its history: archived_through on the session holds the (timestamp, id) of the last
+# archived message, and readers take the blocks first, then hot messages after that position.
+# Blocks are written before the hot copies are deleted, so an interrupted run leaves duplicates
+# that readers skip and the next run removes.
+message_archive_status: Dict[str, Any] = {"runs": 0, "sessions": 0, "blocks": 0, "messages": 0, "last_run": None}
+
+def archived_position(session: Dict[str, Any]) -> Optional[Tuple[datetime, str]]:
+    through = session.get("archived_through")
+    return (through["timestamp"], through["id"]) if through else None
+
+async def read_archived_position(session_id: str, database: Optional[AsyncIOMotorDatabase] = None) -> Optional[Tuple[datetime, str]]:
+    """archived_through read from the database; cached sessions miss archiver runs on other workers"""
+    if storage.backend != "mongo":
+        return None  # Only MongoDB storage archives
+    session = await (database or db).chat_sessions.find_one({"id": session_id}, {"_id": 0, "archived_through": 1})
+    return archived_position(session or {})
+
+def encode_message_block(messages: List[Dict[str, Any]]) -> Tuple[bytes, str]:
+    return compress_bytes(b"".join(bson.encode(message) for message in messages))
+
+def decode_message_block(block: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return bson.decode_all(decompress_bytes(block["data"], block["codec"]))
+
+def archive_block_filter(session_id: str, feature_type: Optional[str]) -> Dict[str, Any]:
+    query = {"session_id": session_id}
+    if feature_type:
+        query["feature_types"] = feature_type
+    return query
+
+async def iter_archived_messages(session_id: str, feature_type: Optional[str] = None,
+                                 after: Optional[Tuple[datetime, str]] = None, database: Optional[AsyncIOMotorDatabase] = None):
+    """Yield a session's archived messages oldest first, decompressing one block at a time"""
+    query = archive_block_filter(session_id, feature_type)
+    if after:
+        query.update(position_filter("last_timestamp", after, "$gt", id_field="last_id"))
+    blocks = (database or db).chat_message_archive.find(query, {"_id": 0, "data": 1, "codec": 1}).sort(
+        [("first_timestamp", ASCENDING), ("first_id", ASCENDING)]
+    ).batch_size(1)
+    async for block in blocks:
+        for message in await asyncio.to_thread(decode_message_block, block):
+            if after and (message["timestamp"], message["id"]) <= after:
+                continue
+            if feature_type and message.get("feature_type") != feature_type:
+                continue
+            yield message
+
+async def archived_history_tail(session_id: str, feature_type: Optional[str], count: int) -> List[Dict[str, Any]]:
+    """The newest `count` archived messages of a session, oldest first"""
+    tail: List[Dict[str, Any]] = []
+    blocks = db.chat_message_archive.find(
+        archive_block_filter(session_id, feature_type), {"_id": 0, "data": 1, "codec": 1}
+    ).sort([("first_timestamp", DESCENDING), ("first_id", DESCENDING)]).batch_size(1)
+    async for block in blocks:
+        messages = await asyncio.to_thread(decode_message_block, block)
+        tail[:0] = [message for message in messages if not feature_type or message.get("feature_type") == feature_type]
+        if len(tail) >= count:
+            break
+    return tail[-count:]
+
+async def load_archived_messages(session_ids: List[str], message_ids: List[str],
+                                 database: Optional[AsyncIOMotorDatabase] = None) -> Dict[str, Dict[str, Any]]:
+    """Archived messages by id, looked up through their sessions' blocks"""
+    wanted = set(message_ids)
+    found = {}
+    async for block in (database or db).chat_message_archive.find(
+        {"session_id": {"$in": session_ids}, "ids": {"$in": message_ids}}, {"_id": 0, "data": 1, "codec": 1}
+    ):
+        for message in await asyncio.to_thread(decode_message_block, block):
+            if message["id"] in wanted:
+                found[message["id"]] = message
+    return found
+
+async def write_archive_block(session_id: str, messages: List[Dict[str, Any]]):
+    data, codec = await asyncio.to_thread(encode_message_block, messages)
+    first, last = messages[0], messages[-1]
+    await db.chat_message_archive.replace_one({"_id": f"{session_id}:{first['id']}"}, {
+        "session_id": session_id,
+        "first_timestamp": first["timestamp"],
+        "first_id": first["id"],
+        "last_timestamp": last["timestamp"],
+        "last_id": last["id"],
+        "count": len(messages),
+        "feature_types": sorted({message.get("feature_type") or "chat" for message in messages}),
+        "features": dict(Counter(usage_feature_key(message.get("feature_type")) for message in messages)),
+        "ids": [message["id"] for message in messages],
+        "codec": codec,
+        "data": data,
+        "archived_at": datetime.utcnow()
+    }, upsert=True)
+    through = {"timestamp": last["timestamp"], "id": last["id"]}
+    await update_session(session_id, {"$set": {"archived_through": through}, "$inc": {"archived_count": len(messages)}})
+    await db.chat_messages.delete_many(
+        {"session_id": session_id, **position_filter("timestamp", (through["timestamp"], through["id"]), "$lt", inclusive=True)}
+    )
+
+async def archive_session_messages(session: Dict[str, Any]) -> int:
+    """Move the archivable prefix of a session's hot messages into full blocks; returns messages moved.
+    
+    A message is archivable when it is older than MESSAGE_ARCHIVE_AFTER_DAYS or beyond the newest
+    MESSAGE_ARCHIVE_KEEP_RECENT. The newest CHAT_HISTORY_MESSAGES always stay hot for prompts, and
+    only full blocks are written, so short sessions are never archived.
+    """
+    session_id = session["id"]
+    through = archived_position(session)
+    if through:
+        # Hot copies left behind by an interrupted run
+        await db.chat_messages.delete_many(
+            {"session_id": session_id, **position_filter("timestamp", through, "$lt", inclusive=True)}
+        )
+    total = await db.chat_messages.count_documents({"session_id": session_id})
+    if total < CHAT_HISTORY_MESSAGES + MESSAGE_ARCHIVE_BLOCK_SIZE:
+        return 0
+    
+    cutoff = datetime.utcnow() - timedelta(days=MESSAGE_ARCHIVE_AFTER_DAYS) if MESSAGE_ARCHIVE_AFTER_DAYS > 0 else None
+    moved = 0
+    block = []
+    messages = db.chat_messages.find({"session_id": session_id}, MESSAGE_PROJECTION).sort(
+        [("timestamp", ASCENDING), ("id", ASCENDING)]
+    ).batch_size(MESSAGE_ARCHIVE_BLOCK_SIZE)
+    async for message in messages:
+        newer = total - 1 - moved - len(block)  # Messages newer than this one
+        if newer < CHAT_HISTORY_MESSAGES:
+            break
+        old = cutoff is not None and message["timestamp"] < cutoff
+        excess = MESSAGE_ARCHIVE_KEEP_RECENT > 0 and newer >= MESSAGE_ARCHIVE_KEEP_RECENT
+        if not (old or excess):
+            break
+        block.append(message)
+        if len(block) == MESSAGE_ARCHIVE_BLOCK_SIZE:
+            await write_archive_block(session_id, block)
+            message_archive_status["blocks"] += 1
+            moved += len(block)
+            block = []
+    return moved
+
+message_archive_lease = JobLease("message-archiver", 300)
+
+async def archive_cold_messages() -> Dict[str, Any]:
+    """Archive old messages of every session, on whichever worker holds the archiver lease"""
+    if not await message_archive_lease.acquire():
+        return message_archive_status
+    try:
+        async for session in db.chat_sessions.find({}, {"_id": 0, "id": 1, "archived_through": 1}):
+            moved = await archive_session_messages(session)
+            if moved:
+                message_archive_status["sessions"] += 1
+                message_archive_status["messages"] += moved
+            if not await message_archive_lease.renew():
+                break  # Taken over by another worker
+    finally:
+        await message_archive_lease.release()
+    message_archive_status["runs"] += 1
+    message_archive_status["last_run"] = datetime.utcnow()
+    return message_archive_status
+
+async def run_message_archiver():
+    while True:
+        await asyncio.sleep(MESSAGE_ARCHIVE_INTERVAL_SECONDS)
+        try:
+            await archive_cold_messages()
+        except Exception as e:
+            logger.error(f"Message archiving failed: {e}")
+
+# Database Indexes
+# Every hot query filters or sorts on these fields; creating an index that already exists is a no-op,
+# so they are ensured on every startup.
+def ttl_options(days: float) -> Dict[str, Any]:
+    """Index options expiring documents `days` after the indexed date; no expiry when days is 0"""
+    return {"expireAfterSeconds": int(days * 86400)} if days > 0 else {}
+
+MONGO_INDEXES: Dict[str, List[Tuple[List[Tuple[str, int]], Dict[str, Any]]]] = {
+    "chat_sessions": [
+        ([("id", ASCENDING)], {"unique": True}),
+        ([("updated_at", DESCENDING), ("id", DESCENDING)], {}),
+        ([("document_ids", ASCENDING)], {}),
+        ([("updated_at", ASCENDING)], ttl_options(SESSION_RETENTION_DAYS)),
+    ],
+    "chat_messages": [
+        ([("session_id", ASCENDING), ("timestamp", ASCENDING), ("id", ASCENDING)], {}),
+        ([("session_id", ASCENDING), ("feature_type", ASCENDING), ("timestamp", ASCENDING), ("id", ASCENDING)], {}),
+        ([("id", ASCENDING)], {}),
+        ([("timestamp", ASCENDING)], ttl_options(MESSAGE_RETENTION_DAYS)),
+    ],
+    "documents": [
+        ([("id", ASCENDING)], {"unique": True}),
+        ([("batch_id", ASCENDING)], {}),
+        ([("text_updated_at", ASCENDING)], {}),
+        ([("ref_count", ASCENDING), ("upload_date", ASCENDING)], {}),
+    ],
+    "chat_message_archive": [
+        ([("session_id", ASCENDING), ("first_timestamp", ASCENDING), ("first_id", ASCENDING)], {}),
+        ([("last_timestamp", ASCENDING)], ttl_options(MESSAGE_RETENTION_DAYS)),
+    ],
+}
+
+# Representative query of each endpoint, checked with explain() by /system-health/indexes
+INDEXED_QUERIES = [
+    {"endpoint": "GET /sessions/{id}", "collection": "chat_sessions", "filter": {"id": "sample"}},
+    {"endpoint": "GET /sessions", "collection": "chat_sessions", "filter": {}, "sort": [("updated_at", DESCENDING)]},
+    {"endpoint": "GET /sessions/summary", "collection": "chat_sessions",
+     "filter": {"$or": [{"updated_at": {"$lt": datetime(2000, 1, 1)}}, {"updated_at": datetime(2000, 1, 1), "id": {"$lt": "sample"}}]},
+     "sort": [("updated_at", DESCENDING), ("id", DESCENDING)]},
+    {"endpoint": "POST /documents/{id}/reextract", "collection": "chat_sessions", "filter": {"document_ids": "sample"}},
+    {"endpoint": "GET /sessions/{id}/messages", "collection": "chat_messages",
+     "filter": {"session_id": "sample"}, "sort": [("timestamp", ASCENDING), ("id", ASCENDING)]},
+    {"endpoint": "GET /sessions/{id}/messages?feature_type", "collection": "chat_messages",
+     "filter": {"session_id": "sample", "feature_type": "chat"}, "sort": [("timestamp", ASCENDING), ("id", ASCENDING)]},
+    {"endpoint": "POST /sessions/{id}/messages (history)", "collection": "chat_messages",
+     "filter": {"session_id": "sample", "feature_type": "research"}, "sort": [("timestamp", DESCENDING), ("id", DESCENDING)]},
+    {"endpoint": "load document text", "collection": "documents", "filter": {"id": "sample"}},
+    {"endpoint": "batch sessions", "collection": "documents", "filter": {"batch_id": "sample"}},
+    {"endpoint": "POST /search (message hits)", "collection": "chat_messages", "filter": {"id": {"$in": ["sample"]}}},
+    {"endpoint": "POST /search (session titles)", "collection": "chat_sessions", "filter": {"id": {"$in": ["sample"]}}},
+    {"endpoint": "search index sync (messages)", "collection": "chat_messages", "filter": {"timestamp": {"$gte": datetime(2000, 1, 1)}}},
+    {"endpoint": "search index sync (documents)", "collection": "documents", "filter": {"text_updated_at": {"$gte": datetime(2000, 1, 1)}}},
+    {"endpoint": "GET /sessions/{id}/messages (archive)", "collection": "chat_message_archive",
+     "filter": {"session_id": "sample"}, "sort": [("first_timestamp", ASCENDING), ("first_id", ASCENDING)]},
+    {"endpoint": "retention GC (documents)", "collection": "documents",
+     "filter": {"ref_count": {"$lte": 0}, "upload_date": {"$lt": datetime(2000, 1, 1)}}},
+    {"endpoint": "retention GC (orphan messages)", "collection": "chat_messages",
+     "filter": {"session_id": {"$gt": "sample"}}, "sort": [("session_id", ASCENDING), ("timestamp", ASCENDING), ("id", ASCENDING)]},
+]
+
+index_status: Dict[str, Any] = {"ensured": False, "indexes": [], "errors": []}
+
+async def replace_index_options(collection_name: str, keys: List[Tuple[str, int]], options: Dict[str, Any]) -> str:
+    """Bring an existing index with the same keys to the wanted options, e.g. after a retention change"""
+    name = "_".join(f"{field}_{direction}" for field, direction in keys)
+    if "expireAfterSeconds" in options:
+        try:
+            await db.command("collMod", collection_name, index={
+                "keyPattern": dict(keys), "expireAfterSeconds": options["expireAfterSeconds"]
+            })
+            return name
+        except OperationFailure:
+            pass  # Servers before 5.1 cannot add a TTL to a plain index in place
+    await db[collection_name].drop_index(name)
+    return await db[collection_name].create_index(keys, **options)
+
+async def ensure_indexes() -> Dict[str, Any]:
+    """Create the indexes in MONGO_INDEXES, one at a time so a conflict only skips that index"""
+    ensured = []
+    errors = []
+    # Replacing an index drops it first, so only the worker holding this lease changes options
+    lease = JobLease("index-options", 300)
+    leased: Optional[bool] = None
+    try:
+        for collection_name, indexes in MONGO_INDEXES.items():
+            for keys, options in indexes:
+                try:
+                    try:
+                        name = await db[collection_name].create_index(keys, **options)
+                    except OperationFailure as e:
+                        if e.code not in (85, 86):  # IndexOptionsConflict, IndexKeySpecsConflict
+                            raise
+                        if leased is None:
+                            leased = await lease.acquire()
+                        if not leased:
+                            raise RuntimeError("Another worker is changing index options; retried on the next startup")
+                        name = await replace_index_options(collection_name, keys, options)
+                    ensured.append(f"{collection_name}.{name}")
+                except Exception as e:
+                    # e.g. duplicate ids in legacy data block a unique index, or an index with other options exists
+                    errors.append({"collection": collection_name, "keys": keys, "error": str(e)})
+    finally:
+        if leased:
+            await lease.release()
+    index_status.update({"ensured": True, "indexes": ensured, "errors": errors, "checked_at": datetime.utcnow()})
+    return index_status
+
+async def run_ensure_indexes():
+    try:
+        status = await ensure_indexes()
+        logger.info(f"🗂️  Indexes ensured: {len(status['indexes'])} ok, {len(status['errors'])} failed")
+        for error in status["errors"]:
+            logger.error(f"Could not create index {error['collection']} {error['keys']}: {error['error']}")
+    except Exception as e:
+        logger.error(f"Index provisioning failed: {e}")
+
+def _plan_stages(plan: Any) -> Tuple[List[str], List[str]]:
+    """Stage names and index names found anywhere in an explain() plan tree"""
+    stages, index_names = [], []
+    pending = [plan]
+    while pending:
+        node = pending.pop()
+        if isinstance(node, dict):
+            if "stage" in node:
+                stages.append(node["stage"])
+            if "indexName" in node:
+                index_names.append(node["indexName"])
+            pending.extend(node.values())
+        elif isinstance(node, list):
+            pending.extend(node)
+    return stages, index_names
+
+async def explain_indexed_queries() -> List[Dict[str, Any]]:
+    """Run explain() on each endpoint query and report whether its winning plan uses an index"""
+    results = []
+    for check in INDEXED_QUERIES:
+        cursor = db[check["collection"]].find(check["filter"]).limit(1)
+        if check.get("sort"):
+            cursor = cursor.sort(check["sort"])
+        try:
+            explanation = await cursor.explain()
+        except Exception as e:
+            results.append({"endpoint": check["endpoint"], "collection": check["collection"], "error": str(e)})
+            continue
+        stages, index_names = _plan_stages(explanation.get("queryPlanner", {}).get("winningPlan", {}))
+        results.append({
+            "endpoint": check["endpoint"],
+            "collection": check["collection"],
+            "uses_index": "COLLSCAN" not in stages,
+            "stages": stages,
+            "indexes": index_names
+        })
+    return results
+
+# Batch Upload Functions
+class MultipartFileStream:
+    """Incremental multipart/form-data parser that collects file parts as the body streams in.
+    
+    Completed files are queued in `completed` as (filename, content, error) tuples; the caller
+    drains the queue between body chunks, so only files that are still being received or
+    waiting for an extraction worker are held in memory. `file_count` counts file parts as soon
+    as their headers arrive, so a caller can stop reading before an extra file is buffered.
+    """
+    
+    def __init__(self, content_type: str, max_file_bytes: int):
+        _, params = parse_options_header(content_type)
+        boundary = params.get(b"boundary")
+        if not boundary:
+            raise HTTPException(status_code=400, detail="Missing multipart boundary")
+        
+        self.max_file_bytes = max_file_bytes
+        self.completed: List[Tuple[str, bytes, Optional[str]]] = []
+        self.file_count = 0
+        self._header_field = b""
+        self._header_value = b""
+        self._headers: Dict[bytes, bytes] = {}
+        self._filename: Optional[str] = None
+        self._buffer: Optional[io.BytesIO] = None
+        self._size = 0
+        self._parser = MultipartParser(boundary, {
+            "on_part_begin": self._on_part_begin,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+        })
+    
+    def write(self, chunk: bytes):
+        try:
+            self._parser.write(chunk)
+        except MultipartParseError as e:
+            raise HTTPException(status_code=400, detail=f"Malformed multipart body: {e}")
+    
+    def finalize(self):
+        try:
+            self._parser.finalize()
+        except MultipartParseError as e:
+            raise HTTPException(status_code=400, detail=f"Malformed multipart body: {e}")
+    
+    def _on_part_begin(self):
+        self._headers = {}
+        self._filename = None
+        self._buffer = None
+        self._size = 0
+    
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+    
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+    
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+    
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        filename = options.get(b"filename")
+        if filename is not None:
+            # Plain form fields are ignored; only parts carrying a filename are files
+            self._filename = filename.decode("utf-8", errors="replace")
+            self._buffer = io.BytesIO()
+            self.file_count += 1
+    
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if self._buffer is None:
+            return
+        self._size += end - start
+        if self._size > self.max_file_bytes:
+            # Stop buffering oversized files; the part is reported as failed
+            self._buffer = io.BytesIO()
+            return
+        self._buffer.write(data[start:end])
+    
+    def _on_part_end(self):
+        if self._filename is None:
+            return
+        if self._size > self.max_file_bytes:
+            error = f"File exceeds the {self.max_file_bytes // (1024 * 1024)} MB upload limit"
+            self.completed.append((self._filename, b"", error))
+        else:
+            self.completed.append((self._filename, self._buffer.getvalue(), None))
+        self._buffer = None
+        self._filename = None
+
+def combine_batch_documents(extracted: Iterable[Tuple[str, str, List[Dict[str, Any]]]]) -> Tuple[str, List[Dict[str, Any]]]:
+    """Concatenate extracted documents into one text with a top-level outline entry per file.
+    
+    `extracted` may be a generator, so callers can hand over each text as it is consumed.
+    """
+    parts = []
+    outline = []
+    offset = 0
+    for filename, text, file_outline in extracted:
+        header = f"=== {filename} ===\n"
+        section = header + text + "\n\n"
+        outline.append({"title": filename, "level": 0, "start": offset})
+        for entry in file_outline:
+            outline.append({
+                "title": entry["title"],
+                "level": entry["level"] + 1,
+                "start": offset + len(header) + entry["start"]
+            })
+        parts.append(section)
+        offset += len(section)
+    
+    combined = "".join(parts)
+    return _strip_with_outline(combined, outline)
+
+def attachment_disposition(filename: str) -> str:
+    """Content-Disposition for a download: an ASCII-safe filename plus the exact name as RFC 5987 filename*"""
+    ascii_name = unicodedata.normalize("NFKD", filename).encode("ascii", "ignore").decode("ascii")
+    ascii_name = re.sub(r'[^A-Za-z0-9 ._()-]', "_", ascii_name).strip()
+    stem, dot, extension = ascii_name.rpartition(".")
+    if not dot:
+        stem, extension = ascii_name, ""
+    if not stem.strip("._ "):
+        ascii_name = f"download.{extension}" if extension else "download"
+    return f'attachment; filename="{ascii_name}"; filename*=UTF-8\'\'{quote(filename, safe="")}'
+
+# API Routes
+@api_router.post("/sessions", response_model=ChatSession)
+async def create_session(request: CreateSessionRequest):
+    session = ChatSession(
+        title=request.title
+    )
+    await storage.sessions.insert(session.dict())
+    usage_rollup.record("sessions", at=session.created_at)
+    return session
+
+@api_router.get("/sessions", response_model=List[ChatSession])
+async def get_sessions():
+    sessions = await storage.sessions.list_recent(100)
+    return FastJSONResponse(trusted_rows(ChatSession, sessions))
+
+@api_router.get("/sessions/summary", response_model=SessionPage)
+async def get_session_summaries(limit: int = Query(50, ge=1, le=200), cursor: Optional[str] = None):
+    """List sessions newest first, one page at a time, without loading any document data"""
+    sessions = await storage.sessions.page(decode_keyset_cursor(cursor) if cursor else None, limit + 1)
+    
+    next_cursor = None
+    if len(sessions) > limit:
+        sessions = sessions[:limit]
+        next_cursor = encode_keyset_cursor(sessions[-1]["updated_at"], sessions[-1]["id"])
+    return FastJSONResponse({"sessions": trusted_rows(SessionSummary, sessions), "next_cursor": next_cursor})
+
+@api_router.get("/supported-formats")
+async def get_supported_formats():
+    """Get list of supported document formats"""
+    return {
+        "supported_formats": get_supported_file_types(),
+        "message": "Supported document formats for upload"
+    }
+
+@api_router.post("/sessions/{session_id}/upload-document")
+async def upload_document(session_id: str, file: UploadFile = File(...), pdf_engine: Optional[str] = None):
+    # Verify session exists
+    session = await get_session_or_404(session_id)
+    
+    # Validate file type
+    if not is_supported_file_type(file.filename):
+        supported_types = ", ".join(get_supported_file_types())
+        raise HTTPException(
+            status_code=400, 
+            detail=f"Unsupported file type. Supported formats: {supported_types}"
+        )
+    
+    # Read and process document
+    file_content = await file.read()
+    document_text, outline = await extract_document(file_content, file.filename, pdf_engine)
+    
+    # Get file type
+    file_type = file.filename.lower().split('.')[-1]
+    
+    # Save document
+    document = await save_document(
+        filename=file.filename,
+        text=document_text,
+        file_size=len(file_content),
+        file_type=file_type,
+        outline=outline,
+        original=file_content
+    )
+    
+    # Update session with a reference to the document (both new and old fields for compatibility)
+    await update_session(session_id, {
+        "$set": {
+            "document_filename": file.filename,
+            "document_type": file_type,
+            "document_ids": [document.id],
+            "document_batch_id": None,
+            # Keep old fields for backward compatibility
+            "pdf_filename": file.filename,
+            "updated_at": datetime.utcnow()
+        },
+        "$unset": {"document_content": "", "pdf_content": "", "document_outline": ""}
+    })
+    await retarget_document_refs(session.get("document_ids") or [], [document.id])
+    
+    return {
+        "message": "Document uploaded successfully",
+        "filename": file.filename,
+        "file_type": file_type,
+        "content_length": len(document_text),
+        "chapter_count": len(outline)
+    }
+
+@api_router.post("/sessions/{session_id}/upload-documents")
+async def upload_documents(session_id: str, request: Request, pdf_engine: Optional[str] = None):
+    """Upload many documents in one multipart request and extract them concurrently"""
+    # Verify session exists
+    session = await get_session_or_404(session_id)
+    
+    content_type = request.headers.get("content-type", "")
+    if not content_type.startswith("multipart/form-data"):
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data request")
+    if pdf_engine:
+        resolve_pdf_engine(pdf_engine)  # Reject unknown engines before reading the body
+    
+    batch_id = str(uuid.uuid4())
+    stream = MultipartFileStream(content_type, UPLOAD_MAX_FILE_BYTES)
+    worker_slots = asyncio.Semaphore(EXTRACTION_WORKERS)
+    tasks = []
+    
+    async def process_file(filename: str, file_content: bytes) -> Dict[str, Any]:
+        try:
+            if not is_supported_file_type(filename):
+                supported_types = ", ".join(get_supported_file_types())
+                raise HTTPException(status_code=400, detail=f"Unsupported file type. Supported formats: {supported_types}")
+            
+            document_text, outline = await extract_document(file_content, filename, pdf_engine)
+            file_type = filename.lower().split('.')[-1]
+            document = await save_document(
+                filename=filename,
+                text=document_text,
+                file_size=len(file_content),
+                file_type=file_type,
+                outline=outline,
+                batch_id=batch_id,
+                original=file_content
+            )
+            return {
+                "filename": filename,
+                "status": "success",
+                "document_id": document.id,
+                "file_type": file_type,
+                "content_length": len(document_text),
+                "chapter_count": len(outline),
+                "_text": document_text,
+                "_outline": outline
+            }
+        except HTTPException as e:
+            return {"filename": filename, "status": "error", "error": e.detail}
+        except Exception as e:
+            logger.error(f"Batch upload failed for {filename}: {e}")
+            return {"filename": filename, "status": "error", "error": str(e)}
+        finally:
+            worker_slots.release()
+    
+    async def reject_file(filename: str, error: str) -> Dict[str, Any]:
+        return {"filename": filename, "status": "error", "error": error}
+    
+    async def drain_completed():
+        for filename, file_content, error in stream.completed:
+            if error:
+                tasks.append(asyncio.create_task(reject_file(filename, error)))
+                continue
+            # Wait for a free worker before reading more of the body
+            await worker_slots.acquire()
+            tasks.append(asyncio.create_task(process_file(filename, file_content)))
+        stream.completed.clear()
+    
+    try:
+        async for chunk in request.stream():
+            stream.write(chunk)
+            if stream.file_count > BATCH_UPLOAD_MAX_FILES:
+                # Stop reading the body; documents already saved are left to the retention GC
+                raise HTTPException(status_code=413, detail=f"Batch limit of {BATCH_UPLOAD_MAX_FILES} files exceeded")
+            await drain_completed()
+        stream.finalize()
+        await drain_completed()
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    
+    if not tasks:
+        raise HTTPException(status_code=400, detail="No files found in upload")
+    
+    results = await asyncio.gather(*tasks)
+    succeeded = [result for result in results if result["status"] == "success"]
+    
+    if not succeeded:
+        raise HTTPException(status_code=400, detail={
+            "message": "None of the uploaded files could be processed",
+            "results": results
+        })
+    
+    # Pop each text as it is combined so the extracted copies are released one by one
+    combined_text, combined_outline = combine_batch_documents(
+        (result["filename"], result.pop("_text"), result.pop("_outline")) for result in succeeded
+    )
+    document_text_cache.put(f"batch:{batch_id}", combined_text)
+    
+    # Update session with references to the documents (both new and old fields for compatibility)
+    batch_filename = succeeded[0]["filename"] if len(succeeded) == 1 else f"{len(succeeded)} documents"
+    await update_session(session_id, {
+        "$set": {
+            "document_filename": batch_filename,
+            "document_type": succeeded[0]["file_type"] if len(succeeded) == 1 else "batch",
+            "document_ids": [result["document_id"] for result in succeeded],
+            "document_batch_id": batch_id,
+            # Keep old fields for backward compatibility
+            "pdf_filename": batch_filename,
+            "updated_at": datetime.utcnow()
+        },
+        "$unset": {"document_content": "", "pdf_content": "", "document_outline": ""}
+    })
+    await retarget_document_refs(session.get("document_ids") or [], [result["document_id"] for result in succeeded])
+    
+    return {
+        "message": f"Processed {len(results)} files ({len(succeeded)} succeeded, {len(results) - len(succeeded)} failed)",
+        "batch_id": batch_id,
+        "total_files": len(results),
+        "succeeded": len(succeeded),
+        "failed": len(results) - len(succeeded),
+        "content_length": len(combined_text),
+        "chapter_count": len(combined_outline),
+        "results": results
+    }
+
+# Keep the old PDF upload endpoint for backward compatibility
+@api_router.post("/sessions/{session_id}/upload-pdf")
+async def upload_pdf(session_id: str, file: UploadFile = File(...), pdf_engine: Optional[str] = None):
+    # Verify session exists
+    session = await get_session_or_404(session_id)
+    
+    # Validate file type
+    if not file.filename.lower().endswith('.pdf'):
+        raise HTTPException(status_code=400, detail="Only PDF files are allowed")
+    
+    # Read and process PDF
+    file_content = await file.read()
+    pdf_text, outline = await extract_document(file_content, file.filename, pdf_engine)
+    
+    # Save PDF document
+    pdf_doc = await save_document(
+        filename=file.filename,
+        text=pdf_text,
+        file_size=len(file_content),
+        file_type="pdf",
+        outline=outline,
+        original=file_content
+    )
+    
+    # Update session with PDF info
+    await update_session(session_id, {
+        "$set": {
+            "document_filename": file.filename,
+            "document_type": "pdf",
+            "document_ids": [pdf_doc.id],
+            "document_batch_id": None,
+            "pdf_filename": file.filename,
+            "updated_at": datetime.utcnow()
+        },
+        "$unset": {"document_content": "", "pdf_content": "", "document_outline": ""}
+    })
+    await retarget_document_refs(session.get("document_ids") or [], [pdf_doc.id])
+    
+    return {
+        "message": "PDF uploaded successfully",
+        "filename": file.filename,
+        "file_type": "pdf",
+        "content_length": len(pdf_text)
+    }
+
+@api_router.get("/documents/{document_id}/original")
+async def download_original_document(document_id: str):
+    """Stream the originally uploaded file back from GridFS"""
+    record = await storage.documents.get(document_id, ("filename", "original_file_id", "file_size"))
+    if not record:
+        raise HTTPException(status_code=404, detail="Document not found")
+    if not record.get("original_file_id"):
+        raise HTTPException(status_code=404, detail="Original file was not stored for this document")
+    
+    media_type = mimetypes.guess_type(record["filename"])[0] or "application/octet-stream"
+    return StreamingResponse(
+        storage.documents.iter_blob(ORIGINALS_BUCKET, record["original_file_id"]),
+        media_type=media_type,
+        headers={
+            "Content-Disposition": attachment_disposition(record["filename"]),
+            "Content-Length": str(record["file_size"])
+        }
+    )
+
+@api_router.post("/documents/{document_id}/reextract")
+async def reextract_document(document_id: str, pdf_engine: Optional[str] = None):
+    """Re-run extraction on the stored original file, e.g. after an extractor fix"""
+    record = await storage.documents.get(document_id, ("filename", "original_file_id"))
+    if not record:
+        raise HTTPException(status_code=404, detail="Document not found")
+    if not record.get("original_file_id"):
+        raise HTTPException(status_code=400, detail="Original file was not stored for this document; upload it again")
+    
+    chunks = [chunk async for chunk in storage.documents.iter_blob(ORIGINALS_BUCKET, record["original_file_id"])]
+    file_content = b"".join(chunks)
+    document_text, outline = await extract_document(file_content, record["filename"], pdf_engine)
+    await replace_document_text(document_id, document_text, outline)
+    
+    return {
+        "message": "Document re-extracted successfully",
+        "document_id": document_id,
+        "filename": record["filename"],
+        "content_length": len(document_text),
+        "chapter_count": len(outline)
+    }
+
+@api_router.post("/sessions/{session_id}/messages")
+async def send_message(session_id: str, request: SendMessageRequest, background_tasks: BackgroundTasks):
+    # Verify session exists
+    session = await get_session_or_404(session_id)
+    
+    # The user message is saved together with the reply at the end of the turn
     user_message = ChatMessage(
         session_id=session_id,
         content=request.content,
         role="user",
         feature_type=request.feature_type
     )
-    await db.chat_messages.insert_one(user_message.dict())
     
-    # Get chat history
-    messages_cursor = db.chat_messages.find({"session_id": session_id}).sort("timestamp", 1)
-    chat_history = await messages_cursor.to_list(100)
+    # Get the recent history this feature sees, ending with the new user message
+    chat_history = await fetch_chat_history(session_id, request.feature_type, CHAT_HISTORY_MESSAGES - 1)
+    chat_history.append({"role": "user", "content": request.content})
     
     # Prepare messages for AI based on feature type
     ai_messages = []
@@ -1636,7 +5227,7 @@ async def send_message(session_id: str, request: SendMessageRequest):
     else:
         # Document-based features
         # Check for document content (prioritize new fields, fall back to old)
-        document_content = session.get("document_content") or session.get("pdf_content")
+        document_content = await load_session_document_text(session)
         document_filename = session.get("document_filename") or session.get("pdf_filename")
         document_type = session.get("document_type") or "pdf"
         
@@ -1691,59 +5282,98 @@ Please answer questions based on this document content. Be specific and referenc
             })
     
     # Add recent conversation history
-    for msg in chat_history[-10:]:  # Last 10 messages for context
-        if msg["feature_type"] == request.feature_type or request.feature_type == "chat":
-            ai_messages.append({
-                "role": msg["role"],
-                "content": msg["content"]
-            })
+    ai_messages.extend(chat_history)
     
     # Get AI response
     ai_response = await get_ai_response(ai_messages, request.model)
     
-    # Save AI message
+    # Build AI message
     ai_message = ChatMessage(
         session_id=session_id,
         content=ai_response,
         role="assistant",
         feature_type=request.feature_type
     )
-    await db.chat_messages.insert_one(ai_message.dict())
     
-    # Update session timestamp
-    await db.chat_sessions.update_one(
-        {"id": session_id},
-        {"$set": {"updated_at": datetime.utcnow()}}
-    )
+    # Save both messages and bump the session timestamp in one batched write
+    await persist_chat_messages(session, [user_message, ai_message], background_tasks)
     
     return {"ai_response": ai_message}
 
+@api_router.get("/sessions/{session_id}/outline")
+async def get_document_outline(session_id: str):
+    """Get the chapter list of the session's document"""
+    session = await get_session_or_404(session_id)
+    
+    outline = await get_session_outline(session)
+    return {
+        "session_id": session_id,
+        "document_filename": session.get("document_filename") or session.get("pdf_filename"),
+        "chapters": [
+            {
+                "title": entry["title"],
+                "level": entry["level"],
+                "start": entry["start"],
+                "end": entry["end"],
+                "length": entry["end"] - entry["start"]
+            }
+            for entry in outline
+        ]
+    }
+
 @api_router.delete("/sessions/{session_id}")
 async def delete_session(session_id: str):
     # Delete session
-    result = await db.chat_sessions.delete_one({"id": session_id})
-    if result.deleted_count == 0:
+    session = await storage.sessions.delete(session_id)
+    session_cache.invalidate(session_id)
+    message_search_index.remove_session(session_id)
+    if session is None:
         raise HTTPException(status_code=404, detail="Session not found")
+    # Documents no other session uses are left to the retention GC
+    await retarget_document_refs(session.get("document_ids") or [], [])
     
     # Delete associated messages
-    await db.chat_messages.delete_many({"session_id": session_id})
+    deleted = await storage.messages.delete_session(session_id)
+    usage_rollup.record("sessions", -1)
+    usage_rollup.record("messages", -deleted)  # Per-feature counts catch up at the next reconcile
     
     return {"message": "Session deleted successfully"}
 
 @api_router.get("/sessions/{session_id}/messages", response_model=List[ChatMessage])
 async def get_messages(session_id: str, feature_type: Optional[str] = Query(None)):
+    """All messages of a session as a JSON array, streamed from the cursor without a cap"""
     # Verify session exists
-    session = await db.chat_sessions.find_one({"id": session_id})
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
+    await get_session_or_404(session_id)
     
-    # Build query
-    query = {"session_id": session_id}
-    if feature_type:
-        query["feature_type"] = feature_type
-    
-    messages = await db.chat_messages.find(query).sort("timestamp", 1).to_list(1000)
-    return [ChatMessage(**message) for message in messages]
+    return StreamingResponse(
+        stream_messages_json_array(iter_session_messages(session_id, feature_type)),
+        media_type="application/json"
+    )
+
+@api_router.get("/sessions/{session_id}/messages/page", response_model=MessagePage)
+async def get_messages_page(session_id: str, feature_type: Optional[str] = Query(None),
+                            limit: int = Query(100, ge=1, le=1000), cursor: Optional[str] = None):
+    """One page of a session's messages, oldest first, continued with next_cursor"""
+    await get_session_or_404(session_id)
+    
+    messages = [message async for message in iter_session_messages(session_id, feature_type, cursor, limit=limit + 1)]
+    next_cursor = None
+    if len(messages) > limit:
+        messages = messages[:limit]
+        next_cursor = encode_keyset_cursor(messages[-1]["timestamp"], messages[-1]["id"])
+    return FastJSONResponse({"messages": trusted_rows(ChatMessage, messages), "next_cursor": next_cursor})
+
+@api_router.get("/sessions/{session_id}/messages/stream")
+async def stream_messages(session_id: str, feature_type: Optional[str] = Query(None), cursor: Optional[str] = None):
+    """Stream a session's messages as NDJSON, writing each message as it is read"""
+    await get_session_or_404(session_id)
+    if cursor:
+        decode_keyset_cursor(cursor)  # Reject a bad cursor before the response starts
+    
+    return StreamingResponse(
+        stream_messages_ndjson(iter_session_messages(session_id, feature_type, cursor)),
+        media_type="application/x-ndjson"
+    )
 
 @api_router.get("/models")
 async def get_available_models():
@@ -1810,16 +5440,14 @@ async def get_available_models():
 # Removed research endpoint - replaced with new features
 
 @api_router.post("/translate")
-async def translate_pdf(request: TranslateRequest):
+async def translate_pdf(request: TranslateRequest, background_tasks: BackgroundTasks):
     # Verify session exists and has PDF
-    session = await db.chat_sessions.find_one({"id": request.session_id})
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
+    session = await get_session_or_404(request.session_id)
     
-    if not session.get("pdf_content"):
+    if not await session_has_document(session):
         raise HTTPException(status_code=400, detail="No PDF uploaded in this session")
     
-    pdf_content = session["pdf_content"]
+    pdf_content = await load_session_document_text(session)
     
     # Limit content based on type
     if request.content_type == "summary":
@@ -1851,7 +5479,7 @@ async def translate_pdf(request: TranslateRequest):
         role="assistant",
         feature_type="translation"
     )
-    await db.chat_messages.insert_one(translation_message.dict())
+    await persist_chat_messages(session, [translation_message], background_tasks, touch_session=False)
     
     return {
         "session_id": request.session_id,
@@ -1861,34 +5489,24 @@ async def translate_pdf(request: TranslateRequest):
     }
 
 @api_router.post("/generate-questions")
-async def generate_questions(request: GenerateQuestionsRequest):
+async def generate_questions(request: GenerateQuestionsRequest, background_tasks: BackgroundTasks):
     # Verify session exists and has PDF
-    session = await db.chat_sessions.find_one({"id": request.session_id})
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
+    session = await get_session_or_404(request.session_id)
     
-    if not session.get("pdf_content"):
+    if not await session_has_document(session):
         raise HTTPException(status_code=400, detail="No PDF uploaded in this session")
     
-    pdf_content = session["pdf_content"]
+    pdf_content = await load_session_document_text(session)
     
-    # Handle chapter segmentation if specified
+    # Handle chapter segmentation if specified, using the outline built at upload
+    matched_chapter = None
     if request.chapter_segment:
-        # Simple chapter detection - could be enhanced
-        content_lines = pdf_content.split('\n')
-        chapter_content = []
-        in_chapter = False
-        
-        for line in content_lines:
-            if request.chapter_segment.lower() in line.lower():
-                in_chapter = True
-            elif any(keyword in line.lower() for keyword in ['chapter', 'section']) and in_chapter:
-                break
-            
-            if in_chapter:
-                chapter_content.append(line)
-        
-        pdf_content = '\n'.join(chapter_content)[:4000] if chapter_content else pdf_content[:4000]
+        outline = await get_session_outline(session)
+        matched_chapter = find_outline_section(outline, request.chapter_segment)
+    
+    if matched_chapter:
+        start = matched_chapter["start"]
+        pdf_content = pdf_content[start:min(matched_chapter["end"], start + 4000)]
     else:
         pdf_content = pdf_content[:4000]
     
@@ -1927,26 +5545,25 @@ Format your response clearly with question numbers, and for MCQs include all opt
         role="assistant",
         feature_type="question_generation"
     )
-    await db.chat_messages.insert_one(questions_message.dict())
+    await persist_chat_messages(session, [questions_message], background_tasks, touch_session=False)
     
     return {
         "session_id": request.session_id,
         "question_type": request.question_type,
         "chapter_segment": request.chapter_segment,
+        "matched_chapter": matched_chapter["title"] if matched_chapter else None,
         "questions": questions_result
     }
 
 @api_router.post("/generate-quiz")
-async def generate_quiz(request: GenerateQuizRequest):
+async def generate_quiz(request: GenerateQuizRequest, background_tasks: BackgroundTasks):
     # Verify session exists and has PDF
-    session = await db.chat_sessions.find_one({"id": request.session_id})
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
+    session = await get_session_or_404(request.session_id)
     
-    if not session.get("pdf_content"):
+    if not await session_has_document(session):
         raise HTTPException(status_code=400, detail="No PDF uploaded in this session")
     
-    pdf_content = session["pdf_content"][:4000]  # Limit content length
+    pdf_content = (await load_session_document_text(session))[:4000]  # Limit content length
     
     # Difficulty level instructions
     difficulty_instructions = {
@@ -1995,7 +5612,7 @@ Format the quiz clearly with question numbers."""
         role="assistant",
         feature_type="quiz_generation"
     )
-    await db.chat_messages.insert_one(quiz_message.dict())
+    await persist_chat_messages(session, [quiz_message], background_tasks, touch_session=False)
     
     return {
         "session_id": request.session_id,
@@ -2005,97 +5622,122 @@ Format the quiz clearly with question numbers."""
         "quiz": quiz_result
     }
 
-@api_router.post("/search")
-async def advanced_search(request: SearchRequest):
+async def search_documents(query: SearchQuery, limit: int) -> List[Dict[str, Any]]:
+    """Document hits with snippet windows around their indexed match offsets"""
+    hits = await asyncio.to_thread(document_search_index.search, query, limit)
+    if not hits:
+        return []
+    # Hits are re-read so documents deleted since indexing drop out
+    records = await storage.documents.find_many([hit.item_id for hit in hits], ("filename", "upload_date"), analytics=True)
+    missing = [hit.item_id for hit in hits if hit.item_id not in records]
+    if missing and storage.backend == "mongo":
+        # A lagging secondary may not have them yet; only a primary miss means deleted
+        records.update(await storage.documents.find_many(missing, ("filename", "upload_date")))
+    texts = await asyncio.gather(*(
+        load_document_text(hit.item_id) if hit.item_id in records else asyncio.sleep(0)
+        for hit in hits
+    ))
+    
     results = []
+    for hit, content in zip(hits, texts):
+        if content is None:
+            document_search_index.remove(hit.item_id)
+            continue
+        doc = records[hit.item_id]
+        snippets = build_snippets(content, hit.matches)
+        results.append({
+            "type": "pdf",
+            "filename": doc["filename"],
+            "snippet": snippets[0]["text"] if snippets else "",
+            "snippets": snippets,
+            "upload_date": doc["upload_date"],
+            "relevance_score": hit.score
+        })
+    return results
+
+async def search_conversations(query: SearchQuery, limit: int) -> List[Dict[str, Any]]:
+    """Message hits with their session titles, resolved in one batched query"""
+    hits = await asyncio.to_thread(message_search_index.search, query, limit)
+    if not hits:
+        return []
+    messages = await storage.messages.find_by_ids([hit.item_id for hit in hits], analytics=True)
+    missing = [hit.item_id for hit in hits if hit.item_id not in messages]
+    if missing and storage.backend == "mongo":
+        # Moved to the cold archive since they were indexed
+        session_ids = list({message_search_index.session_of(item_id) for item_id in missing} - {None})
+        messages.update(await load_archived_messages(session_ids, missing, analytics_db))
+        missing = [item_id for item_id in missing if item_id not in messages]
+        if missing:
+            # A lagging secondary may not have them yet; only a primary miss means deleted
+            messages.update(await storage.messages.find_by_ids(missing))
+            messages.update(await load_archived_messages(
+                session_ids, [item_id for item_id in missing if item_id not in messages]
+            ))
+    titles = await storage.sessions.titles(list({msg["session_id"] for msg in messages.values()}), analytics=True)
     
+    results = []
+    for hit in hits:
+        msg = messages.get(hit.item_id)
+        if msg is None:
+            # Deleted, or still in a write-behind queue
+            if CHAT_WRITE_MODE != "write_behind":
+                message_search_index.remove(hit.item_id)
+            continue
+        results.append({
+            "type": "conversation",
+            "session_title": titles.get(msg["session_id"], "Unknown Session"),
+            "session_id": msg["session_id"],
+            "content": msg["content"][:200] + "..." if len(msg["content"]) > 200 else msg["content"],
+            "snippets": build_snippets(msg["content"], hit.matches),
+            "timestamp": msg["timestamp"],
+            "feature_type": msg.get("feature_type", "chat"),
+            "relevance_score": hit.score
+        })
+    return results
+
+@api_router.post("/search")
+async def advanced_search(request: SearchRequest):
+    query = parse_search_query(request.query)
+    phases = []
     if request.search_type in ["all", "pdfs"]:
-        # Search in PDF documents
-        pdf_query = {"content": {"$regex": request.query, "$options": "i"}}
-        pdf_docs = await db.documents.find(pdf_query).limit(request.limit).to_list(request.limit)
-        
-        for doc in pdf_docs:
-            # Find snippet around the search term
-            content = doc["content"]
-            query_lower = request.query.lower()
-            content_lower = content.lower()
-            
-            if query_lower in content_lower:
-                start_idx = max(0, content_lower.find(query_lower) - 100)
-                end_idx = min(len(content), start_idx + 300)
-                snippet = content[start_idx:end_idx]
-                
-                results.append({
-                    "type": "pdf",
-                    "filename": doc["filename"],
-                    "snippet": snippet,
-                    "upload_date": doc["upload_date"],
-                    "relevance_score": content_lower.count(query_lower)
-                })
-    
+        phases.append(search_documents(query, request.limit))
     if request.search_type in ["all", "conversations"]:
-        # Search in chat messages
-        msg_query = {"content": {"$regex": request.query, "$options": "i"}}
-        messages = await db.chat_messages.find(msg_query).limit(request.limit).to_list(request.limit)
-        
-        for msg in messages:
-            # Get session info for context
-            session = await db.chat_sessions.find_one({"id": msg["session_id"]})
-            session_title = session["title"] if session else "Unknown Session"
-            
-            results.append({
-                "type": "conversation",
-                "session_title": session_title,
-                "session_id": msg["session_id"],
-                "content": msg["content"][:200] + "..." if len(msg["content"]) > 200 else msg["content"],
-                "timestamp": msg["timestamp"],
-                "feature_type": msg["feature_type"]
-            })
+        phases.append(search_conversations(query, request.limit))
+    
+    # Both phases run concurrently
+    results = [result for phase_results in await asyncio.gather(*phases) for result in phase_results]
     
-    # Sort results by relevance/recency
-    results.sort(key=lambda x: x.get("relevance_score", 1) if x["type"] == "pdf" else 1, reverse=True)
+    # Both indexes score with BM25 and the same recency decay
+    results.sort(key=lambda result: result["relevance_score"], reverse=True)
     
     return {
         "query": request.query,
         "search_type": request.search_type,
         "total_results": len(results),
-        "results": results[:request.limit]
+        "results": results[:request.limit],
+        "index_ready": document_search_index.ready and message_search_index.ready
     }
 
 @api_router.post("/export")
 async def export_conversation(request: ExportRequest):
     # Verify session exists
-    session = await db.chat_sessions.find_one({"id": request.session_id})
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
-    
-    # Get messages based on filter
-    query = {"session_id": request.session_id}
-    if request.feature_type:
-        query["feature_type"] = request.feature_type
-    
-    messages = await db.chat_messages.find(query).sort("timestamp", 1).to_list(1000)
-    
-    # Format content for export
-    export_content = f"Chat Session: {session['title']}\n"
-    export_content += f"Created: {session['created_at']}\n"
-    if session.get('pdf_filename'):
-        export_content += f"PDF: {session['pdf_filename']}\n"
-    export_content += "\n" + "="*50 + "\n\n"
+    session = await get_session_or_404(request.session_id)
+    if request.export_format not in ("txt", "pdf", "docx"):
+        raise HTTPException(status_code=400, detail="Unsupported export format")
     
-    for msg in messages:
-        role_label = "User" if msg["role"] == "user" else "Assistant"
-        export_content += f"[{msg['timestamp']}] {role_label}:\n{msg['content']}\n\n"
+    # Get messages based on filter; exports read from the analytics route and may trail the primary slightly
+    message_stream = iter_session_messages(request.session_id, request.feature_type, analytics=True)
     
     if request.export_format == "txt":
-        # Return plain text
-        from fastapi.responses import Response
-        return Response(
-            content=export_content,
+        # Stream plain text straight from the cursor, without holding the transcript in memory
+        return StreamingResponse(
+            stream_export_text(session, message_stream),
             media_type="text/plain",
-            headers={"Content-Disposition": f"attachment; filename={session['title']}.txt"}
+            headers={"Content-Disposition": attachment_disposition(f"{session['title']}.txt")}
         )
-    elif request.export_format == "pdf":
+    
+    messages = [message async for message in message_stream]
+    if request.export_format == "pdf":
         # Generate PDF using reportlab
         from reportlab.lib.pagesizes import letter
         from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
@@ -2128,7 +5770,7 @@ async def export_conversation(request: ExportRequest):
         return Response(
             content=buffer.read(),
             media_type="application/pdf",
-            headers={"Content-Disposition": f"attachment; filename={session['title']}.pdf"}
+            headers={"Content-Disposition": attachment_disposition(f"{session['title']}.pdf")}
         )
     elif request.export_format == "docx":
         # Generate DOCX using python-docx
@@ -2157,66 +5799,34 @@ async def export_conversation(request: ExportRequest):
         return Response(
             content=buffer.read(),
             media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-            headers={"Content-Disposition": f"attachment; filename={session['title']}.docx"}
+            headers={"Content-Disposition": attachment_disposition(f"{session['title']}.docx")}
         )
-    
-    else:
-        raise HTTPException(status_code=400, detail="Unsupported export format")
 
 @api_router.get("/insights")
 async def get_insights():
-    # Get total sessions
-    total_sessions = await db.chat_sessions.count_documents({})
-    
-    # Get total messages
-    total_messages = await db.chat_messages.count_documents({})
-    
-    # Get total PDFs uploaded
-    total_pdfs = await db.documents.count_documents({})
-    
-    # Get feature usage statistics
-    feature_usage = await db.chat_messages.aggregate([
-        {"$group": {"_id": "$feature_type", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}}
-    ]).to_list(10)
-    
-    # Get popular PDFs (most referenced)
-    popular_pdfs = await db.chat_sessions.aggregate([
-        {"$match": {"pdf_filename": {"$exists": True, "$ne": None}}},
-        {"$group": {"_id": "$pdf_filename", "usage_count": {"$sum": 1}}},
-        {"$sort": {"usage_count": -1}},
-        {"$limit": 5}
-    ]).to_list(5)
-    
-    # Get daily usage for last 7 days
-    from datetime import datetime, timedelta
-    seven_days_ago = datetime.utcnow() - timedelta(days=7)
-    
-    daily_usage = await db.chat_messages.aggregate([
-        {"$match": {"timestamp": {"$gte": seven_days_ago}}},
-        {
-            "$group": {
-                "_id": {
-                    "$dateToString": {
-                        "format": "%Y-%m-%d",
-                        "date": "$timestamp"
-                    }
-                },
-                "message_count": {"$sum": 1}
-            }
-        },
-        {"$sort": {"_id": 1}}
-    ]).to_list(7)
+    """Dashboard numbers read from the usage rollups instead of scanning the collections"""
+    now = datetime.utcnow()
+    days = [usage_day(now - timedelta(days=offset)) for offset in range(USAGE_HISTORY_DAYS - 1, -1, -1)]
+    if storage.backend == "memory":
+        await usage_rollup.flush()  # In-process counters; no reason to show them a flush interval late
+    totals, day_counts = await storage.usage.read(days)
+    
+    features = sorted((totals.get("features") or {}).items(), key=lambda item: item[1], reverse=True)
     
     return {
         "overview": {
-            "total_sessions": total_sessions,
-            "total_messages": total_messages,
-            "total_pdfs": total_pdfs
+            "total_sessions": totals.get("sessions", 0),
+            "total_messages": totals.get("messages", 0),
+            "total_pdfs": totals.get("documents", 0)
         },
-        "feature_usage": feature_usage,
-        "popular_pdfs": popular_pdfs,
-        "daily_usage": daily_usage
+        "feature_usage": [{"_id": feature, "count": count} for feature, count in features[:10] if count > 0],
+        "popular_pdfs": totals.get("popular_pdfs", []),  # As of reconciled_at
+        "daily_usage": [{"_id": day, "message_count": day_counts[day]} for day in days if day_counts[day] > 0],
+        "freshness": {
+            "as_of": totals.get("updated_at"),
+            "reconciled_at": totals.get("reconciled_at"),
+            "flush_interval_seconds": USAGE_FLUSH_SECONDS
+        }
     }
 
 # Add CORS middleware with environment-specific origins
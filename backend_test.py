@@ -4,6 +4,7 @@ Comprehensive Backend Testing for ChatPDF Application
 Tests all API endpoints and functionality as specified in test_result.md
 """
 
+import argparse
 import asyncio
 import aiohttp
 import json
@@ -17,6 +18,23 @@ import uuid
 # Backend URL from frontend/.env
 BACKEND_URL = "http://localhost:8001"
 API_BASE_URL = f"{BACKEND_URL}/api"
+IN_PROCESS_SERVER = None  # The server module when started with --in-process
+
+async def read_stored_session(session_id: str) -> Optional[Dict[str, Any]]:
+    """A session as stored, past the response models and projections of the API"""
+    if IN_PROCESS_SERVER is not None:
+        sessions = IN_PROCESS_SERVER.storage.sessions
+        record = await sessions.get(session_id)
+        if record is not None:
+            record["document_content"] = await sessions.legacy_document_text(session_id)
+        return record
+    from motor.motor_asyncio import AsyncIOMotorClient
+    client = AsyncIOMotorClient(os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    try:
+        database = client[os.environ.get("DB_NAME", "chatpdf_database")]
+        return await database.chat_sessions.find_one({"id": session_id}, {"_id": 0})
+    finally:
+        client.close()
 
 class ChatPDFTester:
     def __init__(self):
@@ -85,10 +103,43 @@ class ChatPDFTester:
                     data = await response.json()
                     uptime = data.get('uptime', 0)
                     self.log_test("Health Metrics", True, f"Uptime: {uptime:.2f}s")
+                    pool = data.get('mongo_pool', {})
+                    self.log_test("Mongo Pool Metrics", 'max_pool_size' in pool,
+                                f"Max pool size: {pool.get('max_pool_size')}, read preference: {pool.get('analytics_read_preference')}")
                 else:
                     self.log_test("Health Metrics", False, f"HTTP {response.status}")
         except Exception as e:
             self.log_test("Health Metrics", False, f"Exception: {str(e)}")
+        
+        # Index usage of endpoint queries
+        try:
+            async with self.session.get(f"{API_BASE_URL}/system-health/indexes") as response:
+                if response.status == 200:
+                    data = await response.json()
+                    unindexed = [query['endpoint'] for query in data.get('queries', []) if not query.get('uses_index')]
+                    self.log_test("Index Usage", not unindexed,
+                                "All endpoint queries use an index" if not unindexed else f"Collection scans: {', '.join(unindexed)}")
+                elif response.status == 501:
+                    self.log_test("Index Usage", True, "Not available with in-memory storage")
+                else:
+                    self.log_test("Index Usage", False, f"HTTP {response.status}")
+        except Exception as e:
+            self.log_test("Index Usage", False, f"Exception: {str(e)}")
+        
+        # A manual retention GC pass reports what it reclaimed
+        try:
+            async with self.session.post(f"{API_BASE_URL}/system-health/retention/gc") as response:
+                if response.status == 200:
+                    data = await response.json()
+                    self.log_test("Retention GC", 'bytes_reclaimed' in data,
+                                f"{data.get('documents_deleted')} documents, {data.get('messages_deleted')} messages, "
+                                f"{data.get('bytes_reclaimed')} bytes reclaimed")
+                elif response.status == 501:
+                    self.log_test("Retention GC", True, "Not available with in-memory storage")
+                else:
+                    self.log_test("Retention GC", False, f"HTTP {response.status}")
+        except Exception as e:
+            self.log_test("Retention GC", False, f"Exception: {str(e)}")
     
     async def test_models_endpoint(self):
         """Test available AI models endpoint"""
@@ -146,6 +197,23 @@ class ChatPDFTester:
                     self.log_test("List Sessions", False, f"HTTP {response.status}")
         except Exception as e:
             self.log_test("List Sessions", False, f"Exception: {str(e)}")
+        
+        # Paginated session summaries
+        try:
+            async with self.session.get(f"{API_BASE_URL}/sessions/summary", params={"limit": 1}) as response:
+                if response.status == 200:
+                    page = await response.json()
+                    summaries = page.get('sessions', [])
+                    leaked = [key for key in ('document_content', 'pdf_content', 'document_outline')
+                              if summaries and key in summaries[0]]
+                    if len(summaries) == 1 and not leaked:
+                        self.log_test("Session Summaries", True, f"Next cursor: {'yes' if page.get('next_cursor') else 'none'}")
+                    else:
+                        self.log_test("Session Summaries", False, f"Unexpected page: {len(summaries)} sessions, fields {leaked}")
+                else:
+                    self.log_test("Session Summaries", False, f"HTTP {response.status}")
+        except Exception as e:
+            self.log_test("Session Summaries", False, f"Exception: {str(e)}")
     
     async def test_supported_formats(self):
         """Test supported document formats endpoint"""
@@ -293,6 +361,90 @@ startxref
         except Exception as e:
             self.log_test("Legacy PDF Upload", False, f"Exception: {str(e)}")
     
+    async def test_document_outline(self):
+        """Test chapter outline built at upload time"""
+        print("📑 Testing Document Outline...")
+        
+        if not self.test_session_id:
+            self.log_test("Document Outline", False, "No test session available")
+            return
+        
+        test_text_content = b"CHAPTER 1 Introduction\nIntro text.\nCHAPTER 2 Methods\nMethods text.\n"
+        
+        try:
+            data = aiohttp.FormData()
+            data.add_field('file', test_text_content,
+                          filename='outline_test.txt',
+                          content_type='text/plain')
+            
+            async with self.session.post(
+                f"{API_BASE_URL}/sessions/{self.test_session_id}/upload-document",
+                data=data
+            ) as response:
+                if response.status != 200:
+                    self.log_test("Document Outline", False, f"Upload failed: HTTP {response.status}")
+                    return
+            
+            async with self.session.get(
+                f"{API_BASE_URL}/sessions/{self.test_session_id}/outline"
+            ) as response:
+                if response.status == 200:
+                    result = await response.json()
+                    titles = [chapter['title'] for chapter in result.get('chapters', [])]
+                    if titles == ["CHAPTER 1 Introduction", "CHAPTER 2 Methods"]:
+                        self.log_test("Document Outline", True, f"Chapters: {', '.join(titles)}")
+                    else:
+                        self.log_test("Document Outline", False, f"Unexpected chapters: {titles}")
+                else:
+                    response_text = await response.text()
+                    self.log_test("Document Outline", False, 
+                                f"HTTP {response.status}: {response_text}")
+            
+            # The session references the document; text and outline stay on the document record
+            stored = await read_stored_session(self.test_session_id)
+            if (stored and stored.get('document_ids') and 'document_outline' not in stored
+                    and not stored.get('document_content') and not stored.get('pdf_content')):
+                self.log_test("Session Document Reference", True, f"{len(json.dumps(stored, default=str))} bytes per session")
+            else:
+                self.log_test("Session Document Reference", False, f"Unexpected session: {stored}")
+        except Exception as e:
+            self.log_test("Document Outline", False, f"Exception: {str(e)}")
+    
+    async def test_batch_document_upload(self):
+        """Test multi-file batch upload endpoint"""
+        print("📚 Testing Batch Document Upload...")
+        
+        if not self.test_session_id:
+            self.log_test("Batch Document Upload", False, "No test session available")
+            return
+        
+        try:
+            data = aiohttp.FormData()
+            data.add_field('files', b"First batch document about testing.",
+                          filename='batch_one.txt', content_type='text/plain')
+            data.add_field('files', b"name,value\nalpha,1\nbeta,2\n",
+                          filename='batch_two.csv', content_type='text/csv')
+            data.add_field('files', b"not supported",
+                          filename='batch_three.exe', content_type='application/octet-stream')
+            
+            async with self.session.post(
+                f"{API_BASE_URL}/sessions/{self.test_session_id}/upload-documents",
+                data=data
+            ) as response:
+                if response.status == 200:
+                    result = await response.json()
+                    if result.get('succeeded') == 2 and result.get('failed') == 1:
+                        self.log_test("Batch Document Upload", True, result.get('message', ''))
+                    else:
+                        self.log_test("Batch Document Upload", False, 
+                                    f"Unexpected report: {result.get('results')}")
+                else:
+                    response_text = await response.text()
+                    self.log_test("Batch Document Upload", False, 
+                                f"HTTP {response.status}: {response_text}")
+        except Exception as e:
+            self.log_test("Batch Document Upload", False, f"Exception: {str(e)}")
+    
     async def test_chat_functionality(self):
         """Test chat functionality with AI integration"""
         print("💬 Testing Chat Functionality...")
@@ -464,7 +616,42 @@ startxref
                                 f"HTTP {response.status}: {response_text}")
         except Exception as e:
             self.log_test("Advanced Search", False, f"Exception: {str(e)}")
-    
+        
+        # Phrase queries match consecutive words; regex metacharacters are treated as plain text
+        try:
+            checks = []
+            for query in ['"artificial intelligence"', '(((test[']:
+                async with self.session.post(f"{API_BASE_URL}/search",
+                                           json={"query": query, "search_type": "pdfs", "limit": 10}) as response:
+                    checks.append((query, response.status, len((await response.json()).get('results', []))
+                                   if response.status == 200 else 0))
+            phrase_ok = checks[0][1] == 200 and checks[0][2] > 0
+            literal_ok = checks[1][1] == 200
+            self.log_test("Phrase and Literal Search", phrase_ok and literal_ok,
+                        ", ".join(f"{query}: HTTP {status}, {count} results" for query, status, count in checks))
+        except Exception as e:
+            self.log_test("Phrase and Literal Search", False, f"Exception: {str(e)}")
+
+        # Results are ranked best first and carry snippet windows with in-bounds highlight ranges
+        try:
+            async with self.session.post(f"{API_BASE_URL}/search",
+                                       json={"query": "intelligence", "search_type": "all", "limit": 10}) as response:
+                if response.status == 200:
+                    results = (await response.json()).get('results', [])
+                    scores = [item.get('relevance_score', 0) for item in results]
+                    snippets = [snippet for item in results for snippet in item.get('snippets', [])]
+                    ranked = scores == sorted(scores, reverse=True)
+                    highlighted = all(
+                        0 <= start < end <= len(snippet['text'])
+                        for snippet in snippets for start, end in snippet['highlights']
+                    )
+                    self.log_test("Ranked Search Snippets", bool(results) and ranked and highlighted,
+                                f"{len(results)} results, {len(snippets)} snippets, scores {scores[:3]}")
+                else:
+                    self.log_test("Ranked Search Snippets", False, f"HTTP {response.status}")
+        except Exception as e:
+            self.log_test("Ranked Search Snippets", False, f"Exception: {str(e)}")
+
     async def test_export_functionality(self):
         """Test conversation export functionality"""
         print("📥 Testing Export Functionality...")
@@ -486,6 +673,11 @@ startxref
                                            json=export_data) as response:
                     if response.status == 200:
                         content_type = response.headers.get('content-type', '')
+                        disposition = response.headers.get('content-disposition', '')
+                        body = await response.read()
+                        if export_format == "txt" and not (body.startswith(b"Chat Session:") and "attachment" in disposition):
+                            self.log_test("Export TXT", False, f"Unexpected transcript: {body[:40]!r}, {disposition}")
+                            continue
                         self.log_test(f"Export {export_format.upper()}", True, 
                                     f"Content-Type: {content_type}")
                     else:
@@ -503,7 +695,7 @@ startxref
             async with self.session.get(f"{API_BASE_URL}/insights") as response:
                 if response.status == 200:
                     result = await response.json()
-                    stats = result.get('usage_stats', {})
+                    stats = result.get('overview', {})
                     total_sessions = stats.get('total_sessions', 0)
                     self.log_test("Insights Dashboard", True, 
                                 f"Total sessions: {total_sessions}")
@@ -513,7 +705,17 @@ startxref
                                 f"HTTP {response.status}: {response_text}")
         except Exception as e:
             self.log_test("Insights Dashboard", False, f"Exception: {str(e)}")
-    
+
+        # Numbers come from rollups and say how fresh they are
+        try:
+            async with self.session.get(f"{API_BASE_URL}/insights") as response:
+                result = await response.json() if response.status == 200 else {}
+                freshness = result.get('freshness', {})
+                self.log_test("Insights Freshness", bool(freshness.get('as_of')),
+                            f"As of {freshness.get('as_of')}, reconciled {freshness.get('reconciled_at')}")
+        except Exception as e:
+            self.log_test("Insights Freshness", False, f"Exception: {str(e)}")
+
     async def test_message_retrieval(self):
         """Test message retrieval functionality"""
         print("📨 Testing Message Retrieval...")
@@ -537,6 +739,35 @@ startxref
                                 f"HTTP {response.status}: {response_text}")
         except Exception as e:
             self.log_test("Message Retrieval", False, f"Exception: {str(e)}")
+        
+        # Cursor pages and the NDJSON stream must return the same messages as the full listing
+        try:
+            async with self.session.get(f"{API_BASE_URL}/sessions/{self.test_session_id}/messages") as response:
+                expected_ids = [message['id'] for message in await response.json()]
+            
+            paged_ids = []
+            cursor = None
+            while True:
+                params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+                async with self.session.get(
+                    f"{API_BASE_URL}/sessions/{self.test_session_id}/messages/page", params=params
+                ) as response:
+                    page = await response.json()
+                paged_ids += [message['id'] for message in page['messages']]
+                cursor = page.get('next_cursor')
+                if not cursor:
+                    break
+            
+            async with self.session.get(f"{API_BASE_URL}/sessions/{self.test_session_id}/messages/stream") as response:
+                streamed_ids = [json.loads(line)['id'] for line in (await response.text()).splitlines() if line]
+            
+            if paged_ids == expected_ids and streamed_ids == expected_ids:
+                self.log_test("Message Pagination", True, f"{len(expected_ids)} messages via pages and stream")
+            else:
+                self.log_test("Message Pagination", False,
+                            f"Listing {len(expected_ids)}, pages {len(paged_ids)}, stream {len(streamed_ids)}")
+        except Exception as e:
+            self.log_test("Message Pagination", False, f"Exception: {str(e)}")
     
     async def cleanup_test_session(self):
         """Clean up test session"""
@@ -569,6 +800,8 @@ startxref
         await self.test_session_management()
         await self.test_supported_formats()
         await self.test_document_upload()
+        await self.test_batch_document_upload()
+        await self.test_document_outline()
         await self.test_chat_functionality()
         await self.test_question_generation()
         await self.test_research_features()
@@ -600,18 +833,49 @@ startxref
         print("\n🎯 Testing completed!")
         return passed, total
 
-async def main():
+async def start_in_process_backend():
+    """Serve backend/server.py from this process with in-memory storage, on a free local port"""
+    global BACKEND_URL, API_BASE_URL, IN_PROCESS_SERVER
+    os.environ["STORAGE_BACKEND"] = "memory"
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+    import uvicorn
+    import server as backend_server
+    IN_PROCESS_SERVER = backend_server
+    
+    server = uvicorn.Server(uvicorn.Config(backend_server.app, host="127.0.0.1", port=0, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()  # Startup failed; raise its error
+        await asyncio.sleep(0.05)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    BACKEND_URL = f"http://127.0.0.1:{port}"
+    API_BASE_URL = f"{BACKEND_URL}/api"
+    return server, task
+
+async def main(in_process: bool = False):
     """Main test runner"""
-    async with ChatPDFTester() as tester:
-        passed, total = await tester.run_all_tests()
-        
-        # Exit with appropriate code
-        if passed == total:
-            print("🎉 All tests passed!")
-            sys.exit(0)
-        else:
-            print(f"⚠️  {total - passed} tests failed!")
-            sys.exit(1)
+    backend = await start_in_process_backend() if in_process else None
+    try:
+        async with ChatPDFTester() as tester:
+            passed, total = await tester.run_all_tests()
+    finally:
+        if backend:
+            server, task = backend
+            server.should_exit = True
+            await task
+    
+    # Exit with appropriate code
+    if passed == total:
+        print("🎉 All tests passed!")
+        sys.exit(0)
+    else:
+        print(f"⚠️  {total - passed} tests failed!")
+        sys.exit(1)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Backend API tests")
+    parser.add_argument("--in-process", action="store_true",
+                        help="Start the backend in this process with STORAGE_BACKEND=memory instead of using BACKEND_URL")
+    args = parser.parse_args()
+    asyncio.run(main(args.in_process))
\ No newline at end of file
@@ -716,17 +716,18 @@ const ChatInterface = ({ currentFeature, setCurrentFeature, setCurrentView }) =>
   const loadSessions = async () => {
     try {
       const response = await handleErrorWithRetry(
-        () => apiClient.get('/sessions'),
+        () => apiClient.get('/sessions/summary', { params: { limit: 100 } }),
         2, // 2 retries
         1000 // 1 second delay
       );
-      setSessions(response.data);
-      if (response.data.length === 0) {
+      const loadedSessions = response.data.sessions;
+      setSessions(loadedSessions);
+      if (loadedSessions.length === 0) {
         await createNewSession();
       } else {
         // Automatically select the first session if none is currently selected
         if (!currentSession) {
-          setCurrentSession(response.data[0]);
+          setCurrentSession(loadedSessions[0]);
         }
       }
       NotificationManager.showSuccess('Sessions loaded successfully');